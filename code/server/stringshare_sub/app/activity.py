@@ -0,0 +1,111 @@
+# Importing necessary modules and components
+import asyncio
+import logging
+from uuid import UUID
+from sqlalchemy.sql import select, insert
+from database import database
+from constants import ACTIVITY_FLUSH_INTERVAL, ACTIVITY_BATCH_SIZE, ACTIVITY_QUEUE_SIZE, ACTIVITY_MAX_ATTEMPTS, \
+    ACTIVITY_RETRY_DELAY
+import communities
+import tables
+import models
+import versions
+
+logger = logging.getLogger(__name__)
+
+
+# Writer queueing activity events in memory and inserting them in batches from a background task
+class ActivityWriter:
+    def __init__(self, interval: float = ACTIVITY_FLUSH_INTERVAL, batch_size: int = ACTIVITY_BATCH_SIZE,
+                 queue_size: int = ACTIVITY_QUEUE_SIZE, max_attempts: int = ACTIVITY_MAX_ATTEMPTS,
+                 retry_delay: float = ACTIVITY_RETRY_DELAY):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = None
+        self._task = None
+
+    # Asynchronous function to queue an activity event. 'user' may be None for post events, in which case
+    # it is resolved to the post's author when the batch is written.
+    async def log(self, user: str, action_user: str, action: models.ActivityAction, post_id: UUID = None):
+        event = {'user': user, 'action_user': action_user, 'action': action, 'post_id': post_id}
+        if self._task is None:
+            # Writing straight away when the background task is not running (e.g. from helper routines)
+            await self.write([event])
+        else:
+            # Waiting for room in the queue when it is full, so a burst of writes cannot exhaust memory
+            await self._queue.put(event)
+
+    # Asynchronous function to insert a batch of events with one author lookup and one multi-row INSERT
+    async def write(self, events: list):
+        missing = {event['post_id'] for event in events if event['user'] is None}
+        authors = {}
+        if missing:
+            query = select([tables.posts.c.post_id, tables.posts.c.username]).where(
+                tables.posts.c.post_id.in_(list(missing)))
+            authors = {str(row.post_id): row.username for row in await database.fetch_all(query)}
+
+        rows = []
+        for event in events:
+            user = event['user'] or authors.get(str(event['post_id']))
+            # Events on posts deleted in the meantime are dropped
+            if user:
+                rows.append({**event, 'user': user})
+        if not rows:
+            return
+
+        await database.execute(insert(tables.activity).values(rows))
+        versions.bump(*{row['user'] for row in rows})
+
+    # Asynchronous function writing a batch, retrying with exponential backoff while the database fails (the queue
+    # fills up meanwhile, slowing writers down), then writing its events one by one so only those that cannot be
+    # inserted are dropped
+    async def write_batch(self, batch: list):
+        for attempt in range(self.max_attempts):
+            try:
+                await self.write(batch)
+                return
+            except Exception as e:
+                logger.warning("failed to write %d activity events (attempt %d): %s", len(batch), attempt + 1, e)
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        for event in batch:
+            try:
+                await self.write([event])
+            except Exception:
+                logger.exception("dropping activity event %s", event)
+
+    # Background task draining the queue every 'interval' seconds
+    async def run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self.interval)
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                await self.write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self.run())
+
+    # Asynchronous function waiting for the queued events to be written, then stopping the background task
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+# Writer of the current community, shared by log_action and the like buffer
+activity_writer = communities.PerCommunity(lambda community: ActivityWriter())
@@ -0,0 +1,134 @@
+# Importing necessary modules and components
+import math
+import time
+from collections import Counter
+from typing import Dict, Tuple
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+from jose import jwt, JWTError
+from constants import ADMISSION_RATE, ADMISSION_BURST, ADMISSION_ROUTE_LIMITS, ADMISSION_MAX_IN_FLIGHT, \
+    ADMISSION_MAX_POOL_WAITERS, SECRET_KEY
+import auth
+import cache
+import database
+
+
+# Token bucket refilled at 'rate' tokens per second, holding at most 'burst' tokens
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Function taking one token, returning 0 when it was available or else the seconds until one will be
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+# Functions reading the connection pool of the current database: whether every connection is in use (so new
+# queries wait), and its maximum size (asyncpg pools only; other backends are never reported as saturated)
+def _pool():
+    return getattr(getattr(database.database, '_backend', None), '_pool', None)
+
+
+def pool_saturated():
+    pool = _pool()
+    try:
+        return pool is not None and pool.get_idle_size() == 0 and pool.get_size() >= pool.get_max_size()
+    except AttributeError:
+        return False
+
+
+def pool_size():
+    return _pool().get_max_size()
+
+
+# Admission controller applying per-user, per-route token buckets and shedding load when the server is overloaded
+class AdmissionController:
+    def __init__(self, rate: float = ADMISSION_RATE, burst: float = ADMISSION_BURST,
+                 route_limits: Dict[str, Tuple[float, float]] = ADMISSION_ROUTE_LIMITS,
+                 max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_pool_waiters: int = ADMISSION_MAX_POOL_WAITERS):
+        self.rate = rate
+        self.burst = burst
+        self.route_limits = route_limits
+        self.max_in_flight = max_in_flight
+        self.max_pool_waiters = max_pool_waiters
+        self.in_flight = 0
+        self._buckets = cache.LRUCache(100000)
+        # Counters of admitted and shed requests, per reason and route
+        self.admitted = 0
+        self.shed = Counter()
+
+    # Function identifying who sends a request: the subject of a valid token, else the client address (a forged or
+    # expired token cannot pick the bucket it is counted in)
+    @staticmethod
+    def client_key(request: Request):
+        authorization = request.headers.get('authorization', '')
+        if authorization.lower().startswith('bearer '):
+            try:
+                subject = jwt.decode(authorization[7:], SECRET_KEY, algorithms=[auth.ALGORITHM]).get('sub')
+                if subject:
+                    return subject
+            except JWTError:
+                pass
+        return request.client.host if request.client else ''
+
+    # Function estimating how many in-flight requests are waiting for a database connection
+    def pool_waiters(self):
+        if not pool_saturated():
+            return 0
+        return max(self.in_flight - pool_size(), 0)
+
+    def _reject(self, reason: str, path: str, status_code: int, retry_after: float):
+        self.shed[(reason, path)] += 1
+        return JSONResponse(
+            status_code=status_code,
+            content={'detail': reason.replace('_', ' ')},
+            headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+        )
+
+    # Middleware admitting, rate limiting (429) or shedding (503) each request
+    async def __call__(self, request: Request, call_next):
+        path = request.url.path
+
+        # Shedding everything beyond the in-flight limit or while too many requests wait for the pool
+        if self.in_flight >= self.max_in_flight:
+            return self._reject('overloaded', path, status.HTTP_503_SERVICE_UNAVAILABLE, 1)
+        if self.pool_waiters() >= self.max_pool_waiters:
+            return self._reject('database_busy', path, status.HTTP_503_SERVICE_UNAVAILABLE, 1)
+
+        # Rate limiting each client on each route
+        key = (self.client_key(request), path)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*self.route_limits.get(path, (self.rate, self.burst)))
+            self._buckets.set(key, bucket)
+        wait = bucket.take()
+        if wait:
+            return self._reject('rate_limited', path, status.HTTP_429_TOO_MANY_REQUESTS, wait)
+
+        self.admitted += 1
+        self.in_flight += 1
+        try:
+            return await call_next(request)
+        finally:
+            self.in_flight -= 1
+
+    # Function returning the counters, for the /util/admission route
+    def stats(self):
+        shed = {}
+        for (reason, path), count in self.shed.items():
+            shed.setdefault(reason, {})[path] = count
+        return {'admitted': self.admitted, 'in_flight': self.in_flight, 'shed': shed}
+
+
+admission_controller = AdmissionController()
@@ -1,15 +1,16 @@
 # Importing necessary modules and classes from FastAPI, JWT, and other libraries
 from datetime import datetime, timedelta
 from typing import Optional
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from models import UserAuthIn, User, TokenData
 from tables import users, user_credentials
-from database import database
+from database import read_database
 from sqlalchemy.sql import select, insert
 import bcrypt
+import hmac
 import exceptions
 import constants
 
@@ -35,11 +36,16 @@ def get_password_hash(password_and_salt):
 def gen_salt():
     return str(bcrypt.gensalt(10))
 
+# Dependency checking the admin key on admin routes, which are disabled when ADMIN_KEY is not set
+async def verify_admin(x_admin_key: Optional[str] = Header(None)):
+    if not constants.ADMIN_KEY or not hmac.compare_digest(x_admin_key or '', constants.ADMIN_KEY):
+        raise exceptions.API_401_CREDENTIALS_EXCEPTION
+
 # Function to get a user by their username from the database
 async def get_user(username: str):
     query = select([users.join(user_credentials, users.c.username == user_credentials.c.username)]).where(
         users.c.username == username.lower())
-    user = await database.fetch_one(query)
+    user = await read_database(username.lower()).fetch_one(query)
     if user:
         return UserAuthIn(**user)
 
@@ -0,0 +1,62 @@
+# Benchmark comparing the default FastAPI serialization path (pydantic validation + jsonable_encoder + json)
+# with the orjson record path in responses.py, for a profile-sized list of posts.
+#
+# Usage: python benchmark.py [number_of_posts] [repeats]
+
+# Importing standard libraries
+import datetime
+import json
+import sys
+import timeit
+import uuid
+
+# Importing FastAPI's encoder used by the default response path
+from fastapi.encoders import jsonable_encoder
+
+# Importing custom modules
+import models
+import responses
+
+
+# Function to build rows shaped like the result of methods.get_feed / get_user_profile
+def make_rows(count: int):
+    now = datetime.datetime.now()
+    return [{
+        'post_id': uuid.uuid4(),
+        'username': 'user%d@stringshare.ca' % (i % 50),
+        'full_name': 'User %d' % (i % 50),
+        'avatar_url': 'user%d@stringshare.ca.png' % (i % 50),
+        'bio': 'Lorem ipsum dolor sit amet.',
+        'content': 'Aenean lectus. Pellentesque eget nunc. Donec quis orci eget orci vehicula condimentum.',
+        'date_posted': now - datetime.timedelta(minutes=i),
+        'image_url': str(uuid.uuid4()) + '.jpg',
+        'latitude': 43.9448 + i / 10000,
+        'longitude': -78.8917 - i / 10000,
+        'comments': i % 17,
+        'likes': i % 31,
+        'liked': i % 2 == 0,
+    } for i in range(count)]
+
+
+# Default FastAPI path: validate every row into the response model, encode, then dump with the stdlib encoder
+def pydantic_path(rows):
+    validated = [models.PostOut(**row) for row in rows]
+    return json.dumps(jsonable_encoder(validated)).encode('utf-8')
+
+
+# Fast path: copy the model's fields out of each row and dump straight to bytes with orjson
+def record_path(rows):
+    return responses.dump_records(rows, models.PostOut)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rows = make_rows(count)
+
+    # Making sure both paths produce the same document before timing them
+    assert json.loads(pydantic_path(rows)) == json.loads(record_path(rows))
+
+    for name, path in (('pydantic + json', pydantic_path), ('orjson records', record_path)):
+        seconds = min(timeit.repeat(lambda: path(rows), number=repeats, repeat=3)) / repeats
+        print('{:<16} {:>8.3f} ms per response ({} posts)'.format(name, seconds * 1000, count))
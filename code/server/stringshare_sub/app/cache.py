@@ -0,0 +1,38 @@
+# Importing necessary modules
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+# Bounded in-memory cache evicting the least recently used entry once it holds 'maxsize' entries
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key: Hashable):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    # Function to get an entry, marking it as recently used
+    def get(self, key: Hashable, default: Any = None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    # Function to add or replace an entry, evicting the oldest ones if the cache is full
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    # Function to remove an entry, returning it if it was present
+    def pop(self, key: Hashable, default: Any = None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,64 @@
+# Importing necessary modules and components
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Iterable
+from uuid import UUID
+from sqlalchemy import literal
+from sqlalchemy.sql import select, insert, delete, func
+from database import database
+from constants import SYNC_RETENTION_DAYS
+import tables
+
+logger = logging.getLogger(__name__)
+
+# Kinds of changes recorded in the 'post_changes' table
+POST = 'post'
+COUNTERS = 'counters'
+DELETED = 'deleted'
+
+
+# Function to build the statement logging a change for each of the given posts, resolving their authors in SQL
+def record_query(post_ids: Iterable[UUID], kind: str):
+    return insert(tables.post_changes).from_select(
+        ['post_id', 'username', 'kind'],
+        select([
+            tables.posts.c.post_id,
+            tables.posts.c.username,
+            literal(kind, tables.post_changes.c.kind.type)
+        ]).where(tables.posts.c.post_id.in_(list(post_ids)))
+    )
+
+
+# Function to build the statement logging that a user's followed accounts changed, so their feed sync starts over
+def follow_query(username: str):
+    return insert(tables.follow_changes).values(username=username)
+
+
+# Asynchronous function to log a change for each of the given posts
+async def record(post_ids: Iterable[UUID], kind: str):
+    post_ids = list(post_ids)
+    if post_ids:
+        await database.execute(record_query(post_ids, kind))
+
+
+# Asynchronous function deleting changes older than the retention period (clients further behind get a reset). The
+# newest post change is kept so that the oldest one left always tells how far back the log goes.
+async def prune():
+    cutoff = func.now() - timedelta(days=SYNC_RETENTION_DAYS)
+    newest = select([func.max(tables.post_changes.c.change_id)]).scalar_subquery()
+    await database.execute(delete(tables.post_changes).where(
+        tables.post_changes.c.created < cutoff,
+        tables.post_changes.c.change_id < newest
+    ))
+    await database.execute(delete(tables.follow_changes).where(tables.follow_changes.c.created < cutoff))
+
+
+# Background task pruning the change log every hour
+async def run_pruning():
+    while True:
+        try:
+            await prune()
+        except Exception:
+            logger.exception("failed to prune the post change log")
+        await asyncio.sleep(3600)
@@ -0,0 +1,275 @@
+# Importing necessary modules and components
+import asyncio
+import contextvars
+import logging
+import os
+import time
+import orjson
+import sqlalchemy
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+from constants import COMMUNITY, DB_URL, APP_ROOT, MEDIA_ROOT, DATA_ROOT, PUBLIC_URL, COMMUNITIES_FILE, \
+    COMMUNITY_IDLE_SECONDS, COMMUNITY_PATH_PREFIX
+import tables
+
+logger = logging.getLogger(__name__)
+
+# Community the current request (or background task) is for, the default community when unset
+_current = contextvars.ContextVar('community', default=None)
+
+# Functions run with a community as the current one when it is opened (connecting its database, starting its
+# background tasks) and when it is closed, in order
+_open_hooks = []
+_close_hooks = []
+
+
+def on_open(hook):
+    _open_hooks.append(hook)
+    return hook
+
+
+def on_close(hook):
+    _close_hooks.append(hook)
+    return hook
+
+
+# Functions telling whether a community has work in progress besides requests (e.g. jobs), run with it as the
+# current one; a busy community is not closed
+_busy_checks = []
+
+
+def on_busy_check(check):
+    _busy_checks.append(check)
+    return check
+
+
+# Function creating the tables of a community's database that do not exist yet
+def create_tables(db_url: str):
+    engine = sqlalchemy.create_engine(db_url, echo=False)
+    try:
+        tables.metadata.create_all(engine)
+    finally:
+        engine.dispose()
+
+
+# A community hosted by this process, with its own database, media root and per-community objects (connection
+# pool, caches, buffers), created on first use. Communities other than the default one are opened by their first
+# request and closed again once idle for COMMUNITY_IDLE_SECONDS, unless pinned.
+class Community:
+    def __init__(self, name: str, db_url: str, media_root: str, data_root: str, public_url: str,
+                 hosts=(), pinned: bool = False):
+        self.name = name
+        self.db_url = db_url
+        self.media_root = media_root
+        self.data_root = data_root
+        self.public_url = public_url
+        self.hosts = {host.lower() for host in hosts} | {name.lower()}
+        self.pinned = pinned
+        self.instances = {}
+        self.tasks = []
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.is_open = False
+        self._lock = None
+
+    # Function returning this community's instance of a per-community object, creating it on first use
+    def instance(self, key, factory):
+        value = self.instances.get(key)
+        if value is None:
+            value = self.instances[key] = factory(self)
+        return value
+
+    # Function starting a background task of this community, cancelled when it is closed
+    def start_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    # Asynchronous function running hooks with this community as the current one (tasks they start keep it)
+    async def _run(self, hooks):
+        token = _current.set(self)
+        try:
+            for hook in hooks:
+                await hook()
+        finally:
+            _current.reset(token)
+
+    # Asynchronous function opening the community if it is not open yet: creating its tables and running the
+    # open hooks
+    async def open(self):
+        if self.is_open:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.is_open:
+                return
+            await asyncio.get_running_loop().run_in_executor(None, create_tables, self.db_url)
+            try:
+                await self._run(_open_hooks)
+            except Exception:
+                await self._cleanup()
+                raise
+            self.is_open = True
+            self.last_used = time.monotonic()
+            logger.info("opened community %s", self.name)
+
+    # Asynchronous function closing the community: cancelling its background tasks, running the close hooks and
+    # dropping its per-community objects, so an idle community holds no connections and no memory
+    async def close(self):
+        if not self.is_open:
+            return
+        async with self._lock:
+            if not self.is_open:
+                return
+            self.is_open = False
+            await self._cleanup()
+            logger.info("closed community %s", self.name)
+
+    async def _cleanup(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for hook in _close_hooks:
+            try:
+                await self._run([hook])
+            except Exception:
+                logger.exception("failed to close community %s", self.name)
+        self.instances.clear()
+
+    # Functions counting the requests using the community, which is not closed while any is running
+    async def acquire(self):
+        await self.open()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.last_used = time.monotonic()
+
+    # Function telling whether the community can be closed
+    def idle(self, now: float):
+        return (self.is_open and not self.pinned and self is not default and self.active == 0
+                and now - self.last_used >= COMMUNITY_IDLE_SECONDS and not self.busy())
+
+    # Function telling whether a busy check reports work in progress in the community
+    def busy(self):
+        token = _current.set(self)
+        try:
+            return any(check() for check in _busy_checks)
+        finally:
+            _current.reset(token)
+
+
+# Object standing for the current community's instance of a per-community object, e.g.
+#     activity_writer = communities.PerCommunity(lambda community: ActivityWriter())
+# so modules keep using one module-level name whatever community a request is for (its own attributes are
+# underscored so they never hide those of the objects it stands for, such as the get() of caches)
+class PerCommunity:
+    def __init__(self, factory):
+        self._factory = factory
+
+    def _resolve(self):
+        return current().instance(self, self._factory)
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __contains__(self, key):
+        return key in self._resolve()
+
+
+# Function loading the communities hosted beside the default one from COMMUNITIES_FILE, a JSON object of
+# name -> {"db_url", "media_root", "data_root", "public_url", "hosts", "pinned"} (only "db_url" is required)
+def load(path: str):
+    if not path:
+        return []
+    with open(path, 'rb') as file:
+        config = orjson.loads(file.read())
+    return [
+        Community(
+            name,
+            options['db_url'],
+            options.get('media_root', os.path.join(MEDIA_ROOT, name, '')),
+            options.get('data_root', os.path.join(APP_ROOT, 'data', name)),
+            options.get('public_url', 'https://' + name),
+            options.get('hosts', ()),
+            options.get('pinned', False)
+        )
+        for name, options in config.items() if name != COMMUNITY
+    ]
+
+
+# The community configured by COMMUNITY, DB_URL and MEDIA_ROOT (always open), and the others hosted with it
+default = Community(COMMUNITY, DB_URL, MEDIA_ROOT, DATA_ROOT, PUBLIC_URL, pinned=True)
+hosted = load(COMMUNITIES_FILE)
+_by_name = {community.name: community for community in [default] + hosted}
+_by_host = {host: community for community in hosted for host in community.hosts}
+
+
+# Function returning the current community
+def current():
+    return _current.get() or default
+
+
+# Function finding the community of a request, by a path prefix ('/c/<name>/...', returning the path without it)
+# or else by host name. Returns (None, path) for a path prefix naming no community; other hosts get the default.
+def resolve(host: str, path: str):
+    if path.startswith(COMMUNITY_PATH_PREFIX):
+        name, _, rest = path[len(COMMUNITY_PATH_PREFIX):].partition('/')
+        return _by_name.get(name), '/' + rest
+    return _by_host.get(host.split(':', 1)[0].lower(), default), path
+
+
+# Asynchronous generator passing on a response body, then releasing the community it was produced for
+async def _release_after(body, community: Community):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        community.release()
+
+
+# Middleware routing each request to its community: opening the community if needed, making it the current one
+# while the request is handled and stripping the path prefix it was selected by
+async def dispatch(request: Request, call_next):
+    community, path = resolve(request.headers.get('host', ''), request.url.path)
+    if community is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={'detail': 'unknown community'})
+    request.scope['path'] = path
+    await community.acquire()
+    token = _current.set(community)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        community.release()
+        raise
+    finally:
+        _current.reset(token)
+    response.body_iterator = _release_after(response.body_iterator, community)
+    return response
+
+
+# Asynchronous function opening the pinned communities (on startup)
+async def open_pinned():
+    for community in [default] + hosted:
+        if community.pinned:
+            await community.open()
+
+
+# Asynchronous function closing every community (on shutdown)
+async def close_all():
+    for community in hosted + [default]:
+        await community.close()
+
+
+# Background task closing the communities idle for COMMUNITY_IDLE_SECONDS
+async def run_eviction():
+    while True:
+        await asyncio.sleep(min(60, COMMUNITY_IDLE_SECONDS))
+        now = time.monotonic()
+        for community in hosted:
+            if community.idle(now):
+                try:
+                    await community.close()
+                except Exception:
+                    logger.exception("failed to close community %s", community.name)
@@ -13,12 +13,163 @@ DATA_ROOT = os.path.join(APP_ROOT, 'data', COMMUNITY)
 # Setting up database connection information using environment variables
 DB_USER = os.getenv('POSTGRES_USER')
 DB_KEY = urllib.parse.quote(os.getenv('POSTGRES_PASSWORD'))
-DB_SERVER = os.getenv('POSTGRES_SERVER')
+DB_SERVER = os.getenv('POSTGRES_SERVER', 'db')
 DB_PORT = os.getenv('POSTGRES_PORT')
 DB_DB = os.getenv('POSTGRES_DB')
 
 # Constructing the database URL using the obtained values
-DB_URL = "postgresql://{}:{}@db:{}/{}".format(DB_USER, DB_KEY, DB_PORT, DB_DB)
+DB_URL = "postgresql://{}:{}@{}:{}/{}".format(DB_USER, DB_KEY, DB_SERVER, DB_PORT, DB_DB)
 
 # Getting the value of the 'SECRET_KEY' environment variable
 SECRET_KEY = os.getenv('SECRET_KEY')
+
+# Conditional GET: users whose version stamps and followee lists are kept in memory for ETags, per community
+VERSION_CACHE_USERS = int(os.getenv('VERSION_CACHE_USERS', 100000))
+
+# Default and maximum number of items returned by paginated endpoints
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 20))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 100))
+
+# Number of posts whose newest comments are kept in memory, and how many comments are kept per post
+COMMENT_CACHE_POSTS = int(os.getenv('COMMENT_CACHE_POSTS', 1000))
+COMMENT_CACHE_DEPTH = int(os.getenv('COMMENT_CACHE_DEPTH', MAX_PAGE_SIZE))
+
+# Like buffering for hot posts: enabled flag, taps per second making a post hot, and flush interval in seconds
+LIKE_BUFFERING = os.getenv('LIKE_BUFFERING', 'false').lower() == 'true'
+LIKE_HOT_THRESHOLD = int(os.getenv('LIKE_HOT_THRESHOLD', 20))
+LIKE_FLUSH_INTERVAL = float(os.getenv('LIKE_FLUSH_INTERVAL', 0.05))
+
+# Background activity writer: seconds between batches, maximum events per INSERT, and queue bound
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', 0.005))
+ACTIVITY_BATCH_SIZE = int(os.getenv('ACTIVITY_BATCH_SIZE', 500))
+ACTIVITY_QUEUE_SIZE = int(os.getenv('ACTIVITY_QUEUE_SIZE', 10000))
+
+# Attempts at writing a batch of activity events before writing them one by one, and the delay before the first
+# retry in seconds (doubled after each attempt)
+ACTIVITY_MAX_ATTEMPTS = int(os.getenv('ACTIVITY_MAX_ATTEMPTS', 5))
+ACTIVITY_RETRY_DELAY = float(os.getenv('ACTIVITY_RETRY_DELAY', 0.5))
+
+# Public base URL of this server, used to give other communities absolute links to local media
+PUBLIC_URL = os.getenv('PUBLIC_URL', 'https://' + str(COMMUNITY))
+
+# Federation delivery: peer overrides ("community=url,..."), e.g. to point a community at a local stand-in server
+FEDERATION_PEERS = dict(
+    peer.split('=', 1) for peer in os.getenv('FEDERATION_PEERS', '').split(',') if '=' in peer
+)
+FEDERATION_SCHEME = os.getenv('FEDERATION_SCHEME', 'https')
+FEDERATION_KEY = os.getenv('FEDERATION_KEY')  # Shared key expected from (and sent to) other communities, if set
+FEDERATION_BATCH_SIZE = int(os.getenv('FEDERATION_BATCH_SIZE', 500))
+FEDERATION_BATCH_DELAY = float(os.getenv('FEDERATION_BATCH_DELAY', 0.2))
+FEDERATION_POLL_INTERVAL = float(os.getenv('FEDERATION_POLL_INTERVAL', 5))
+FEDERATION_MAX_ATTEMPTS = int(os.getenv('FEDERATION_MAX_ATTEMPTS', 10))
+FEDERATION_TIMEOUT = float(os.getenv('FEDERATION_TIMEOUT', 10))
+
+# Cache of users and media from other communities: profile cache size, freshness and stale-while-revalidate
+# windows in seconds, and the directory (within each community's media root), disk budget per community and
+# freshness of cached remote media
+REMOTE_PROFILE_CACHE_SIZE = int(os.getenv('REMOTE_PROFILE_CACHE_SIZE', 10000))
+REMOTE_PROFILE_TTL = float(os.getenv('REMOTE_PROFILE_TTL', 300))
+REMOTE_STALE_TTL = float(os.getenv('REMOTE_STALE_TTL', 86400))
+REMOTE_MEDIA_DIR = "remote/"
+REMOTE_MEDIA_MAX_BYTES = int(os.getenv('REMOTE_MEDIA_MAX_BYTES', 256 * 1024 * 1024))
+REMOTE_MEDIA_TTL = float(os.getenv('REMOTE_MEDIA_TTL', 86400))
+REMOTE_TIMEOUT = float(os.getenv('REMOTE_TIMEOUT', 5))
+
+# Admission control: default requests per second and burst per user and route, per-route overrides
+# ("path=rate:burst,..."), and the load at which requests are shed with 503
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 20))
+ADMISSION_BURST = float(os.getenv('ADMISSION_BURST', 40))
+ADMISSION_ROUTE_LIMITS = {
+    path: tuple(float(value) for value in limit.split(':'))
+    for path, limit in (
+        route.split('=', 1) for route in os.getenv(
+            'ADMISSION_ROUTE_LIMITS', '/client/like=5:10,/client/search=2:5'
+        ).split(',') if '=' in route
+    )
+}
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 200))
+ADMISSION_MAX_POOL_WAITERS = int(os.getenv('ADMISSION_MAX_POOL_WAITERS', 50))
+
+# Request logging: file, share of successful fast requests that are logged, and the duration (ms) counted as slow
+LOG_FILE = os.getenv('LOG_FILE', 'info.log')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+LOG_SLOW_MS = float(os.getenv('LOG_SLOW_MS', 500))
+
+# Debug mode: responses carry the number of database queries of the request and the time spent in them
+DEBUG = os.getenv('DEBUG', 'false').lower() in ('1', 'true', 'yes')
+
+# Optional read replicas (comma-separated database URLs), and how long a user's reads stay on the primary after
+# they write, so they always see their own writes despite replication lag
+DB_REPLICA_URLS = [url for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url]
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+
+# Feed sync: maximum changes returned per call, and how long the change log is kept
+SYNC_LIMIT = int(os.getenv('SYNC_LIMIT', 500))
+SYNC_RETENTION_DAYS = float(os.getenv('SYNC_RETENTION_DAYS', 7))
+
+# Media garbage collection: age (seconds) below which files are never swept, seconds between passes,
+# pause (seconds) between shards, and maximum files removed per second
+MEDIA_GC_GRACE_SECONDS = float(os.getenv('MEDIA_GC_GRACE_SECONDS', 3600))
+MEDIA_GC_INTERVAL = float(os.getenv('MEDIA_GC_INTERVAL', 6 * 3600))
+MEDIA_GC_SHARD_DELAY = float(os.getenv('MEDIA_GC_SHARD_DELAY', 0.05))
+MEDIA_GC_DELETE_RATE = float(os.getenv('MEDIA_GC_DELETE_RATE', 100))
+
+# Trending posts: length of the list, posts tracked in memory, half-life (seconds) of a like or comment,
+# weights of likes and comments, seconds between recomputations of the list and between checkpoints
+TRENDING_SIZE = int(os.getenv('TRENDING_SIZE', 50))
+TRENDING_CAPACITY = int(os.getenv('TRENDING_CAPACITY', 2000))
+TRENDING_HALF_LIFE = float(os.getenv('TRENDING_HALF_LIFE', 6 * 3600))
+TRENDING_LIKE_WEIGHT = float(os.getenv('TRENDING_LIKE_WEIGHT', 1))
+TRENDING_COMMENT_WEIGHT = float(os.getenv('TRENDING_COMMENT_WEIGHT', 3))
+TRENDING_REFRESH_SECONDS = float(os.getenv('TRENDING_REFRESH_SECONDS', 1))
+TRENDING_CHECKPOINT_INTERVAL = float(os.getenv('TRENDING_CHECKPOINT_INTERVAL', 300))
+
+# Follow suggestions: accounts suggested per user, users refreshed per chunk, followees counted when a user follows
+# someone, seconds between refreshes and pause (seconds) between chunks
+SUGGESTIONS_SIZE = int(os.getenv('SUGGESTIONS_SIZE', 20))
+SUGGESTIONS_CHUNK = int(os.getenv('SUGGESTIONS_CHUNK', 500))
+SUGGESTIONS_FANOUT = int(os.getenv('SUGGESTIONS_FANOUT', 200))
+SUGGESTIONS_INTERVAL = float(os.getenv('SUGGESTIONS_INTERVAL', 6 * 3600))
+SUGGESTIONS_CHUNK_DELAY = float(os.getenv('SUGGESTIONS_CHUNK_DELAY', 0.5))
+
+# Map clusters: deepest zoom level aggregated, grid cells per map tile side as a power of two (2 -> 4x4 cells),
+# and maximum clusters returned per request
+MAP_MAX_ZOOM = int(os.getenv('MAP_MAX_ZOOM', 20))
+MAP_CELL_BITS = int(os.getenv('MAP_CELL_BITS', 2))
+MAP_MAX_CLUSTERS = int(os.getenv('MAP_MAX_CLUSTERS', 500))
+
+# Bulk user provisioning: key required by the admin routes (they are disabled when unset), users inserted per
+# transaction, processes hashing passwords, and concurrent avatar requests
+ADMIN_KEY = os.getenv('ADMIN_KEY')
+PROVISION_BATCH_SIZE = int(os.getenv('PROVISION_BATCH_SIZE', 200))
+PROVISION_WORKERS = int(os.getenv('PROVISION_WORKERS', os.cpu_count() or 1))
+PROVISION_AVATAR_CONCURRENCY = int(os.getenv('PROVISION_AVATAR_CONCURRENCY', 16))
+
+# Activity partitioning: whether the activity table is partitioned by month, how many months of partitions are
+# created ahead, and how many days of activity are kept (older partitions are detached; 0 keeps everything)
+ACTIVITY_PARTITIONING = os.getenv('ACTIVITY_PARTITIONING', 'false').lower() in ('1', 'true', 'yes')
+ACTIVITY_PARTITIONS_AHEAD = int(os.getenv('ACTIVITY_PARTITIONS_AHEAD', 2))
+ACTIVITY_RETENTION_DAYS = int(os.getenv('ACTIVITY_RETENTION_DAYS', 0))
+
+# Account export: exports running at once (others get 503) and bytes of records or media read per chunk
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', 2))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 64 * 1024))
+
+# Communities hosted beside COMMUNITY by this process: JSON file describing them (see communities.py), seconds
+# after which an idle community is closed, and the path prefix selecting a community ('/c/<community>/...')
+COMMUNITIES_FILE = os.getenv('COMMUNITIES_FILE')
+COMMUNITY_IDLE_SECONDS = float(os.getenv('COMMUNITY_IDLE_SECONDS', 600))
+COMMUNITY_PATH_PREFIX = os.getenv('COMMUNITY_PATH_PREFIX', '/c/')
+
+# Maintenance jobs: rows per chunk, jobs running at once, pause between chunks, pause while the connection pool is
+# saturated, seconds between checks for new jobs, and seconds after which a running job without progress is resumed
+JOB_CHUNK_SIZE = int(os.getenv('JOB_CHUNK_SIZE', 100))
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', 1))
+JOB_CHUNK_DELAY = float(os.getenv('JOB_CHUNK_DELAY', 0.1))
+JOB_BACKOFF_SECONDS = float(os.getenv('JOB_BACKOFF_SECONDS', 1))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 5))
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 300))
+
+# Post hydration: unchanging parts of posts and authors kept in memory
+HYDRATION_POST_CACHE_SIZE = int(os.getenv('HYDRATION_POST_CACHE_SIZE', 50000))
+HYDRATION_AUTHOR_CACHE_SIZE = int(os.getenv('HYDRATION_AUTHOR_CACHE_SIZE', 10000))
@@ -1,18 +1,79 @@
 # Importing necessary modules for working with databases and SQLAlchemy
-import databases
-import sqlalchemy
-
-# Importing the metadata object from the 'tables' module
-from tables import metadata
+import contextlib
+import contextvars
+import itertools
+import time
 
 # Importing constants module to access database URL
 import constants
 
-# Creating a databases.Database instance with the specified database URL
-database = databases.Database(constants.DB_URL)
+# Importing the LRU cache used to remember recent writers
+from cache import LRUCache
+
+# Importing the database class counting the queries of each request
+from querystats import CountingDatabase
+
+# Importing the communities hosted by this process, each with its own database
+import communities
+
+# The databases.Database instance (connection pool) of the current community, created from its database URL
+database = communities.PerCommunity(lambda community: CountingDatabase(community.db_url))
+
+# Creating databases.Database instances for the optional read replicas
+replicas = [CountingDatabase(url) for url in constants.DB_REPLICA_URLS]
+_next_replica = itertools.cycle(replicas)
+
+# Users who wrote recently (username -> time of the write), whose reads stay on the primary
+_recent_writers = LRUCache(100000)
+
+# Whether the reads of the current request have to see every committed write (see primary_reads)
+_primary_reads = contextvars.ContextVar('primary_reads', default=False)
+
+
+# Function to remember that a user just wrote, so they read their own writes from the primary for a while
+def mark_write(*usernames: str):
+    now = time.monotonic()
+    for username in usernames:
+        if username:
+            _recent_writers.set(username, now)
+
+
+# Context manager sending the reads made in its block to the primary. Responses tagged with the version stamps of
+# versions.py are read there: a lagging replica would otherwise answer with content older than the stamp, which the
+# client would then keep under that ETag (getting 304s) until the next write.
+@contextlib.contextmanager
+def primary_reads():
+    token = _primary_reads.set(True)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+# Function returning the database to run a read-only query on for a user: a replica (round robin) unless there
+# are none, the reads have to be on the primary (primary_reads) or the user wrote within the last
+# READ_YOUR_WRITES_SECONDS (only the default community has replicas)
+def read_database(username: str = None):
+    if not replicas or _primary_reads.get() or communities.current() is not communities.default:
+        return database
+    if username is not None:
+        written = _recent_writers.get(username)
+        if written is not None and time.monotonic() - written < constants.READ_YOUR_WRITES_SECONDS:
+            return database
+    return next(_next_replica)
+
+
+# Asynchronous functions connecting and disconnecting the current community's database, and the replicas
+# for the default community
+async def connect():
+    await database.connect()
+    if communities.current() is communities.default:
+        for replica in replicas:
+            await replica.connect()
 
-# Creating a SQLAlchemy engine instance with the specified database URL
-engine = sqlalchemy.create_engine(constants.DB_URL, echo=False)
 
-# Creating database tables based on the defined metadata
-metadata.create_all(engine)
+async def disconnect():
+    if communities.current() is communities.default:
+        for replica in replicas:
+            await replica.disconnect()
+    await database.disconnect()
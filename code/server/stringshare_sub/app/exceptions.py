@@ -14,6 +14,12 @@ API_401_CREDENTIALS_EXCEPTION = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},    # Custom headers for the exception response
 )
 
+# Creating a custom HTTPException instance for a 403 Forbidden scenario when federation is not configured
+API_403_FEDERATION_DISABLED_EXCEPTION = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,  # HTTP status code for Forbidden
+    detail="federation is not configured",  # Custom detail message for the exception
+)
+
 # Creating a custom HTTPException instance for a 404 Not Found scenario
 API_404_NOT_FOUND_EXCEPTION = HTTPException(
     status_code=404,          # HTTP status code for Not Found
@@ -31,3 +37,10 @@ API_500_SIGNATURE_EXCEPTION = HTTPException(
     status_code=500,           # HTTP status code for Internal Server Error
     detail="server error",     # Custom detail message for the exception
 )
+
+# Creating a custom HTTPException instance for a 503 Service Unavailable scenario when too many exports are running
+API_503_EXPORT_BUSY_EXCEPTION = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,  # HTTP status code for Service Unavailable
+    detail="too many exports running, try again later",  # Custom detail message for the exception
+    headers={"Retry-After": "30"},  # Custom headers for the exception response
+)
@@ -0,0 +1,139 @@
+# Importing necessary modules and components
+import io
+import zipfile
+import aiofiles
+import orjson
+from fastapi import HTTPException
+from sqlalchemy.sql import select, union
+from database import read_database
+from constants import EXPORT_CHUNK_SIZE, EXPORT_CONCURRENCY
+import models
+import storage
+import tables
+
+# Number of exports running, each holding a database connection for its whole duration
+_running = 0
+
+
+# Write-only file collecting what the zip writer outputs until it is drained. It cannot seek, so entries are
+# written with their sizes after the data and nothing has to be kept to rewrite headers.
+class _Output(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# Function taking one of the EXPORT_CONCURRENCY export slots without waiting, telling whether one was free (checking
+# and taking it in one step, so concurrent requests cannot both take the last one). The export stream releases it.
+def acquire():
+    global _running
+    if _running >= EXPORT_CONCURRENCY:
+        return False
+    _running += 1
+    return True
+
+
+def release():
+    global _running
+    _running -= 1
+
+
+# Function building the queries of the records exported for a user, as (file name, query)
+def queries(user: models.User):
+    username = user.username
+    return [
+        ('profile.ndjson', select([tables.users]).where(tables.users.c.username == username)),
+        ('posts.ndjson', select([
+            tables.posts,
+            tables.post_locations.c.latitude,
+            tables.post_locations.c.longitude
+        ]).select_from(
+            tables.posts.outerjoin(tables.post_locations, tables.post_locations.c.post_id == tables.posts.c.post_id)
+        ).where(tables.posts.c.username == username).order_by(tables.posts.c.date_posted)),
+        ('images.ndjson', select([tables.post_images]).select_from(
+            tables.post_images.join(tables.posts, tables.posts.c.post_id == tables.post_images.c.post_id)
+        ).where(tables.posts.c.username == username)),
+        ('comments.ndjson', select([tables.comments]).where(tables.comments.c.username == username)
+         .order_by(tables.comments.c.date_posted)),
+        ('likes.ndjson', select([tables.likes]).where(tables.likes.c.username == username)),
+        ('following.ndjson', select([tables.following.c.following]).where(tables.following.c.user == username)),
+        ('followers.ndjson', select([tables.followers.c.follower]).where(tables.followers.c.user == username)),
+        ('activity.ndjson', select([tables.activity]).where(tables.activity.c.user == username)
+         .order_by(tables.activity.c.datetime)),
+    ]
+
+
+# Function building the query of the media files of a user: their avatar and the images of their posts
+def media_query(user: models.User):
+    return union(
+        select([tables.users.c.avatar_url.label('url')]).where(tables.users.c.username == user.username),
+        select([tables.post_images.c.image_url]).select_from(
+            tables.post_images.join(tables.posts, tables.posts.c.post_id == tables.post_images.c.post_id)
+        ).where(tables.posts.c.username == user.username)
+    )
+
+
+# Asynchronous generator of a zip archive of a user's data: one JSON lines file per kind of record, read through
+# server-side cursors, and their media files under 'media/', read in chunks. Only one chunk of records or of a file
+# is held in memory at a time. The records are read from one snapshot of the database. It releases the slot taken
+# by acquire() when it ends or is closed; its first chunk is empty, so the caller can start it right away (a started
+# generator is closed even if the response is never sent).
+async def stream(user: models.User):
+    try:
+        yield b''
+        db = read_database(user.username)
+        output = _Output()
+        async with db.transaction(isolation='repeatable_read', readonly=True):
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for name, query in queries(user):
+                    keys = [str(column.key) for column in query.selected_columns]
+                    with archive.open(name, 'w', force_zip64=True) as entry:
+                        lines = []
+                        size = 0
+                        async for row in db.iterate(query):
+                            line = orjson.dumps({key: row[key] for key in keys}, default=str) + b'\n'
+                            lines.append(line)
+                            size += len(line)
+                            if size >= EXPORT_CHUNK_SIZE:
+                                entry.write(b''.join(lines))
+                                lines.clear()
+                                size = 0
+                                yield output.drain()
+                        entry.write(b''.join(lines))
+                    yield output.drain()
+
+                # Images are already compressed, so they are stored as they are
+                async for row in db.iterate(media_query(user)):
+                    try:
+                        path = storage.media_store.path(row['url'] or '')
+                    except HTTPException:
+                        # Missing files and media of other communities are left out
+                        continue
+                    info = zipfile.ZipInfo('media/' + row['url'].lstrip('/'))
+                    async with aiofiles.open(path, 'rb') as file:
+                        with archive.open(info, 'w', force_zip64=True) as entry:
+                            while True:
+                                chunk = await file.read(EXPORT_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                entry.write(chunk)
+                                yield output.drain()
+        yield output.drain()
+    finally:
+        release()
@@ -0,0 +1,221 @@
+# Importing necessary modules and components
+import asyncio
+import hmac
+import logging
+import random
+import urllib.parse
+from datetime import timedelta
+from typing import Dict, List, Optional
+import aiohttp
+from fastapi import Header
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.sql import select, delete, update, distinct, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from database import database
+from constants import FEDERATION_PEERS, FEDERATION_SCHEME, FEDERATION_KEY, \
+    FEDERATION_BATCH_SIZE, FEDERATION_BATCH_DELAY, FEDERATION_POLL_INTERVAL, FEDERATION_MAX_ATTEMPTS, \
+    FEDERATION_TIMEOUT
+import communities
+import hydration
+import tables
+import models
+import exceptions
+
+logger = logging.getLogger(__name__)
+
+# Kinds of events exchanged between communities, matching the fields of models.ServerBatch
+FOLLOW = 'follows'
+LIKE = 'likes'
+COMMENT = 'comments'
+
+
+# Function to get the community a username belongs to (the part after '@')
+def community_of(username: str):
+    return username.rsplit('@', 1)[1] if '@' in username else communities.current().name
+
+
+# Function to tell whether a username belongs to another community than the current one
+def is_remote(username: str):
+    return community_of(username) != communities.current().name
+
+
+# Function to get the base URL of a community's server, honouring FEDERATION_PEERS overrides (e.g. a local stand-in)
+def peer_url(community: str):
+    return FEDERATION_PEERS.get(community, "{}://{}".format(FEDERATION_SCHEME, community)).rstrip('/')
+
+
+# Function to build the absolute URL of a media file of the current community, as seen from other communities
+def public_media_url(url: str):
+    if url is None or '://' in url:
+        return url
+    return "{}/client/media/?url={}".format(communities.current().public_url.rstrip('/'), urllib.parse.quote(url))
+
+
+# Dependency checking the shared federation key on inbound /server requests, which are refused when no
+# FEDERATION_KEY is configured
+async def verify_peer(x_federation_key: Optional[str] = Header(None)):
+    if not FEDERATION_KEY:
+        raise exceptions.API_403_FEDERATION_DISABLED_EXCEPTION
+    if not hmac.compare_digest(x_federation_key or '', FEDERATION_KEY):
+        raise exceptions.API_401_CREDENTIALS_EXCEPTION
+
+
+# Asynchronous function to build the ServerUser describing a local user to other communities
+async def server_user(username: str):
+    user = await database.fetch_one(tables.users.select().where(tables.users.c.username == username))
+    if user is None or is_remote(username):
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+    return models.ServerUser(
+        username=user['username'],
+        full_name=user['full_name'],
+        avatar_url=public_media_url(user['avatar_url']) or '',
+        bio=user['bio'] or ''
+    )
+
+
+# Asynchronous function to insert or refresh the local copy of a user from another community
+async def upsert_remote_user(user: models.ServerUser):
+    # Usernames are stored in lower case, like local ones; local users are never overwritten by other communities
+    user.username = user.username.lower()
+    if not is_remote(user.username):
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    query = pg_insert(tables.users).values(
+        username=user.username,
+        full_name=user.full_name,
+        avatar_url=user.avatar_url,
+        bio=user.bio
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[tables.users.c.username],
+        set_={'full_name': query.excluded.full_name, 'avatar_url': query.excluded.avatar_url, 'bio': query.excluded.bio}
+    )
+    await database.execute(query)
+    hydration.forget_authors(user.username)
+
+
+# Asynchronous function to make sure a remote user referenced locally exists in the users table
+async def ensure_remote_user(username: str):
+    query = pg_insert(tables.users).values(username=username, full_name=username).on_conflict_do_nothing()
+    await database.execute(query)
+
+
+# Outbound delivery queue. Events are persisted in the 'federation_outbox' table so they survive restarts,
+# and a background task sends all due events of a destination in one request over a pooled keep-alive session.
+class DeliveryQueue:
+    def __init__(self, batch_size: int = FEDERATION_BATCH_SIZE, batch_delay: float = FEDERATION_BATCH_DELAY,
+                 poll_interval: float = FEDERATION_POLL_INTERVAL, max_attempts: int = FEDERATION_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._session = None
+        self._wakeup = None
+        self._task = None
+
+    # Asynchronous function to persist an event for a destination community and wake the sender
+    async def enqueue(self, destination: str, kind: str, event):
+        query = tables.federation_outbox.insert().values(
+            destination=destination,
+            kind=kind,
+            payload=jsonable_encoder(event)
+        )
+        await database.execute(query)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # Asynchronous function to send one batch of events to a destination, returning whether it was accepted
+    async def send(self, destination: str, events: List):
+        batch = {FOLLOW: [], LIKE: [], COMMENT: []}
+        for event in events:
+            batch[event['kind']].append(event['payload'])
+        headers = {'X-Federation-Key': FEDERATION_KEY} if FEDERATION_KEY else {}
+        try:
+            async with self._session.post(peer_url(destination) + '/server/batch', json=batch, headers=headers) as response:
+                if response.status < 300:
+                    return True
+                logger.warning("community %s rejected %d events: status %d", destination, len(events), response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("could not reach community %s: %s", destination, e)
+        return False
+
+    # Asynchronous function to deliver one batch of due events to every destination, one request per destination
+    async def deliver(self):
+        due = tables.federation_outbox.c.next_attempt <= func.now()
+        query = select([distinct(tables.federation_outbox.c.destination)]).where(due)
+        events: Dict[str, List] = {}
+        for row in await database.fetch_all(query):
+            query = tables.federation_outbox.select().where(
+                due, tables.federation_outbox.c.destination == row['destination']
+            ).order_by(tables.federation_outbox.c.event_id).limit(self.batch_size)
+            events[row['destination']] = await database.fetch_all(query)
+
+        results = await asyncio.gather(*[self.send(destination, rows) for destination, rows in events.items()])
+
+        for rows, delivered in zip(events.values(), results):
+            ids = [row['event_id'] for row in rows]
+            if delivered:
+                await database.execute(delete(tables.federation_outbox).where(tables.federation_outbox.c.event_id.in_(ids)))
+                continue
+
+            # Retrying with exponential backoff and jitter, giving up after max_attempts
+            attempts = rows[0]['attempts'] + 1
+            if attempts >= self.max_attempts:
+                logger.error("dropping %d events for community %s after %d attempts", len(ids), rows[0]['destination'], attempts)
+                await database.execute(delete(tables.federation_outbox).where(tables.federation_outbox.c.event_id.in_(ids)))
+                continue
+            backoff = min(2 ** attempts, 3600) * random.uniform(0.5, 1.5)
+            await database.execute(update(tables.federation_outbox).where(
+                tables.federation_outbox.c.event_id.in_(ids)
+            ).values(attempts=attempts, next_attempt=func.now() + timedelta(seconds=backoff)))
+
+        # Returning whether a destination may still have more due events than fit in one batch
+        return any(len(rows) >= self.batch_size for rows in events.values())
+
+    # Background task waiting for new events (or the next retry), then delivering them in batches
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                # Letting more events gather so a burst becomes one request per destination
+                await asyncio.sleep(self.batch_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await self.deliver():
+                    pass
+            except Exception:
+                logger.exception("failed to deliver federation events")
+
+    def start(self):
+        if self._task is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=4, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=FEDERATION_TIMEOUT)
+            )
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    # Asynchronous function to stop the sender; undelivered events stay in the outbox for the next start
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self._session.close()
+        self._task = None
+        self._session = None
+        self._wakeup = None
+
+
+# Queue of the current community, shared by the write methods
+delivery_queue = communities.PerCommunity(lambda community: DeliveryQueue())
+
+
+# Asynchronous function to let a remote user's community know that a local user followed them
+async def deliver_follow(username: str, user: models.User):
+    event = models.ServerFollowUser(username=username, user=await server_user(user.username))
+    await delivery_queue.enqueue(community_of(username), FOLLOW, event)
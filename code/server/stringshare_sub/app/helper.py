@@ -1,146 +1,245 @@
 # Importing necessary modules and components
+import asyncio
 import os.path
-from sqlalchemy.sql import delete, select, insert, update
+from sqlalchemy import and_, literal, tuple_
+from sqlalchemy.sql import delete, select, insert, update, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from database import database
-from constants import DATA_ROOT, COMMUNITY
+from constants import JOB_CHUNK_SIZE, PROVISION_AVATAR_CONCURRENCY
+import communities
+import hydration
 import tables
-import auth
+import maps
 import methods
 import models
+import provisioning
+import suggestions
+import trending
+import versions
+
+# Tables emptied by a reset, children first ('map_cells' before 'post_locations', so the trigger taking deleted
+# locations out of the cells finds nothing to do)
+RESET_TABLES = [
+    'activity', 'user_stats', 'post_images', 'map_cells', 'post_locations', 'likes', 'comments', 'posts',
+    'post_changes', 'follow_changes', 'trending_scores', 'follow_suggestions', 'following', 'followers',
+    'user_credentials', 'users'
+]
+
+# Files of initial data under the community's data root, parents first
+RESET_FILES = [
+    'users', 'user_credentials', 'followers', 'following', 'posts', 'comments', 'likes', 'post_locations',
+    'post_images', 'activity'
+]
+
+
+# Function building the statements deleting all data and loading the initial data from SQL files
+def reset_statements():
+    statements = [delete(tables.metadata.tables[name]) for name in RESET_TABLES]
+    for name in RESET_FILES:
+        with open(os.path.join(communities.current().data_root, name + ".sql"), 'r') as file:
+            statements.append(file.read())
+
+    # Restarting every user's feed sync, since the watermarks they hold refer to the deleted data
+    statements.append(insert(tables.follow_changes).from_select(['username'], select([tables.users.c.username])))
+    return statements
+
+
+# Asynchronous function rebuilding the data derived from the loaded data and invalidating the caches
+async def rebuild_derived():
+    # Rebuilding the follow counters, suggestions and map clusters from the loaded data
+    await rebuild_user_stats()
+    await suggestions.refresh()
+    await maps.rebuild()
+
+    # Invalidating every ETag issued before the reset
+    versions.reset()
+    methods.comment_cache.clear()
+    trending.tracker.clear()
+    hydration.clear()
+
 
 # Asynchronous function to reset the entire database to its initial state
 async def reset_database():
     print("Resetting database...")
+    async with database.transaction():
+        for statement in reset_statements():
+            await database.execute(statement)
+    await rebuild_derived()
+    print("Database Reset Complete")
 
-    # Deleting all data from various tables
-    await database.execute(delete(tables.activity))
-    await database.execute(delete(tables.post_images))
-    await database.execute(delete(tables.post_locations))
-    await database.execute(delete(tables.likes))
-    await database.execute(delete(tables.comments))
-    await database.execute(delete(tables.posts))
-    await database.execute(delete(tables.following))
-    await database.execute(delete(tables.followers))
-    await database.execute(delete(tables.user_credentials))
-    await database.execute(delete(tables.users))
-
-# Loading initial data from SQL files to populate all the tables
-    with open(os.path.join(DATA_ROOT, "users.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "user_credentials.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "followers.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "following.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "posts.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "comments.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "likes.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "post_locations.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "post_images.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
-
-    with open(os.path.join(DATA_ROOT, "activity.sql"), 'r') as file:
-        user_commands = file.read()
-        await database.execute(user_commands)
 
-    print("Database Reset Complete")
+# Job step resetting the database: deleting and loading the data in one transaction, then rebuilding the rest
+async def reset_database_step(cursor: dict):
+    if cursor.get('phase', 'load') == 'load':
+        return {'phase': 'rebuild'}, len(RESET_FILES), reset_statements()
+    await rebuild_derived()
+    return None, 0, []
 
 
 # Asynchronous function to print environment variable and constant values
 async def helper():
     print(os.getenv('PORT'))
-    print(COMMUNITY)
-
-# Asynchronous function to fix the 'followers' table based on the 'following' table
-async def fix_followers():
-    await database.execute(delete(tables.followers))
-    query = select([tables.following])
-    following = await database.fetch_all(query)
-    for pair in following:
-        await database.execute(insert(tables.followers).values(
-            user=pair.following,
-            follower=pair.user
-        ))
-
-# Asynchronous function to populate the 'activity' table based on other tables
-async def populate_activity():
-    # Populating 'activity' table with 'like' actions
-    likes_query = select([tables.likes])
-    likes = await database.fetch_all(likes_query)
-    for like in likes:
-        author = await methods.get_post_author(like.post_id)
-        query = insert(tables.activity).values(
-            user=author.username,
-            action_user=like.username,
-            action=models.ActivityAction.like,
-            post_id=like.post_id
-        )
-        await database.execute(query)
-
-    # Populating 'activity' table with 'comment' actions
-    comments_query = select([tables.likes])
-    comments = await database.fetch_all(comments_query)
-    for comment in comments:
-        author = await methods.get_post_author(comment.post_id)
-        query = insert(tables.activity).values(
-            user=author.username,
-            action_user=comment.username,
-            action=models.ActivityAction.comment,
-            post_id=comment.post_id
-        )
-        await database.execute(query)
-
-    # Populating 'activity' table with 'follow' actions
-    query = select([tables.followers])
-    followers = await database.fetch_all(query)
-    for pair in followers:
-        await database.execute(insert(tables.activity).values(
-            user=pair.user,
-            action_user=pair.follower,
-            action=models.ActivityAction.follow
-        ))
-
-# Asynchronous function to update user passwords
-async def update_password():
-    q = select([tables.users])
-    users = await database.fetch_all(q)
-    for user in users:
-        salt = auth.gen_salt()
-        query = ((
-            update(tables.user_credentials)
-            .where(tables.user_credentials.c.username == user.username)
-        ).values(
-            hashed_password=auth.get_password_hash("a" + salt),
+    print(communities.current().name)
+
+# Asynchronous function to rebuild the 'user_stats' follow counters from the 'followers' and 'following' tables
+async def rebuild_user_stats():
+    followers = select([
+        tables.followers.c.user,
+        func.count().label('followers')
+    ]).group_by(tables.followers.c.user).subquery()
+
+    following = select([
+        tables.following.c.user,
+        func.count().label('following')
+    ]).group_by(tables.following.c.user).subquery()
+
+    counts = select([
+        tables.users.c.username,
+        func.coalesce(followers.c.followers, 0),
+        func.coalesce(following.c.following, 0)
+    ]).select_from(
+        tables.users
+        .outerjoin(followers, followers.c.user == tables.users.c.username)
+        .outerjoin(following, following.c.user == tables.users.c.username)
+    )
+
+    async with database.transaction():
+        await database.execute(delete(tables.user_stats))
+        await database.execute(insert(tables.user_stats).from_select(['username', 'followers', 'following'], counts))
+
+
+# Asynchronous function to build the follow counters on first start after the 'user_stats' table was added
+async def ensure_user_stats():
+    existing = await database.fetch_one(select([tables.user_stats.c.username]).limit(1))
+    if existing is None:
+        await rebuild_user_stats()
+
+# Job steps: each one processes a chunk of rows after the cursor returned by the previous chunk (an empty dict at
+# first) and returns the next cursor (None when done), the number of rows processed and the statements writing the
+# chunk, which the job runner executes in one transaction with the job's progress (see jobs.py)
+
+# Function building the condition selecting the keys after 'after' (None for the first chunk) up to 'last'
+def key_range(columns, after, last=None):
+    key = tuple_(*columns)
+    conditions = []
+    if after is not None:
+        conditions.append(key > tuple_(*[literal(value, column.type) for column, value in zip(columns, after)]))
+    if last is not None:
+        conditions.append(key <= tuple_(*[literal(value, column.type) for column, value in zip(columns, last)]))
+    return and_(*conditions)
+
+
+# Asynchronous function reading the next chunk of rows of a table in key order, returning them and the last key
+async def next_chunk(columns, key_columns, after):
+    query = select(columns).order_by(*key_columns).limit(JOB_CHUNK_SIZE)
+    if after is not None:
+        query = query.where(key_range(key_columns, after))
+    rows = await database.fetch_all(query)
+    last = [str(rows[-1][column.key]) for column in key_columns] if rows else None
+    return rows, last
+
+
+# Sources of the 'activity' table: (phase, key columns, columns inserted, query of the activity of a key range)
+def _activity_sources():
+    return [
+        ('likes', [tables.likes.c.post_id, tables.likes.c.username], ['user', 'action_user', 'action', 'post_id'],
+         lambda condition: select([
+             tables.posts.c.username,
+             tables.likes.c.username,
+             literal(models.ActivityAction.like, tables.activity.c.action.type),
+             tables.likes.c.post_id
+         ]).select_from(
+             tables.likes.join(tables.posts, tables.posts.c.post_id == tables.likes.c.post_id)
+         ).where(condition)),
+        ('comments', [tables.comments.c.comment_id], ['user', 'action_user', 'action', 'post_id'],
+         lambda condition: select([
+             tables.posts.c.username,
+             tables.comments.c.username,
+             literal(models.ActivityAction.comment, tables.activity.c.action.type),
+             tables.comments.c.post_id
+         ]).select_from(
+             tables.comments.join(tables.posts, tables.posts.c.post_id == tables.comments.c.post_id)
+         ).where(condition)),
+        ('follows', [tables.followers.c.user, tables.followers.c.follower], ['user', 'action_user', 'action'],
+         lambda condition: select([
+             tables.followers.c.user,
+             tables.followers.c.follower,
+             literal(models.ActivityAction.follow, tables.activity.c.action.type)
+         ]).where(condition)),
+    ]
+
+
+# Job step populating the 'activity' table from the likes, comments and follows, one range of keys at a time
+async def populate_activity(cursor: dict):
+    sources = _activity_sources()
+    phases = [phase for phase, _, _, _ in sources]
+    index = phases.index(cursor.get('phase', phases[0]))
+    _, key_columns, columns, activity_query = sources[index]
+    after = cursor.get('after')
+    keys, last = await next_chunk(key_columns, key_columns, after)
+    if not keys:
+        if index + 1 == len(sources):
+            return None, 0, []
+        return {'phase': phases[index + 1]}, 0, []
+    statement = insert(tables.activity).from_select(columns, activity_query(key_range(key_columns, after, last)))
+    return {'phase': phases[index], 'after': last}, len(keys), [statement]
+
+
+# Job step resetting user passwords to "a" (for development), hashing them across the process pool
+async def update_password(cursor: dict):
+    users, last = await next_chunk([tables.users.c.username], [tables.users.c.username], cursor.get('after'))
+    if not users:
+        return None, 0, []
+    loop = asyncio.get_running_loop()
+    hashes = await asyncio.gather(*[
+        loop.run_in_executor(provisioning.pool(), provisioning.hash_password, "a") for _ in users
+    ])
+    statements = [
+        update(tables.user_credentials).where(tables.user_credentials.c.username == user['username']).values(
+            hashed_password=hashed_password,
             salt=salt,
             disabled=False
-        ))
-        await database.execute(query)
-
-# Asynchronous function to create avatars for all users
-async def create_avatars():
-    q = select([tables.users])
-    users = await database.fetch_all(q)
-    for user in users:
-        await methods.create_avatar(user)
\ No newline at end of file
+        )
+        for user, (salt, hashed_password) in zip(users, hashes)
+    ]
+    return {'after': last}, len(users), statements
+
+
+# Job step creating new avatars for users (keeping the current one when the avatar service fails)
+async def create_avatars(cursor: dict):
+    users, last = await next_chunk([tables.users.c.username, tables.users.c.full_name], [tables.users.c.username],
+                                   cursor.get('after'))
+    if not users:
+        return None, 0, []
+    semaphore = asyncio.Semaphore(PROVISION_AVATAR_CONCURRENCY)
+    urls = await asyncio.gather(*[provisioning.fetch_avatar(user['full_name'], semaphore) for user in users])
+    statements = [
+        update(tables.users).where(tables.users.c.username == user['username']).values(avatar_url=url)
+        for user, url in zip(users, urls) if url is not None
+    ]
+    # Forgetting the cached authors and the users' page versions once the new avatars are committed (before, a read
+    # could cache the old ones again)
+    usernames = [user['username'] for user in users]
+    return ({'after': last}, len(users), statements, lambda: versions.bump(*usernames),
+            lambda: hydration.forget_authors(*usernames))
+
+
+# Job step rebuilding the 'followers' table from the 'following' table, then the follow counters
+async def fix_followers(cursor: dict):
+    phase = cursor.get('phase', 'clear')
+    if phase == 'clear':
+        return {'phase': 'copy'}, 0, [delete(tables.followers)]
+    if phase == 'stats':
+        await rebuild_user_stats()
+        return None, 0, []
+    key_columns = [tables.following.c.user, tables.following.c.following]
+    keys, last = await next_chunk(key_columns, key_columns, cursor.get('after'))
+    if not keys:
+        return {'phase': 'stats'}, 0, []
+    # Skipping the rows a concurrent follow already added since the table was cleared
+    statement = pg_insert(tables.followers).from_select(
+        ['user', 'follower'],
+        select([tables.following.c.following, tables.following.c.user]).where(
+            key_range(key_columns, cursor.get('after'), last))
+    ).on_conflict_do_nothing()
+    return {'phase': 'copy', 'after': last}, len(keys), [statement]
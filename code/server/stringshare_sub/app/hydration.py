@@ -0,0 +1,198 @@
+# Importing necessary modules and components
+import asyncio
+import contextlib
+import contextvars
+from sqlalchemy import and_
+from sqlalchemy.sql import select, exists, func
+from database import database, read_database
+from constants import HYDRATION_POST_CACHE_SIZE, HYDRATION_AUTHOR_CACHE_SIZE
+import cache
+import communities
+import tables
+
+# Fields of a post that never change (its row, first image and location) and fields of its author
+POST_FIELDS = ('post_id', 'username', 'content', 'date_posted', 'image_url', 'latitude', 'longitude')
+AUTHOR_FIELDS = ('full_name', 'avatar_url', 'bio')
+
+# Caches of the unchanging parts of posts (post_id -> fields) and of authors (username -> fields), which are
+# forgotten when a user changes their profile
+post_cache = communities.PerCommunity(lambda community: cache.LRUCache(HYDRATION_POST_CACHE_SIZE))
+author_cache = communities.PerCommunity(lambda community: cache.LRUCache(HYDRATION_AUTHOR_CACHE_SIZE))
+
+# Number of times cached authors were forgotten, so a hydration that read authors before one of those changes does
+# not cache them afterwards
+_forgotten = 0
+
+# Loaders of the current request (viewer username -> PostLoader), so a post is hydrated once per request
+_loaders = contextvars.ContextVar('post_loaders', default=None)
+
+
+# Context manager giving the requests handled in its block their own loaders
+@contextlib.contextmanager
+def scope():
+    token = _loaders.set({})
+    try:
+        yield
+    finally:
+        _loaders.reset(token)
+
+
+# Function to forget the cached fields of users who changed their name, avatar or bio
+def forget_authors(*usernames: str):
+    global _forgotten
+    _forgotten += 1
+    for username in usernames:
+        author_cache.pop(username)
+
+
+# Function to forget every cached post and author (e.g. after a database reset)
+def clear():
+    global _forgotten
+    _forgotten += 1
+    post_cache.clear()
+    author_cache.clear()
+
+
+# Function building the query hydrating posts for a viewer: their counters and 'liked' flag, along with the
+# unchanging fields and the author's when 'full' (correlated subqueries, so only the requested posts are counted)
+def posts_query(post_ids: list, username: str, full: bool = True):
+    columns = [
+        tables.posts.c.post_id,
+        tables.posts.c.username,
+        select([func.count()]).where(
+            tables.comments.c.post_id == tables.posts.c.post_id).scalar_subquery().label('comments'),
+        select([func.count()]).where(
+            tables.likes.c.post_id == tables.posts.c.post_id).scalar_subquery().label('likes'),
+        exists().where(and_(
+            tables.likes.c.post_id == tables.posts.c.post_id,
+            tables.likes.c.username == username
+        )).label('liked')
+    ]
+    source = tables.posts
+    if full:
+        columns += [
+            tables.posts.c.content,
+            tables.posts.c.date_posted,
+            select([tables.post_images.c.image_url]).where(
+                tables.post_images.c.post_id == tables.posts.c.post_id
+            ).order_by(tables.post_images.c.image_url).limit(1).scalar_subquery().label('image_url'),
+            tables.post_locations.c.latitude,
+            tables.post_locations.c.longitude,
+            tables.users.c.full_name,
+            tables.users.c.avatar_url,
+            tables.users.c.bio
+        ]
+        source = source.join(tables.users, tables.users.c.username == tables.posts.c.username).outerjoin(
+            tables.post_locations, tables.post_locations.c.post_id == tables.posts.c.post_id)
+    return select(columns).select_from(source).where(tables.posts.c.post_id.in_(post_ids))
+
+
+# Asynchronous function hydrating posts by id for a viewer in one query, returning post_id -> post for the posts
+# that exist. Counters and the 'liked' flag are always read; the other fields only when a post or its author is
+# not cached. The cached parts are taken before the query (the caches may lose them meanwhile). Authors are only
+# cached when read from the primary with no author forgotten meanwhile, so a lagging replica or a read overtaken by
+# a profile change cannot cache outdated names or avatars (posts never change, so they are always cached).
+async def hydrate(post_ids: list, username: str):
+    cached = {post_id: post_cache.get(post_id) for post_id in post_ids}
+    authors = {post['username']: author_cache.get(post['username']) for post in cached.values() if post is not None}
+    full = any(post is None or authors[post['username']] is None for post in cached.values())
+
+    db = read_database(username)
+    forgotten = _forgotten
+    rows = await db.fetch_all(posts_query(post_ids, username, full))
+    cache_authors = db is database and forgotten == _forgotten
+    hydrated = {}
+    for row in rows:
+        post_id = str(row['post_id'])
+        if full:
+            post = {field: row[field] for field in POST_FIELDS}
+            author = {field: row[field] for field in AUTHOR_FIELDS}
+            post_cache.set(post_id, post)
+            if cache_authors:
+                author_cache.set(post['username'], author)
+        else:
+            post = cached[post_id]
+            author = authors[post['username']]
+        hydrated[post_id] = {**post, **author, 'comments': row['comments'], 'likes': row['likes'],
+                             'liked': row['liked']}
+    return hydrated
+
+
+# Asynchronous function returning the fields of authors by username (username -> fields, leaving out users who do
+# not exist), reading those that are not cached in one query, which are cached by the same rules as in hydrate
+async def authors(usernames: list):
+    found = {username: author_cache.get(username) for username in set(usernames)}
+    missing = [username for username, author in found.items() if author is None]
+    if missing:
+        db = read_database()
+        forgotten = _forgotten
+        query = select([tables.users.c.username] + [tables.users.c[field] for field in AUTHOR_FIELDS]).where(
+            tables.users.c.username.in_(missing))
+        rows = await db.fetch_all(query)
+        cache_authors = db is database and forgotten == _forgotten
+        for row in rows:
+            author = found[row['username']] = {field: row[field] for field in AUTHOR_FIELDS}
+            if cache_authors:
+                author_cache.set(row['username'], author)
+    return {username: author for username, author in found.items() if author is not None}
+
+
+# DataLoader of posts for one viewer: the posts requested while the event loop runs other tasks are hydrated
+# together in one batch, and every post is hydrated once (the results are memoized for the loader's lifetime)
+class PostLoader:
+    def __init__(self, username: str):
+        self.username = username
+        self._futures = {}
+        self._queue = []
+        self._tasks = set()
+
+    # Function returning the future of a post (its hydrated dict, or None if it does not exist)
+    def load(self, post_id):
+        key = str(post_id)
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # Waiting one more turn of the event loop, so the tasks started along with this one (e.g. by
+                # asyncio.gather) can add their posts to the batch
+                loop.call_soon(loop.call_soon, self._dispatch)
+        return future
+
+    # Asynchronous function to get posts in the order of their ids, leaving out those that do not exist
+    async def load_many(self, post_ids: list):
+        posts = await asyncio.gather(*[asyncio.shield(self.load(post_id)) for post_id in post_ids])
+        return [post for post in posts if post is not None]
+
+    def _dispatch(self):
+        keys, self._queue = self._queue, []
+        task = asyncio.ensure_future(self._fetch(keys))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, keys: list):
+        try:
+            posts = await hydrate(keys, self.username)
+        except Exception as e:
+            # Failed posts are hydrated again by the next load
+            for key in keys:
+                future = self._futures.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key in keys:
+            future = self._futures[key]
+            if not future.done():
+                future.set_result(posts.get(key))
+
+
+# Function returning the loader of the current request for a viewer (a new one outside of requests)
+def loader(username: str):
+    loaders = _loaders.get()
+    if loaders is None:
+        return PostLoader(username)
+    post_loader = loaders.get(username)
+    if post_loader is None:
+        post_loader = loaders[username] = PostLoader(username)
+    return post_loader
@@ -0,0 +1,222 @@
+# Importing necessary modules and components
+import asyncio
+import logging
+import time
+import uuid
+from datetime import timedelta
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import select, insert, update, func
+from database import database
+from constants import JOB_CONCURRENCY, JOB_CHUNK_DELAY, JOB_BACKOFF_SECONDS, JOB_POLL_INTERVAL, JOB_STALE_SECONDS
+import admission
+import communities
+import exceptions
+import helper
+import tables
+
+logger = logging.getLogger(__name__)
+
+# Routines that can run as jobs: kind -> step processing one chunk (see helper.py). A step returns the next cursor
+# (None when done), the number of rows processed and the statements to run in the chunk's transaction, optionally
+# followed by functions to call once that transaction is committed (e.g. invalidating caches)
+KINDS = {
+    'reset_database': helper.reset_database_step,
+    'populate_activity': helper.populate_activity,
+    'fix_followers': helper.fix_followers,
+    'update_password': helper.update_password,
+    'create_avatars': helper.create_avatars,
+}
+
+# States of jobs that are not finished
+PENDING = ('queued', 'running')
+
+
+# Raised inside a chunk's transaction when the job was cancelled meanwhile, to roll the chunk back
+class Cancelled(Exception):
+    pass
+
+
+# Runner executing queued jobs chunk by chunk, each chunk and the job's progress in one transaction, so a job
+# resumes where it stopped after a restart. At most 'concurrency' jobs run at once, and chunks wait while the
+# connection pool is saturated so maintenance work yields to requests. A runner only updates the jobs it claimed
+# (marked with its 'owner' token) and keeps refreshing them while they run, so no other runner takes one over as
+# stale while it waits for the pool or runs a long step.
+class JobRunner:
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, chunk_delay: float = JOB_CHUNK_DELAY,
+                 backoff: float = JOB_BACKOFF_SECONDS, poll_interval: float = JOB_POLL_INTERVAL,
+                 stale_seconds: float = JOB_STALE_SECONDS):
+        self.concurrency = concurrency
+        self.chunk_delay = chunk_delay
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.owner = uuid.uuid4().hex
+        self._running = {}
+        self._backlog = False
+        self._wakeup = None
+        self._task = None
+
+    # Asynchronous function to queue a job, returning the unfinished job of the same kind if there is one
+    async def enqueue(self, kind: str):
+        if kind not in KINDS:
+            raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+        existing = await database.fetch_one(select([tables.jobs]).where(
+            tables.jobs.c.kind == kind,
+            tables.jobs.c.state.in_(PENDING)
+        ).order_by(tables.jobs.c.job_id).limit(1))
+        if existing is not None:
+            return existing
+        job = await database.fetch_one(insert(tables.jobs).values(
+            kind=kind, state='queued', cursor={}
+        ).returning(*tables.jobs.c))
+        self._backlog = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    # Asynchronous function to cancel an unfinished job; its current chunk is rolled back
+    async def cancel(self, job_id: int):
+        job = await database.fetch_one(update(tables.jobs).where(
+            tables.jobs.c.job_id == job_id,
+            tables.jobs.c.state.in_(PENDING)
+        ).values(state='cancelled', updated=func.now()).returning(*tables.jobs.c))
+        return job if job is not None else await get(job_id)
+
+    # Asynchronous function claiming the oldest queued job, or a running one that made no progress for
+    # 'stale_seconds' (its process stopped), skipping the jobs claimed by other processes meanwhile
+    async def claim(self):
+        candidate = select([tables.jobs.c.job_id]).where(
+            or_(
+                tables.jobs.c.state == 'queued',
+                and_(tables.jobs.c.state == 'running',
+                     tables.jobs.c.updated < func.now() - timedelta(seconds=self.stale_seconds))
+            ),
+            tables.jobs.c.job_id.notin_(list(self._running))
+        ).order_by(tables.jobs.c.job_id).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+        return await database.fetch_one(update(tables.jobs).where(
+            tables.jobs.c.job_id == candidate
+        ).values(state='running', owner=self.owner, updated=func.now()).returning(*tables.jobs.c))
+
+    # Function telling whether jobs are running or may be waiting to run
+    def busy(self):
+        return bool(self._running) or self._backlog
+
+    # Asynchronous function refreshing the 'updated' time of a job every third of 'stale_seconds' while it runs
+    async def heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(self.stale_seconds / 3)
+            try:
+                await database.execute(update(tables.jobs).where(
+                    tables.jobs.c.job_id == job_id,
+                    tables.jobs.c.owner == self.owner,
+                    tables.jobs.c.state == 'running'
+                ).values(updated=func.now()))
+            except Exception:
+                logger.exception("failed to refresh job %s", job_id)
+
+    # Asynchronous function running a job's chunks until it is done, cancelled (or taken over) or fails
+    async def execute(self, job):
+        job_id = job['job_id']
+        cursor = job['cursor']
+        step = KINDS[job['kind']]
+        heartbeat = asyncio.create_task(self.heartbeat(job_id))
+        try:
+            while cursor is not None:
+                while admission.pool_saturated():
+                    await asyncio.sleep(self.backoff)
+                cursor, processed, statements, *after_commit = await step(cursor)
+                async with database.transaction():
+                    for statement in statements:
+                        await database.execute(statement)
+                    saved = await database.fetch_val(update(tables.jobs).where(
+                        tables.jobs.c.job_id == job_id,
+                        tables.jobs.c.owner == self.owner,
+                        tables.jobs.c.state == 'running'
+                    ).values(
+                        cursor=cursor if cursor is not None else {},
+                        done=tables.jobs.c.done + processed,
+                        state='running' if cursor is not None else 'done',
+                        updated=func.now()
+                    ).returning(tables.jobs.c.job_id))
+                    if saved is None:
+                        raise Cancelled()
+                for callback in after_commit:
+                    callback()
+                await asyncio.sleep(self.chunk_delay)
+            logger.info("job %s (%s) done", job_id, job['kind'])
+        except Cancelled:
+            logger.info("job %s (%s) cancelled or taken over", job_id, job['kind'])
+        except Exception as e:
+            logger.exception("job %s (%s) failed", job_id, job['kind'])
+            await database.execute(update(tables.jobs).where(
+                tables.jobs.c.job_id == job_id,
+                tables.jobs.c.owner == self.owner,
+                tables.jobs.c.state == 'running'
+            ).values(state='failed', error=str(e)[:1000], updated=func.now()))
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+            # The community stays open for COMMUNITY_IDLE_SECONDS after its last job, as after its last request
+            communities.current().last_used = time.monotonic()
+            self._wakeup.set()
+
+    # Background task starting jobs while fewer than 'concurrency' are running
+    async def run(self):
+        while True:
+            try:
+                # Jobs may be waiting until a claim finds none
+                self._backlog = True
+                while len(self._running) < self.concurrency:
+                    job = await self.claim()
+                    if job is None:
+                        self._backlog = False
+                        break
+                    self._running[job['job_id']] = asyncio.create_task(self.execute(job))
+            except Exception:
+                logger.exception("failed to start jobs")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    # Asynchronous function to stop the runner; interrupted jobs stay 'running' and are resumed from their last
+    # chunk by the next start
+    async def stop(self):
+        if self._task is None:
+            return
+        tasks = [self._task] + list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running.clear()
+        self._task = None
+        self._wakeup = None
+
+
+# Runner of the current community
+runner = communities.PerCommunity(lambda community: JobRunner())
+
+
+# Keeping a community open while its jobs run or wait to run
+@communities.on_busy_check
+def busy():
+    return runner.busy()
+
+
+# Asynchronous function to get a job
+async def get(job_id: int):
+    job = await database.fetch_one(select([tables.jobs]).where(tables.jobs.c.job_id == job_id))
+    if job is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+    return job
+
+
+# Asynchronous function to get the most recent jobs
+async def recent(limit: int = 50):
+    return await database.fetch_all(select([tables.jobs]).order_by(tables.jobs.c.job_id.desc()).limit(limit))
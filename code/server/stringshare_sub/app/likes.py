@@ -0,0 +1,195 @@
+# Importing necessary modules and components
+import asyncio
+import logging
+import time
+from typing import Dict
+from uuid import UUID
+import asyncpg
+from sqlalchemy import and_, literal, tuple_
+from sqlalchemy.sql import select, delete, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from database import database
+from constants import LIKE_FLUSH_INTERVAL, LIKE_HOT_THRESHOLD
+import activity
+import communities
+import changes
+import trending
+import tables
+import models
+import versions
+
+logger = logging.getLogger(__name__)
+
+
+# Function building the condition matching a user's like on a post
+def like_condition(post_id: UUID, username: str):
+    return and_(tables.likes.c.post_id == post_id, tables.likes.c.username == username)
+
+
+# Function to build a single statement toggling a like, logging the change of the post's counters for feed sync,
+# and returning the new state along with the post's author
+def toggle_query(post_id: UUID, username: str):
+    # Removing the like if it exists
+    deleted = delete(tables.likes).where(
+        like_condition(post_id, username)
+    ).returning(tables.likes.c.post_id).cte('deleted')
+
+    # Adding the like if nothing was removed (ON CONFLICT makes concurrent double taps harmless)
+    inserted = pg_insert(tables.likes).from_select(
+        ['post_id', 'username'],
+        select([
+            literal(post_id, tables.likes.c.post_id.type),
+            literal(username, tables.users.c.username.type)
+        ]).where(~exists(select([deleted.c.post_id])))
+    ).on_conflict_do_nothing().returning(tables.likes.c.post_id).cte('inserted')
+
+    # Logging the change, which also yields the author (nothing when the post does not exist)
+    logged = changes.record_query([post_id], changes.COUNTERS).returning(
+        tables.post_changes.c.username).cte('logged')
+    author = select([logged.c.username]).scalar_subquery()
+
+    return select([
+        exists(select([inserted.c.post_id])).label('liked'),
+        author.label('author')
+    ])
+
+
+# Buffer coalescing like toggles on hot posts in memory and writing them to the database in batches
+class LikeBuffer:
+    def __init__(self, interval: float = LIKE_FLUSH_INTERVAL, hot_threshold: int = LIKE_HOT_THRESHOLD):
+        self.interval = interval
+        self.hot_threshold = hot_threshold
+        # Desired like state per post and user, waiting to be written / being written
+        self._pending: Dict[UUID, Dict[str, bool]] = {}
+        self._flushing: Dict[UUID, Dict[str, bool]] = {}
+        # Taps per post within the current second: post_id -> (second, count)
+        self._rates: Dict[UUID, tuple] = {}
+        self._task = None
+
+    # Function to count a tap on a post and tell whether the post is currently hot
+    def is_hot(self, post_id: UUID):
+        second = int(time.monotonic())
+        window, count = self._rates.get(post_id, (second, 0))
+        count = count + 1 if window == second else 1
+        self._rates[post_id] = (second, count)
+        return count >= self.hot_threshold
+
+    # Function to tell whether a post has like changes that are not written yet
+    def has_pending(self, post_id: UUID):
+        return post_id in self._pending or post_id in self._flushing
+
+    # Function returning the latest known like state of a user on a post, if it is still buffered
+    def _buffered_state(self, post_id: UUID, username: str):
+        for buffer in (self._pending, self._flushing):
+            state = buffer.get(post_id, {}).get(username)
+            if state is not None:
+                return state
+        return None
+
+    # Asynchronous function to toggle a like through the buffer, returning the new state (None when the post does
+    # not exist, which is not buffered)
+    async def toggle(self, post_id: UUID, username: str):
+        current = self._buffered_state(post_id, username)
+        if current is None:
+            query = select([
+                exists().where(tables.posts.c.post_id == post_id).label('post'),
+                exists().where(like_condition(post_id, username)).label('liked')
+            ])
+            row = await database.fetch_one(query)
+            if not row['post']:
+                return None
+            current = bool(row['liked'])
+            # Another tap may have been buffered while the state was being read
+            buffered = self._buffered_state(post_id, username)
+            if buffered is not None:
+                current = buffered
+        self._pending.setdefault(post_id, {})[username] = not current
+        return not current
+
+    # Asynchronous function writing all buffered like changes and queueing their activity events
+    async def flush(self):
+        # Forgetting the tap rates of posts that cooled down
+        second = int(time.monotonic())
+        self._rates = {post_id: rate for post_id, rate in self._rates.items() if rate[0] >= second - 1}
+
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        self._flushing = batch
+        added = [(post_id, username) for post_id, users in batch.items() for username, liked in users.items() if liked]
+        removed = [(post_id, username) for post_id, users in batch.items() for username, liked in users.items() if not liked]
+        inserted = []
+        try:
+            async with database.transaction():
+                if added:
+                    # Only inserting the likes whose post and user still exist (e.g. a post deleted since the tap)
+                    pairs = tuple_(tables.posts.c.post_id, tables.users.c.username).in_(added)
+                    inserted = await database.fetch_all(pg_insert(tables.likes).from_select(
+                        ['post_id', 'username'],
+                        select([tables.posts.c.post_id, tables.users.c.username]).select_from(
+                            tables.posts.join(tables.users, pairs)
+                        ).where(and_(
+                            tables.posts.c.post_id.in_(list(batch.keys())),
+                            tables.users.c.username.in_(list({username for _, username in added}))
+                        ))
+                    ).on_conflict_do_nothing().returning(tables.likes.c.post_id, tables.likes.c.username))
+                if removed:
+                    await database.execute(delete(tables.likes).where(
+                        tuple_(tables.likes.c.post_id, tables.likes.c.username).in_(removed)
+                    ))
+                await database.execute(changes.record_query(batch.keys(), changes.COUNTERS))
+        except asyncpg.exceptions.IntegrityConstraintViolationError:
+            # Retrying would fail the same way and hold back the taps buffered since, so the batch is dropped
+            logger.exception("dropped %d buffered like changes", len(added) + len(removed))
+            return
+        except Exception:
+            # Putting the batch back, without overriding taps buffered since, so the next flush retries it
+            for post_id, users in batch.items():
+                self._pending[post_id] = {**users, **self._pending.get(post_id, {})}
+            raise
+        finally:
+            self._flushing = {}
+
+        # Invalidating the likers' cached pages, and the authors' pages for removed likes (the activity writer
+        # resolves the authors of added likes in bulk and bumps theirs)
+        versions.bump(*{username for _, username in added + removed})
+        # Only the likes actually written are scored and get activity events
+        added = [(row['post_id'], row['username']) for row in inserted]
+        for post_id, username in added:
+            trending.tracker.like(post_id, username, True)
+        for post_id, username in removed:
+            trending.tracker.like(post_id, username, False)
+        if removed:
+            query = select([tables.posts.c.username]).where(
+                tables.posts.c.post_id.in_(list({post_id for post_id, _ in removed})))
+            versions.bump(*{row.username for row in await database.fetch_all(query)})
+        for post_id, username in added:
+            await activity.activity_writer.log(None, username, models.ActivityAction.like, post_id)
+
+    # Background task flushing the buffer every 'interval' seconds
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("failed to flush buffered likes")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    # Asynchronous function stopping the background task and writing what is left in the buffer
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# Buffer of the current community, shared by the like endpoint
+like_buffer = communities.PerCommunity(lambda community: LikeBuffer())
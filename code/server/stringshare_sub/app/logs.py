@@ -0,0 +1,83 @@
+# Importing necessary modules and components
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import orjson
+from constants import LOG_FILE, LOG_SAMPLE_RATE, LOG_SLOW_MS
+
+# Request ids: a per-process prefix and a counter, much cheaper than drawing random characters per request
+_prefix = os.urandom(3).hex()
+_counter = itertools.count(1)
+
+# Listener writing queued records to the log file from a background thread
+_listener = None
+
+
+# Formatter writing each record as one JSON line, including the structured fields passed in 'extra'
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord):
+        line = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        line.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            line['exc_info'] = self.formatException(record.exc_info)
+        return orjson.dumps(line, default=str).decode()
+
+
+# Function routing the root logger through a queue, so the event loop never waits on disk writes
+def setup(level: int = logging.INFO):
+    global _listener
+    if _listener is not None:
+        return
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(JSONFormatter())
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    _listener.start()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+
+# Function flushing the queued records and stopping the background writer
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# Function returning a new request id
+def request_id():
+    return "{}-{:x}".format(_prefix, next(_counter))
+
+
+# Function telling whether a completed request should be logged: errors and slow requests always are,
+# other requests only for a sample of LOG_SAMPLE_RATE
+def should_log(status_code: int, duration_ms: float):
+    return status_code >= 500 or duration_ms >= LOG_SLOW_MS or random.random() < LOG_SAMPLE_RATE
+
+
+# Function logging a completed request as one structured line
+def log_request(logger: logging.Logger, rid: str, method: str, path: str, status_code: int, start: float,
+                queries: int = None, query_ms: float = None):
+    duration_ms = (time.perf_counter() - start) * 1000
+    if should_log(status_code, duration_ms):
+        level = logging.ERROR if status_code >= 500 else logging.WARNING if duration_ms >= LOG_SLOW_MS else logging.INFO
+        logger.log(level, "request completed", extra={'fields': {
+            'rid': rid,
+            'method': method,
+            'path': path,
+            'status_code': status_code,
+            'duration_ms': round(duration_ms, 2),
+            'queries': queries,
+            'query_ms': query_ms,
+        }})
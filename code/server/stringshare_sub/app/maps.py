@@ -0,0 +1,108 @@
+# Importing necessary modules and components
+import math
+from uuid import UUID
+from sqlalchemy import Integer, literal, cast
+from sqlalchemy.sql import select, insert, delete, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert, array_agg, aggregate_order_by
+from database import database
+from constants import MAP_MAX_ZOOM, MAP_CELL_BITS
+import tables
+
+# Latitude limit of the Web Mercator projection used by map tiles
+MAX_LATITUDE = 85.0511
+
+
+# Function to get the number of grid cells along each axis at a zoom level (2^MAP_CELL_BITS cells per map tile)
+def cells_per_axis(zoom: int):
+    return 2 ** (zoom + MAP_CELL_BITS)
+
+
+# Function to get the grid cell (x, y) of a point at a zoom level, like map tiles (y grows southwards)
+def cell(latitude: float, longitude: float, zoom: int):
+    n = cells_per_axis(zoom)
+    latitude = math.radians(max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE))
+    x = int((longitude + 180) / 360 * n)
+    y = int((1 - math.log(math.tan(latitude) + 1 / math.cos(latitude)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+# Function building the SQL expressions of the same grid cell, so cells can be computed in bulk by the database
+def cell_columns(latitude, longitude, zoom):
+    n = func.power(2, zoom + MAP_CELL_BITS)
+    latitude = func.radians(func.greatest(func.least(latitude, MAX_LATITUDE), -MAX_LATITUDE))
+    x = func.floor((longitude + 180) / 360 * n)
+    y = func.floor((1 - func.ln(func.tan(latitude) + 1 / func.cos(latitude)) / func.pi()) / 2 * n)
+    return (
+        cast(func.least(func.greatest(x, 0), n - 1), Integer).label('cell_x'),
+        cast(func.least(func.greatest(y, 0), n - 1), Integer).label('cell_y')
+    )
+
+
+# Function to build the statement adding a post's location to its cell at every zoom level
+def record_query(post_id: UUID, latitude: float, longitude: float):
+    zoom = func.generate_series(0, MAP_MAX_ZOOM).column_valued('zoom')
+    latitude = literal(latitude, tables.post_locations.c.latitude.type)
+    longitude = literal(longitude, tables.post_locations.c.longitude.type)
+    query = pg_insert(tables.map_cells).from_select(
+        ['zoom', 'cell_x', 'cell_y', 'count', 'latitude_sum', 'longitude_sum', 'post_id'],
+        select([
+            zoom,
+            *cell_columns(latitude, longitude, zoom),
+            literal(1),
+            latitude,
+            longitude,
+            literal(post_id, tables.posts.c.post_id.type)
+        ])
+    )
+    # The newest post of a cell represents it
+    return query.on_conflict_do_update(
+        index_elements=[tables.map_cells.c.zoom, tables.map_cells.c.cell_x, tables.map_cells.c.cell_y],
+        set_={
+            'count': tables.map_cells.c.count + 1,
+            'latitude_sum': tables.map_cells.c.latitude_sum + query.excluded.latitude_sum,
+            'longitude_sum': tables.map_cells.c.longitude_sum + query.excluded.longitude_sum,
+            'post_id': query.excluded.post_id
+        }
+    )
+
+
+# Asynchronous function to rebuild every cell from the 'post_locations' table (e.g. after a database reset)
+async def rebuild():
+    # Computing the cell of every location at every zoom level, then aggregating the locations of each cell
+    zoom = func.generate_series(0, MAP_MAX_ZOOM).column_valued('zoom')
+    located = select([
+        zoom,
+        *cell_columns(tables.post_locations.c.latitude, tables.post_locations.c.longitude, zoom),
+        tables.post_locations.c.latitude,
+        tables.post_locations.c.longitude,
+        tables.posts.c.post_id,
+        tables.posts.c.date_posted
+    ]).select_from(
+        tables.post_locations
+        .join(tables.posts, tables.posts.c.post_id == tables.post_locations.c.post_id)
+    ).where(
+        tables.post_locations.c.latitude.isnot(None),
+        tables.post_locations.c.longitude.isnot(None)
+    ).subquery()
+
+    cells = select([
+        located.c.zoom,
+        located.c.cell_x,
+        located.c.cell_y,
+        func.count(),
+        func.sum(located.c.latitude),
+        func.sum(located.c.longitude),
+        array_agg(aggregate_order_by(located.c.post_id, located.c.date_posted.desc()))[1]
+    ]).group_by(located.c.zoom, located.c.cell_x, located.c.cell_y)
+
+    async with database.transaction():
+        await database.execute(delete(tables.map_cells))
+        await database.execute(insert(tables.map_cells).from_select(
+            ['zoom', 'cell_x', 'cell_y', 'count', 'latitude_sum', 'longitude_sum', 'post_id'], cells))
+
+
+# Asynchronous function to build the cells on first start after the 'map_cells' table was added
+async def ensure():
+    existing = await database.fetch_one(select([tables.map_cells.c.zoom]).limit(1))
+    if existing is None:
+        await rebuild()
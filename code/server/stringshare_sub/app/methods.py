@@ -1,24 +1,52 @@
 # Importing necessary modules and components
 from uuid import UUID
 from fastapi import UploadFile
-from sqlalchemy.sql import select, insert, update, or_, delete
+from sqlalchemy.sql import select, insert, update, or_, and_, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy import func
-from database import database
-from constants import MEDIA_ROOT, COMMUNITY
+from database import database, read_database, mark_write
+from constants import PAGE_SIZE, COMMENT_CACHE_POSTS, COMMENT_CACHE_DEPTH, LIKE_BUFFERING, \
+    SYNC_LIMIT, TRENDING_COMMENT_WEIGHT, MAP_MAX_ZOOM, MAP_MAX_CLUSTERS, \
+    ACTIVITY_RETENTION_DAYS
+from datetime import timedelta
+import asyncio
+import logging
 import os.path
+import activity
 import auth
+import cache
+import changes
+import communities
 import tables
-import aiofiles
 import requests
 import exceptions
+import federation
+import hydration
+import likes
+import maps
 import models
+import pagination
+import storage
+import suggestions
+import trending
+import remote
+import responses
+import versions
+
+logger = logging.getLogger(__name__)
+
+# Function to get the full username of a local user: adding the current community's suffix if not present,
+# in lower case
+def local_username(username: str):
+    community = communities.current().name
+    if "@" + community not in username:
+        username = username + "@" + community
+    return username.lower()
 
 # Asynchronous function to create a new user
 async def create_user(user: models.UserIn):
     # Adding community suffix to the username if not present
-    if "@" + COMMUNITY not in user.username:
-        user.username = user.username + "@" + COMMUNITY
-    user.username = user.username.lower()
+    user.username = local_username(user.username)
 
     # Checking if the username already exists
     query = tables.users.select().where(tables.users.c.username == user.username)
@@ -49,11 +77,14 @@ async def create_user(user: models.UserIn):
                 )
                 await database.execute(query)
 
-            except Exception as e:
-                print(e)
+            except Exception:
+                logger.exception("failed to create user %s", user.username)
                 # Uncomment the line below if you want to rollback in case of an exception
                 # await database.rollback()
 
+        # Reading the new user (e.g. when logging in right after signing up) from the primary for a while
+        mark_write(user.username)
+
 # Asynchronous function to create an avatar for a user
 async def create_avatar(user: models.User):
     # Parameters for the avatar creation API
@@ -65,17 +96,13 @@ async def create_avatar(user: models.User):
     # Requesting an avatar image from the API
     avatar = requests.get('https://ui-avatars.com/api/', params=params)
 
-    # Writing the avatar image to a file
-    async with aiofiles.open(os.path.join(MEDIA_ROOT, (user.username + ".png")), "wb") as out_file:
-        await out_file.write(avatar.content)
-
-    # Returning the filename of the avatar
-    return user.username + ".png"
+    # Storing the avatar image and returning its URL
+    return await storage.media_store.save(avatar.content, ".png")
 
 # Asynchronous function to get user information by username
 async def get_user(username: str):
     query = tables.users.select().where(tables.users.c.username == username)
-    user = await database.fetch_one(query)
+    user = await read_database().fetch_one(query)
 
     if user:
         return user
@@ -83,83 +110,54 @@ async def get_user(username: str):
         raise exceptions.API_404_NOT_FOUND_EXCEPTION
 
 # Asynchronous function to get user profile information
-async def get_user_profile(username: str, user: models.User):
-    # Subqueries for counting followers and following
-    followers_subquery = select([
-        tables.followers.c.user,
-        func.count().label('followers')
-    ]).group_by(tables.followers.c.user).subquery()
-
-    following_subquery = select([
-        tables.following.c.user,
-        func.count().label('following')
-    ]).group_by(tables.following.c.user).subquery()
+async def get_user_profile(username: str, user: models.User, cursor: str = None, limit: int = PAGE_SIZE):
+    # Refreshing the local copy of users from other communities through the remote profile cache
+    if federation.is_remote(username):
+        try:
+            await remote.get_profile(username)
+        except Exception:
+            logger.exception("failed to refresh remote user %s", username)
 
-    # Query to retrieve user profile information
+    # Query to retrieve user profile information, with follower counts read from the maintained counters
     profile_query = select([
         tables.users,
-        func.coalesce(followers_subquery.c.followers, 0).label('followers'),
-        func.coalesce(following_subquery.c.following, 0).label('following')
+        func.coalesce(tables.user_stats.c.followers, 0).label('followers'),
+        func.coalesce(tables.user_stats.c.following, 0).label('following')
     ]).select_from(
         tables.users
-        .outerjoin(followers_subquery, followers_subquery.c.user == tables.users.c.username)
-        .outerjoin(following_subquery, following_subquery.c.user == tables.users.c.username)
+        .outerjoin(tables.user_stats, tables.user_stats.c.username == tables.users.c.username)
     ).where(
         tables.users.c.username == username
     )
 
-    # Fetching the user profile
-    profile = await database.fetch_one(profile_query)
-
-    # Subqueries for counting comments, likes, and checking if liked
-    comments_subquery = select([
-        tables.comments.c.post_id,
-        func.count().label('comments')
-    ]).group_by(tables.comments.c.post_id).subquery()
-
-    likes_subquery = select([
-        tables.likes.c.post_id,
-        func.count().label('likes')
-    ]).group_by(tables.likes.c.post_id).subquery()
-
-    liked_subquery = select([
-        tables.likes.c.post_id,
-        func.bool_or(tables.likes.c.username == user.username).label('liked')
-    ]).group_by(tables.likes.c.post_id).subquery()
-
-    # Query to retrieve user's posts
+    # Query to retrieve the ids of one page of the user's posts, newest first (hydrated below)
     query = select([
-        tables.posts,
-        tables.users.c.username,
-        tables.users.c.full_name,
-        tables.users.c.avatar_url,
-        func.coalesce(comments_subquery.c.comments, 0).label('comments'),
-        func.coalesce(likes_subquery.c.likes, 0).label('likes'),
-        func.coalesce(liked_subquery.c.liked, False).label('liked'),
-        tables.post_images.c.image_url,
-        tables.post_locations.c.latitude,
-        tables.post_locations.c.longitude
-    ]).select_from(
-        tables.posts
-        .join(tables.users, tables.users.c.username == tables.posts.c.username)
-        .outerjoin(comments_subquery, comments_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(likes_subquery, likes_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(tables.post_images, tables.post_images.c.post_id == tables.posts.c.post_id)
-        .outerjoin(tables.post_locations, tables.post_locations.c.post_id == tables.posts.c.post_id)
-    ).where(
+        tables.posts.c.post_id,
+        tables.posts.c.date_posted
+    ]).where(
         tables.posts.c.username == username
     ).order_by(
-        tables.posts.c.date_posted.desc()
-    )
+        tables.posts.c.date_posted.desc(),
+        tables.posts.c.post_id.desc()
+    ).limit(limit + 1)
 
-    # Fetching user's posts
-    posts = await database.fetch_all(query)
+    if cursor:
+        query = query.where(pagination.after_cursor(cursor, tables.posts.c.date_posted, tables.posts.c.post_id))
 
-    # Returning user profile information along with posts
-    return {**profile, 'posts': posts}
+    # Fetching the user profile and the page of posts concurrently
+    db = read_database(user.username)
+    profile, posts = await asyncio.gather(db.fetch_one(profile_query), db.fetch_all(query))
 
-# Asynchronous function to retrieve user activity
-async def get_activity(user: models.User):
+    if profile is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+
+    # Returning user profile information along with the hydrated posts and the cursor of the next page
+    posts, next_cursor = pagination.page(posts, limit, 'date_posted', 'post_id')
+    posts = await hydration.loader(user.username).load_many([post['post_id'] for post in posts])
+    return {**profile, 'posts': posts, 'next_cursor': next_cursor}
+
+# Function to build the query of a user's activity, newest first
+def activity_query(user: models.User):
     # Query to fetch user activity along with user details
     query = select([
         tables.activity,
@@ -171,9 +169,17 @@ async def get_activity(user: models.User):
     ).where(tables.activity.c.user == user.username).order_by(
         tables.activity.c.datetime.desc()
     )
-    
+
+    # Bounding the time range when old activity is detached, so only the recent partitions are scanned
+    if ACTIVITY_RETENTION_DAYS:
+        query = query.where(tables.activity.c.datetime >= func.now() - timedelta(days=ACTIVITY_RETENTION_DAYS))
+    return query
+
+
+# Asynchronous function to retrieve user activity
+async def get_activity(user: models.User):
     # Fetching and returning all activity records
-    return await database.fetch_all(query)
+    return await read_database(user.username).fetch_all(activity_query(user))
 
 
 # Asynchronous function to search for users based on a search query
@@ -201,160 +207,266 @@ async def search_users(search_query: str, user: models.User):
     )
 
     # Fetching and returning all matching users with their following status
-    return await database.fetch_all(query)
+    return await read_database(user.username).fetch_all(query)
 
 
 # Asynchronous function to get the list of followers for a user
 async def get_followers(user: models.User):
     query = select(tables.followers).where(tables.followers.c.user == user.username)
-    followers = await database.fetch_all(query)
+    followers = await read_database(user.username).fetch_all(query)
     return followers
 
 
 # Asynchronous function to get the list of users a given user is following
 async def get_following(user: models.User):
     query = select(tables.following.c.following).where(tables.following.c.user == user.username)
-    following = await database.fetch_all(query)
+    following = await read_database(user.username).fetch_all(query)
     return following
 
 
 # Asynchronous function to get the count of followers for a user
 async def get_follower_count(user: models.User):
-    query = select([func.count()]).select_from(tables.followers).where(tables.followers.c.user == user.username)
-    followers = await database.execute(query)
-    return followers
+    query = select([tables.user_stats.c.followers]).where(tables.user_stats.c.username == user.username)
+    followers = await read_database(user.username).execute(query)
+    return followers or 0
 
 
 # Asynchronous function to get the count of users a given user is following
 async def get_following_count(user: models.User):
-    query = select([func.count()]).select_from(tables.following).where(tables.following.c.user == user.username)
-    following = await database.execute(query)
-    return following
+    query = select([tables.user_stats.c.following]).where(tables.user_stats.c.username == user.username)
+    following = await read_database(user.username).execute(query)
+    return following or 0
+
+
+# Function to build an upsert adding 'delta' to one of a user's follow counters
+def increment_user_stat(username: str, column: str, delta: int = 1):
+    return pg_insert(tables.user_stats).values(
+        username=username, **{column: max(delta, 0)}
+    ).on_conflict_do_update(
+        index_elements=[tables.user_stats.c.username],
+        set_={column: tables.user_stats.c[column] + delta}
+    )
 
 
 # Asynchronous function to create or update user bio
 async def create_bio(bio, user):
     query = update(tables.users).where(tables.users.c.username == user.username).values(bio=bio)
     await database.execute(query)
+    mark_write(user.username)
+    versions.bump(user.username)
+    hydration.forget_authors(user.username)
 
 
 # Asynchronous function to update user avatar
 async def update_avatar(photo: UploadFile, user: models.User):
     _, extension = os.path.splitext(photo.filename)
-    url = str(user.username) + extension
-    
-    # Writing the photo content to the specified file
-    async with aiofiles.open(os.path.join(MEDIA_ROOT, url), "wb") as out_file:
-        await out_file.write(photo.file.read())
-    
+
+    # Storing the photo content (the previous avatar is swept once nothing references it)
+    url = await storage.media_store.save(await photo.read(), extension)
+
     # Updating the user's avatar URL in the database
     query = update(tables.users).where(tables.users.c.username == user.username).values(avatar_url=url)
     await database.execute(query)
+    mark_write(user.username)
+    versions.bump(user.username)
+    hydration.forget_authors(user.username)
 
 
 # Asynchronous function to retrieve a specific post
 async def get_post(post_id: UUID, user: models.User):
-    # Subqueries to fetch counts and user-specific information related to the post
-    comments_subquery = select([
-        tables.comments.c.post_id,
-        func.count().label('comments')
-    ]).group_by(tables.comments.c.post_id).subquery()
-
-    likes_subquery = select([
-        tables.likes.c.post_id,
-        func.count().label('likes')
-    ]).group_by(tables.likes.c.post_id).subquery()
-
-    liked_subquery = select([
-        tables.likes.c.post_id,
-        func.bool_or(tables.likes.c.username == user.username).label('liked')
-    ]).group_by(tables.likes.c.post_id).subquery()
-
-    # Main query to fetch post details
-    query = select([
-        tables.posts,
-        tables.users,
-        func.coalesce(comments_subquery.c.comments, 0).label('comments'),
-        func.coalesce(likes_subquery.c.likes, 0).label('likes'),
-        func.coalesce(liked_subquery.c.liked, False).label('liked'),
-        tables.post_images.c.image_url,
-        tables.post_locations.c.latitude,
-        tables.post_locations.c.longitude
-    ]).select_from(
-        tables.posts
-        .join(tables.users, tables.posts.c.username == tables.users.c.username)
-        .outerjoin(comments_subquery, comments_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(likes_subquery, likes_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(tables.post_images, tables.post_images.c.post_id == tables.posts.c.post_id)
-        .outerjoin(tables.post_locations, tables.post_locations.c.post_id == tables.posts.c.post_id)
-    ).where(
-        tables.posts.c.post_id == post_id
-    )
-    
-    # Fetching and returning the post details
-    feed = await database.fetch_one(query)
-    return feed
+    post = await hydration.loader(user.username).load(post_id)
+    if post is None:
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+    return post
 
 
-# Asynchronous function to retrieve the user's feed
-async def get_feed(user: models.User):
-    # Similar subqueries as in the get_post function
-    comments_subquery = select([
-        tables.comments.c.post_id,
-        func.count().label('comments')
-    ]).group_by(tables.comments.c.post_id).subquery()
-
-    likes_subquery = select([
-        tables.likes.c.post_id,
-        func.count().label('likes')
-    ]).group_by(tables.likes.c.post_id).subquery()
-
-    liked_subquery = select([
-        tables.likes.c.post_id,
-        func.bool_or(tables.likes.c.username == user.username).label('liked')
-    ]).group_by(tables.likes.c.post_id).subquery()
-
-    # Query to fetch posts from users the current user is following
-    query = select([
-        tables.posts,
-        tables.users,
-        func.coalesce(comments_subquery.c.comments, 0).label('comments'),
-        func.coalesce(likes_subquery.c.likes, 0).label('likes'),
-        func.coalesce(liked_subquery.c.liked, False).label('liked'),
-        tables.post_images.c.image_url,
-        tables.post_locations.c.latitude,
-        tables.post_locations.c.longitude
+# Function to build the query of the ids of a user's feed, newest first
+def feed_query(user: models.User):
+    return select([
+        tables.posts.c.post_id
     ]).select_from(
         tables.following
         .join(tables.posts, tables.following.c.following == tables.posts.c.username)
-        .join(tables.users, tables.posts.c.username == tables.users.c.username)
-        .outerjoin(comments_subquery, comments_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(likes_subquery, likes_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(liked_subquery, liked_subquery.c.post_id == tables.posts.c.post_id)
-        .outerjoin(tables.post_images, tables.post_images.c.post_id == tables.posts.c.post_id)
-        .outerjoin(tables.post_locations, tables.post_locations.c.post_id == tables.posts.c.post_id)
     ).where(
         tables.following.c.user == user.username
     ).order_by(
         tables.posts.c.date_posted.desc()
     )
-    
-    # Fetching and returning the user's feed
-    feed = await database.fetch_all(query)
-    return feed
+
+
+# Asynchronous function to retrieve the user's feed
+async def get_feed(user: models.User):
+    # Fetching the ids of the feed's posts, then hydrating them
+    rows = await read_database(user.username).fetch_all(feed_query(user))
+    return await hydration.loader(user.username).load_many([row['post_id'] for row in rows])
+
+
+# Asynchronous function to get the clusters of posts in a map viewport at a zoom level, largest first
+async def get_map_clusters(south: float, west: float, north: float, east: float, zoom: int, user: models.User):
+    if south > north:
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    zoom = min(zoom, MAP_MAX_ZOOM)
+    west_x, north_y = maps.cell(north, west, zoom)
+    east_x, south_y = maps.cell(south, east, zoom)
+
+    # Viewports crossing the antimeridian wrap around
+    if west_x <= east_x:
+        columns = tables.map_cells.c.cell_x.between(west_x, east_x)
+    else:
+        columns = or_(tables.map_cells.c.cell_x >= west_x, tables.map_cells.c.cell_x <= east_x)
+
+    image_subquery = select([tables.post_images.c.image_url]).where(
+        tables.post_images.c.post_id == tables.map_cells.c.post_id
+    ).limit(1).scalar_subquery()
+
+    query = select([
+        (tables.map_cells.c.latitude_sum / tables.map_cells.c.count).label('latitude'),
+        (tables.map_cells.c.longitude_sum / tables.map_cells.c.count).label('longitude'),
+        tables.map_cells.c.count,
+        tables.map_cells.c.post_id,
+        image_subquery.label('image_url')
+    ]).where(
+        tables.map_cells.c.zoom == zoom,
+        columns,
+        tables.map_cells.c.cell_y.between(north_y, south_y)
+    ).order_by(
+        tables.map_cells.c.count.desc()
+    ).limit(MAP_MAX_CLUSTERS)
+    return await read_database(user.username).fetch_all(query)
+
+
+# Asynchronous function to get the accounts suggested to a user, precomputed by the suggestions job
+async def get_suggestions(user: models.User):
+    query = select([tables.follow_suggestions.c.candidates]).where(
+        tables.follow_suggestions.c.username == user.username)
+    row = await read_database(user.username).fetch_one(query)
+    return row['candidates'] if row else []
+
+
+# Asynchronous function to get the trending posts, best first
+async def get_trending(user: models.User, limit: int):
+    post_ids = trending.tracker.top(limit)
+    posts = await hydration.loader(user.username).load_many(post_ids)
+
+    # Forgetting posts deleted since they were scored
+    found = {str(post['post_id']) for post in posts}
+    for post_id in post_ids:
+        if post_id not in found:
+            trending.tracker.discard(post_id)
+    return posts
+
+
+# Asynchronous function to get the changes to a user's feed since a watermark: new posts, deleted post ids and
+# refreshed counters, along with the watermark to send next time. Watermarks are transaction ids: a call returns the
+# changes of the transactions older than the oldest one still running, so a change committed late by a long
+# transaction is never skipped.
+async def sync_feed(user: models.User, since: int):
+    db = read_database(user.username)
+
+    # Asking the client for a full refresh when its watermark was pruned, or when the user followed someone since
+    # (the followed user's older posts are not changes); like changes, a follow counts once its transaction is older
+    # than the oldest one still running
+    xmin = func.txid_snapshot_xmin(func.txid_current_snapshot())
+    bounds = await db.fetch_one(select([
+        xmin.label('xmin'),
+        select([func.min(tables.post_changes.c.txid)]).scalar_subquery().label('oldest'),
+        exists().where(and_(
+            tables.follow_changes.c.username == user.username,
+            tables.follow_changes.c.txid >= since,
+            tables.follow_changes.c.txid < xmin
+        )).label('followed')
+    ]))
+    xmin, oldest = bounds['xmin'], bounds['oldest']
+    if since and ((oldest is not None and since < oldest) or bounds['followed']):
+        return {'watermark': xmin, 'reset': True, 'has_more': False, 'posts': [], 'deleted': [], 'counters': []}
+
+    # Nothing new yet when the watermark comes from a database further ahead (e.g. the primary, read from a replica)
+    if since >= xmin:
+        return {'watermark': since, 'reset': False, 'has_more': False, 'posts': [], 'deleted': [], 'counters': []}
+
+    # Changes to posts of followed users made by the transactions finished before the oldest one still running
+    def changes_query(*conditions):
+        return select([tables.post_changes]).select_from(
+            tables.post_changes
+            .join(tables.following, and_(
+                tables.following.c.following == tables.post_changes.c.username,
+                tables.following.c.user == user.username
+            ))
+        ).where(*conditions).order_by(tables.post_changes.c.txid, tables.post_changes.c.change_id)
+
+    rows = await db.fetch_all(changes_query(
+        tables.post_changes.c.txid >= since,
+        tables.post_changes.c.txid < xmin
+    ).limit(SYNC_LIMIT + 1))
+    has_more = len(rows) > SYNC_LIMIT
+    watermark = xmin
+    if has_more:
+        # Stopping at a transaction boundary: the next call resumes with the first transaction left out, or with the
+        # one after it when that single transaction holds more than a page of changes
+        watermark = rows[SYNC_LIMIT]['txid']
+        rows = [row for row in rows if row['txid'] < watermark]
+        if not rows:
+            rows = await db.fetch_all(changes_query(tables.post_changes.c.txid == watermark))
+            watermark += 1
+
+    # Keeping the latest kind of change per post
+    deleted, created, changed = set(), set(), set()
+    for row in rows:
+        if row['kind'] == changes.DELETED:
+            deleted.add(row['post_id'])
+        elif row['kind'] == changes.POST:
+            created.add(row['post_id'])
+        else:
+            changed.add(row['post_id'])
+    created -= deleted
+    changed -= deleted | created
+
+    counters = []
+    if changed:
+        counters = await db.fetch_all(select([
+            tables.posts.c.post_id,
+            select([func.count()]).where(
+                tables.likes.c.post_id == tables.posts.c.post_id).scalar_subquery().label('likes'),
+            select([func.count()]).where(
+                tables.comments.c.post_id == tables.posts.c.post_id).scalar_subquery().label('comments'),
+            exists().where(and_(
+                tables.likes.c.post_id == tables.posts.c.post_id,
+                tables.likes.c.username == user.username
+            )).label('liked')
+        ]).where(tables.posts.c.post_id.in_(list(changed))))
+
+    posts = await hydration.loader(user.username).load_many(list(created))
+    posts.sort(key=lambda post: post['date_posted'], reverse=True)
+
+    return {
+        'watermark': watermark,
+        'reset': False,
+        'has_more': has_more,
+        'posts': posts,
+        'deleted': list(deleted),
+        'counters': counters,
+    }
 
 
 # Asynchronous function to retrieve likes for a specific post
 async def get_post_likes(post_id: UUID):
     query = tables.likes.select().where(tables.likes.c.post_id == post_id)
-    likes = await database.fetch_all(query)
+    likes = await read_database().fetch_all(query)
     return likes
 
 
-# Asynchronous function to retrieve comments for a specific post
-async def get_post_comments(post_id: UUID):
-    # Query to fetch comments along with user information for a specific post
-    query = select([
+# Cache of the newest comments of recently read posts: post_id -> (comments newest first, whether that is all of them).
+# The comments are cached without their author's avatar, which is read through the author cache of hydration
+comment_cache = communities.PerCommunity(lambda community: cache.LRUCache(COMMENT_CACHE_POSTS))
+
+# Posts whose comments are being loaded into the cache: post_id -> [loads running, comments created meanwhile], so a
+# load overtaken by a new comment does not cache a window missing it
+comment_loads = communities.PerCommunity(lambda community: {})
+
+
+# Function to build the query fetching comments along with user information for a specific post, newest first
+def comments_query(post_id: UUID):
+    return select([
         tables.comments,
         tables.users
     ]).select_from(
@@ -363,12 +475,90 @@ async def get_post_comments(post_id: UUID):
     ).where(
         tables.comments.c.post_id == post_id
     ).order_by(
-        tables.comments.c.date_posted.desc()
+        tables.comments.c.date_posted.desc(),
+        tables.comments.c.comment_id.desc()
     )
-    
-    # Fetching and returning comments
-    comments = await database.fetch_all(query)
-    return comments
+
+
+# Function returning the cached part of a comment (everything but its author's avatar)
+def cached_comment(comment: dict):
+    return {key: value for key, value in comment.items() if key != 'avatar_url'}
+
+
+# Asynchronous function to load the newest comments of a post from the primary, caching them unless a comment was
+# created meanwhile, returning them along with whether that is all of them
+async def load_comments(post_id: UUID):
+    load = comment_loads.setdefault(post_id, [0, 0])
+    load[0] += 1
+    created = load[1]
+    try:
+        rows = await database.fetch_all(comments_query(post_id).limit(COMMENT_CACHE_DEPTH + 1))
+    finally:
+        load[0] -= 1
+        if not load[0]:
+            comment_loads.pop(post_id, None)
+    comments = [responses.record_to_dict(row, models.CommentOut) for row in rows[:COMMENT_CACHE_DEPTH]]
+    complete = len(rows) <= COMMENT_CACHE_DEPTH
+    if load[1] == created:
+        comment_cache.set(post_id, ([cached_comment(comment) for comment in comments], complete))
+    return comments, complete
+
+
+# Asynchronous function to retrieve one page of comments for a specific post, with the cursor of the next page
+async def get_post_comments(post_id: UUID, cursor: str = None, limit: int = PAGE_SIZE):
+    cached = comment_cache.get(post_id)
+    avatars = None
+
+    # Loading the newest comments of the post into the cache when its first page is read (from the primary, since
+    # the cached window is afterwards only updated by create_comment), and serving their avatars as read
+    if cached is None and cursor is None:
+        cached = await load_comments(post_id)
+        avatars = {comment['username']: comment['avatar_url'] for comment in cached[0]}
+
+    # Serving the page from the cache when it lies within the cached comments, with the avatars of their authors
+    if cached is not None:
+        comments, complete = cached
+        start = 0
+        if cursor:
+            key = pagination.decode_cursor(cursor)
+            while start < len(comments) and (comments[start]['date_posted'], comments[start]['comment_id']) >= key:
+                start += 1
+        window = comments[start:start + limit + 1]
+        if len(window) > limit or complete:
+            if avatars is None:
+                authors = await hydration.authors([comment['username'] for comment in window])
+                avatars = {username: author['avatar_url'] for username, author in authors.items()}
+            window = [{**comment, 'avatar_url': avatars.get(comment['username'])} for comment in window]
+            return pagination.page(window, limit, 'date_posted', 'comment_id')
+
+    # Fetching older pages from the database
+    query = comments_query(post_id).limit(limit + 1)
+    if cursor:
+        query = query.where(pagination.after_cursor(cursor, tables.comments.c.date_posted, tables.comments.c.comment_id))
+    return pagination.page(await read_database().fetch_all(query), limit, 'date_posted', 'comment_id')
+
+
+# Asynchronous function to add a newly created comment to the cached comments of its post
+async def cache_comment(post_id: UUID, comment_id: UUID):
+    # Telling the loads of the post's comments running meanwhile that their window may miss the comment
+    load = comment_loads.get(post_id)
+    if load is not None:
+        load[1] += 1
+    if post_id not in comment_cache:
+        return
+    row = await database.fetch_one(comments_query(post_id).where(tables.comments.c.comment_id == comment_id))
+    cached = comment_cache.get(post_id)
+    if row is None or cached is None:
+        return
+    comments, complete = cached
+    comments = sorted(
+        comments + [cached_comment(responses.record_to_dict(row, models.CommentOut))],
+        key=lambda comment: (comment['date_posted'], comment['comment_id']),
+        reverse=True
+    )
+    if len(comments) > COMMENT_CACHE_DEPTH:
+        comments, complete = comments[:COMMENT_CACHE_DEPTH], False
+    comment_cache.set(post_id, (comments, complete))
 
 
 # Asynchronous function to create a new post
@@ -382,9 +572,7 @@ async def create_post(post: str, latitude: float, longitude: float, photo: Uploa
             # Handling post image, if provided
             if photo:
                 _, extension = os.path.splitext(photo.filename)
-                url = str(post_id) + extension
-                async with aiofiles.open(os.path.join(MEDIA_ROOT, url), "wb") as out_file:
-                    await out_file.write(photo.file.read())
+                url = await storage.media_store.save(await photo.read(), extension)
                 
                 # Inserting post image details into the post_images table
                 image_query = insert(tables.post_images).values(post_id=post_id, image_url=url)
@@ -397,24 +585,74 @@ async def create_post(post: str, latitude: float, longitude: float, photo: Uploa
                      latitude=latitude,
                      longitude=longitude)
             await database.execute(location_query)
-        except Exception as e:
-            print(e)
+
+            # Adding the post to the map clusters at every zoom level
+            await database.execute(maps.record_query(post_id, latitude, longitude))
+
+            # Logging the new post for feed sync
+            await database.execute(changes.record_query([post_id], changes.POST))
+        except Exception:
+            logger.exception("failed to create a post of %s", user.username)
             # Handle exceptions or log errors as needed
 
+    # Invalidating cached copies of the author's profile and their followers' feeds
+    mark_write(user.username)
+    versions.bump(user.username)
+
 
 # Asynchronous function to follow another user
 async def follow_user(username: str, user: models.User):
+    # Users of other communities are known locally by a row in the users table, refreshed from their community
+    is_remote = federation.is_remote(username)
+    if is_remote:
+        try:
+            await remote.get_profile(username)
+        except Exception:
+            logger.exception("failed to fetch remote user %s", username)
+            await federation.ensure_remote_user(username)
+
     async with (database.transaction()):
         try:
-            # Inserting into following and followers tables to establish the follow relationship
-            query = insert(tables.following).values(user=user.username, following=username)
-            await database.execute(query)
-            query = insert(tables.followers).values(user=username, follower=user.username)
-            await database.execute(query)
-        except Exception as e:
-            print(e)
-            # Handle exceptions or log errors as needed
-    
+            # Inserting into following and followers tables to establish the follow relationship, unless it
+            # already exists (e.g. a follow delivered again by another community)
+            query = pg_insert(tables.following).values(
+                user=user.username,
+                following=username
+            ).on_conflict_do_nothing().returning(tables.following.c.user)
+            followed = await database.execute(query) is not None
+            if followed:
+                query = insert(tables.followers).values(user=username, follower=user.username)
+                await database.execute(query)
+
+                # Keeping the follow counters in step with the tables
+                await database.execute(increment_user_stat(user.username, 'following'))
+                await database.execute(increment_user_stat(username, 'followers'))
+
+                # Restarting the follower's feed sync, which would otherwise miss the followed user's older posts
+                await database.execute(changes.follow_query(user.username))
+        except Exception:
+            logger.exception("failed to follow %s", username)
+            followed = False
+
+    # Nothing else to do when the follow already existed or failed
+    if not followed:
+        return
+
+    # Invalidating cached copies of the follower's feed and profile
+    mark_write(user.username)
+    versions.following_changed(user.username)
+
+    # Updating the follower's suggestions (dropping the followed user, adding the users they follow)
+    if not federation.is_remote(user.username):
+        try:
+            await suggestions.followed(user.username, username)
+        except Exception:
+            logger.exception("failed to update the follow suggestions of %s", user.username)
+
+    # Letting the followed user's community know
+    if is_remote:
+        await federation.deliver_follow(username, user)
+
     # Logging the follow action
     await log_action(user, models.ActivityAction.follow, username=username)
 
@@ -426,8 +664,16 @@ async def create_comment(comment: models.Comment, user: models.User):
         post_id=comment.post_id,
         username=user.username,
         content=comment.content
-    )
-    await database.execute(query)
+    ).returning(tables.comments.c.comment_id)
+    comment_id = await database.execute(query)
+    mark_write(user.username)
+
+    # Logging the change of the post's comment count for feed sync, and scoring it for trending posts
+    await changes.record([comment.post_id], changes.COUNTERS)
+    trending.tracker.record(comment.post_id, TRENDING_COMMENT_WEIGHT)
+
+    # Keeping the cached comments of the post up to date
+    await cache_comment(comment.post_id, comment_id)
     
     # Logging the comment action
     await log_action(user, models.ActivityAction.comment, post_id=comment.post_id)
@@ -435,28 +681,24 @@ async def create_comment(comment: models.Comment, user: models.User):
 
 # Asynchronous function to create or remove a like on a post
 async def create_like(post_id: UUID, user: models.User):
-    # Checking if the user has already liked the post
-    existing_query = select([tables.likes]).where(
-        tables.likes.c.post_id == post_id,
-        tables.likes.c.username == user.username)
-    existing = await database.fetch_one(existing_query)
-    
-    # If the user has already liked the post, remove the like; otherwise, add a new like
-    if existing:
-        query = delete(tables.likes).where(
-            tables.likes.c.post_id == post_id,
-            tables.likes.c.username == user.username
-        )
-        await database.execute(query)
-    else:
-        query = insert(tables.likes).values(
-            post_id=post_id,
-            username=user.username
-        )
-        await database.execute(query)
-    
-    # Logging the like action
-    await log_action(user, models.ActivityAction.like, post_id=post_id)
+    # Hot posts (and posts with likes still buffered) go through the buffer, which writes likes and activity in batches
+    if LIKE_BUFFERING and (likes.like_buffer.is_hot(post_id) or likes.like_buffer.has_pending(post_id)):
+        await likes.like_buffer.toggle(post_id, user.username)
+        mark_write(user.username)
+        return
+
+    # Removing the like if it exists, otherwise adding it, in a single statement that also returns the author
+    result = await database.fetch_one(likes.toggle_query(post_id, user.username))
+
+    # Invalidating cached copies showing the user's 'liked' flags and the post's like count
+    mark_write(user.username)
+    versions.bump(user.username, result['author'] if result is not None else None)
+    if result is not None and result['author']:
+        trending.tracker.like(post_id, user.username, result['liked'])
+
+    # Logging the like action (only when the post was liked, not when the like was removed)
+    if result is not None and result['liked'] and result['author']:
+        await log_action(user, models.ActivityAction.like, post_id=post_id, author=result['author'])
 
 
 # Asynchronous function to retrieve the author of a specific post
@@ -475,23 +717,64 @@ async def get_post_author(post_id: UUID):
 
 # Asynchronous function to log a user action (follow, comment, like) in the activity table
 async def log_action(action_user: models.User, action: models.ActivityAction, username: str = None,
-                     post_id: UUID = None):
-    # Depending on the action type, log the action in the activity table
+                     post_id: UUID = None, author: str = None):
+    # Depending on the action type, hand the action to the background activity writer
     if username is None and post_id is not None:
-        # If the action is related to a post, find the author and log the action
-        author = await get_post_author(post_id)
-        query = insert(tables.activity).values(
-            user=author.username,
-            action_user=action_user.username,
-            action=action,
-            post_id=post_id
-        )
-        await database.execute(query)
+        # If the action is related to a post, the writer resolves the author (unless the caller already knows it)
+        await activity.activity_writer.log(author, action_user.username, action, post_id)
     elif username is not None and action is models.ActivityAction.follow:
         # If the action is a follow, log the action for the specified user
-        query = insert(tables.activity).values(
-            user=username,
-            action_user=action_user.username,
-            action=action
-        )
-        await database.execute(query)
+        await activity.activity_writer.log(username, action_user.username, action)
+
+
+# Asynchronous function to apply a follow of a local user by a user of another community
+async def receive_follow(event: models.ServerFollowUser):
+    if federation.is_remote(event.username) or not federation.is_remote(event.user.username):
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    await federation.upsert_remote_user(event.user)
+    await follow_user(event.username.lower(), event.user)
+
+
+# Asynchronous function to apply a like of a local post by a user of another community
+async def receive_like(event: models.ServerLike):
+    if not federation.is_remote(event.user.username):
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    await federation.upsert_remote_user(event.user)
+
+    # Adding the like only if it is not there yet, so a redelivered event does not toggle it off again
+    query = pg_insert(tables.likes).values(
+        post_id=event.post_id,
+        username=event.user.username
+    ).on_conflict_do_nothing().returning(tables.likes.c.post_id)
+    if await database.execute(query) is not None:
+        await changes.record([event.post_id], changes.COUNTERS)
+        trending.tracker.like(event.post_id, event.user.username, True)
+        author = await get_post_author(event.post_id)
+        versions.bump(author.username)
+        await log_action(event.user, models.ActivityAction.like, post_id=event.post_id, author=author.username)
+
+
+# Asynchronous function to apply a comment on a local post by a user of another community
+async def receive_comment(event: models.ServerComment):
+    if not federation.is_remote(event.user.username):
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    await federation.upsert_remote_user(event.user)
+    await create_comment(event.comment, event.user)
+
+
+# Asynchronous function to apply a batch of events sent by another community, in order of kind.
+# Invalid events are skipped so that the rest of the batch is not redelivered.
+async def receive_batch(batch: models.ServerBatch):
+    for receive, events in ((receive_follow, batch.follows), (receive_like, batch.likes),
+                            (receive_comment, batch.comments)):
+        for event in events:
+            try:
+                await receive(event)
+            except Exception:
+                logger.exception("failed to apply an event from another community")
+
+
+# Asynchronous function to search local users on behalf of a user of another community
+async def server_search_users(search: models.ServerSearchUser):
+    users = await search_users(search.search_query, search)
+    return [user for user in users if not federation.is_remote(user['username'])]
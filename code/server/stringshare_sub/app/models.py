@@ -24,12 +24,35 @@ class SearchUser(User):
     is_following: Optional[bool]
     avatar_url: str
 
+class SuggestedUser(User):
+    avatar_url: Optional[str]
+    mutuals: int
+
 class UserAvatar(User):
     avatar_url: str
 
 class UserIn(User):
     password: str
 
+class ProvisionError(BaseModel):
+    line: int
+    username: Optional[str]
+    error: str
+
+class ProvisionReport(BaseModel):
+    created: int
+    failed: int
+    errors: List[ProvisionError]
+
+class JobOut(BaseModel):
+    job_id: int
+    kind: str
+    state: str
+    done: int
+    error: Optional[str]
+    created: datetime.datetime
+    updated: datetime.datetime
+
 class UserAuthIn(User):
     hashed_password: str
     salt: str
@@ -58,6 +81,32 @@ class UserOut(User):
     followers: int
     following: int
     posts: List[PostOut]
+    next_cursor: Optional[str]
+
+# Map Models
+
+class MapCluster(BaseModel):
+    latitude: float
+    longitude: float
+    count: int
+    post_id: Optional[UUID]
+    image_url: Optional[str]
+
+# Feed Sync Models
+
+class PostCounters(BaseModel):
+    post_id: UUID
+    likes: int
+    comments: int
+    liked: bool
+
+class SyncOut(BaseModel):
+    watermark: int
+    reset: bool
+    has_more: bool
+    posts: List[PostOut]
+    deleted: List[UUID]
+    counters: List[PostCounters]
 
 # Comment Models
 
@@ -118,3 +167,8 @@ class ServerLike(BaseModel):
 class ServerComment(BaseModel):
     comment: Comment
     user: ServerUser
+
+class ServerBatch(BaseModel):
+    follows: List[ServerFollowUser] = []
+    likes: List[ServerLike] = []
+    comments: List[ServerComment] = []
@@ -0,0 +1,38 @@
+# Importing necessary modules and components
+import base64
+import datetime
+from uuid import UUID
+from sqlalchemy import and_, or_
+import exceptions
+
+
+# Function to encode the sort key of the last row of a page into an opaque cursor string
+def encode_cursor(date: datetime.datetime, row_id: UUID):
+    raw = "{}|{}".format(date.isoformat(), row_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+# Function to decode a cursor back into its (date, id) sort key
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date, row_id = raw.split("|")
+        return datetime.datetime.fromisoformat(date), UUID(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+
+
+# Function returning the condition selecting rows that come after the cursor in (date desc, id desc) order
+def after_cursor(cursor: str, date_column, id_column):
+    date, row_id = decode_cursor(cursor)
+    return or_(date_column < date, and_(date_column == date, id_column < row_id))
+
+
+# Function to split a result fetched with limit + 1 rows into the page and the cursor of the next page
+def page(rows, limit: int, date_key: str, id_key: str):
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[date_key], last[id_key])
@@ -0,0 +1,106 @@
+# Query plan regression check: seeds a large dataset inside a transaction that is rolled back, then checks that the
+# planner uses indexes (no sequential scan of large tables) for the hot queries of the API.
+# Usage: python plancheck.py [scale]   (scale 1 = 10k users, 200k posts, 1M likes; exits with 1 on regressions)
+import asyncio
+import sys
+from types import SimpleNamespace
+import orjson
+from sqlalchemy.sql import select, exists
+from sqlalchemy.dialects import postgresql
+from database import database
+from constants import DB_URL
+import communities
+import hydration
+import likes
+import methods
+import tables
+
+# Seeding statements, formatted with the row counts ({users}, {posts}, {likes}, {comments}, {activity})
+SEED = [
+    """INSERT INTO users (username, full_name)
+       SELECT 'plan' || i || '@plan.test', 'Plan User ' || i FROM generate_series(1, {users}) i""",
+    """INSERT INTO following ("user", following)
+       SELECT DISTINCT 'plan' || (1 + i % {users}) || '@plan.test',
+                       'plan' || (1 + (random() * ({users} - 1))::int) || '@plan.test'
+       FROM generate_series(1, {users} * 50) i ON CONFLICT DO NOTHING""",
+    """INSERT INTO posts (username, content, date_posted)
+       SELECT 'plan' || (1 + i % {users}) || '@plan.test', 'post ' || i, now() - i * interval '1 minute'
+       FROM generate_series(1, {posts}) i""",
+    """INSERT INTO likes (post_id, username)
+       SELECT post_id, 'plan' || (1 + (random() * ({users} - 1))::int) || '@plan.test'
+       FROM (SELECT post_id FROM posts ORDER BY random() LIMIT {posts}) p, generate_series(1, {likes} / {posts})
+       ON CONFLICT DO NOTHING""",
+    """INSERT INTO comments (post_id, username, content, date_posted)
+       SELECT post_id, username, 'comment', date_posted + interval '1 minute'
+       FROM posts ORDER BY random() LIMIT {comments}""",
+    """INSERT INTO activity ("user", action_user, action, post_id, datetime)
+       SELECT username, username, 'like', post_id, date_posted FROM posts ORDER BY random() LIMIT {activity}""",
+    "ANALYZE users, following, posts, likes, comments, activity",
+]
+
+# Tables that must never be read by a sequential scan in the checked queries
+LARGE_TABLES = {'posts', 'likes', 'comments', 'activity', 'following'}
+
+
+# Function walking a JSON plan, yielding its nodes
+def nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from nodes(child)
+
+
+# Asynchronous function returning the sequential scans of large tables in the plan of a query
+async def seq_scans(query):
+    compiled = query.compile(dialect=postgresql.dialect(paramstyle='named'))
+    plan = await database.fetch_val("EXPLAIN (FORMAT JSON) " + str(compiled), values=compiled.params)
+    plan = orjson.loads(plan) if isinstance(plan, str) else plan
+    return sorted({
+        node['Relation Name'] for node in nodes(plan[0]['Plan'])
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in LARGE_TABLES
+    })
+
+
+# Asynchronous function seeding the dataset, 'scale' times the default size, in the current transaction
+async def seed(scale: float):
+    counts = {name: int(count * scale) for name, count in
+              (('users', 10000), ('posts', 200000), ('likes', 1000000), ('comments', 200000), ('activity', 500000))}
+    for statement in SEED:
+        await database.execute(statement.format(**counts))
+
+
+# Asynchronous function returning the sequential scans of large tables in the plan of each hot query, for the filters
+# and sort keys of the feed, profile, comments, activity and like endpoints
+async def check():
+    user = SimpleNamespace(username='plan1@plan.test')
+    post_id = await database.fetch_val(select([tables.posts.c.post_id]).where(
+        tables.posts.c.username == user.username).limit(1))
+    checks = {
+        'get_feed': methods.feed_query(user),
+        'hydrate posts': hydration.posts_query([post_id], user.username),
+        'get_user_profile posts': select([tables.posts.c.post_id, tables.posts.c.date_posted])
+        .where(tables.posts.c.username == user.username)
+        .order_by(tables.posts.c.date_posted.desc(), tables.posts.c.post_id.desc()).limit(21),
+        'get_post_comments': methods.comments_query(post_id).limit(21),
+        'get_activity': methods.activity_query(user),
+        'create_like': select([exists().where(likes.like_condition(post_id, user.username))]),
+        'likes of a user': select([tables.likes]).where(tables.likes.c.username == user.username),
+    }
+    return {name: await seq_scans(query) for name, query in checks.items()}
+
+
+async def main(scale: float):
+    communities.create_tables(DB_URL)
+    await database.connect()
+    try:
+        async with database.transaction(force_rollback=True):
+            await seed(scale)
+            results = await check()
+    finally:
+        await database.disconnect()
+    for name, scans in results.items():
+        print("{:<28} {}".format(name, "FAIL: sequential scan of " + ", ".join(scans) if scans else "ok"))
+    return sum(bool(scans) for scans in results.values())
+
+
+if __name__ == '__main__':
+    sys.exit(1 if asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 1)) else 0)
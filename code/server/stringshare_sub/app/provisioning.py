@@ -0,0 +1,201 @@
+# Importing necessary modules and components
+import asyncio
+import csv
+import itertools
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Tuple
+import orjson
+import pydantic
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.sql import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from database import database
+from constants import PROVISION_BATCH_SIZE, PROVISION_WORKERS, PROVISION_AVATAR_CONCURRENCY
+import auth
+import methods
+import models
+import remote
+import storage
+import tables
+
+logger = logging.getLogger(__name__)
+
+# Pool of processes hashing passwords (bcrypt is CPU bound), created on first use
+_pool = None
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PROVISION_WORKERS)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+# Function run in the pool: generating a salt and hashing a password with it
+def hash_password(password: str):
+    salt = auth.gen_salt()
+    return salt, auth.get_password_hash(password + salt)
+
+
+# Generator of (line number, row, error) from a stream of CSV (with a header line) or JSON lines
+def read_rows(stream: Iterable[str]) -> Iterator[Tuple[int, dict, str]]:
+    lines = iter(stream)
+    first = next(lines, '')
+    if first.lstrip().startswith('{'):
+        for number, line in enumerate(itertools.chain([first], lines), 1):
+            if not line.strip():
+                continue
+            try:
+                row = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                yield number, {}, "invalid JSON: {}".format(e)
+                continue
+            if isinstance(row, dict):
+                yield number, row, None
+            else:
+                yield number, {}, "expected a JSON object"
+    else:
+        reader = csv.DictReader(lines, fieldnames=next(csv.reader([first]), []))
+        for row in reader:
+            # Values beyond the header's columns are put under None
+            if None in row:
+                yield reader.line_num + 1, {}, "more values than columns"
+            else:
+                yield reader.line_num + 1, row, None
+
+
+# Asynchronous function to create an avatar from the user's name, returning None when the avatar service fails
+async def fetch_avatar(full_name: str, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        try:
+            params = {"name": full_name, "background": "random"}
+            async with remote.session().get('https://ui-avatars.com/api/', params=params) as response:
+                if response.status != 200:
+                    return None
+                content = await response.read()
+            return await storage.media_store.save(content, ".png")
+        except Exception as e:
+            logger.warning("could not create the avatar of %s: %s", full_name, e)
+            return None
+
+
+# Asynchronous function to create a batch of users: validating the rows, hashing passwords across the process pool
+# and fetching avatars concurrently, then inserting users and credentials in one transaction.
+# Returns the number of users created and the errors as (line number, username, message).
+async def create_batch(rows: List[Tuple[int, dict, str]], semaphore: asyncio.Semaphore):
+    errors = []
+    users = {}
+    for number, row, error in rows:
+        if error is not None:
+            errors.append((number, None, error))
+            continue
+        unexpected = sorted(set(row) - set(models.UserIn.__fields__))
+        if unexpected:
+            errors.append((number, row.get('username'), "unexpected columns: {}".format(', '.join(unexpected))))
+            continue
+        try:
+            user = models.UserIn(**row)
+        except pydantic.ValidationError as e:
+            errors.append((number, row.get('username'), str(e).replace('\n', ' ')))
+            continue
+        user.username = methods.local_username(user.username)
+        if user.username in users:
+            errors.append((number, user.username, "duplicate username in the file"))
+            continue
+        users[user.username] = (number, user)
+    if not users:
+        return 0, errors
+
+    # Skipping existing users before doing the expensive work
+    query = select([tables.users.c.username]).where(tables.users.c.username.in_(list(users)))
+    for row in await database.fetch_all(query):
+        number, _ = users.pop(row['username'])
+        errors.append((number, row['username'], "username already exists"))
+    if not users:
+        return 0, errors
+
+    loop = asyncio.get_running_loop()
+    hashes = asyncio.gather(*[
+        loop.run_in_executor(pool(), hash_password, user.password) for _, user in users.values()
+    ], return_exceptions=True)
+    avatars = asyncio.gather(*[fetch_avatar(user.full_name, semaphore) for _, user in users.values()])
+    hashes, avatars = await asyncio.gather(hashes, avatars)
+
+    # Reporting the passwords that could not be hashed (e.g. too long for bcrypt)
+    accounts = {}
+    for (username, (number, user)), hashed, avatar in zip(users.items(), hashes, avatars):
+        if isinstance(hashed, Exception):
+            errors.append((number, username, str(hashed)))
+        else:
+            accounts[username] = (user, hashed, avatar)
+    if not accounts:
+        return 0, errors
+
+    async with database.transaction():
+        # Users created concurrently (e.g. by a signup) are left alone and reported
+        query = pg_insert(tables.users).values([
+            {'username': username, 'full_name': user.full_name, 'avatar_url': avatar}
+            for username, (user, _, avatar) in accounts.items()
+        ]).on_conflict_do_nothing().returning(tables.users.c.username)
+        created = {row['username'] for row in await database.fetch_all(query)}
+
+        credentials = [
+            {'username': username, 'hashed_password': hashed_password, 'salt': salt, 'disabled': False}
+            for username, (_, (salt, hashed_password), _) in accounts.items() if username in created
+        ]
+        if credentials:
+            await database.execute(tables.user_credentials.insert().values(credentials))
+
+    for username in accounts:
+        if username not in created:
+            errors.append((users[username][0], username, "username already exists"))
+    return len(created), sorted(errors)
+
+
+# Asynchronous function to create users from a stream of CSV or JSON lines (fields: username, full_name, password),
+# in batches of PROVISION_BATCH_SIZE, returning a report with the errors per line
+async def provision(stream: Iterable[str]):
+    semaphore = asyncio.Semaphore(PROVISION_AVATAR_CONCURRENCY)
+    report = {'created': 0, 'failed': 0, 'errors': []}
+    rows = read_rows(stream)
+    while True:
+        # Reading the next batch in a thread, so the event loop does not wait on the file (e.g. an upload spooled
+        # to disk)
+        batch = await run_in_threadpool(list, itertools.islice(rows, PROVISION_BATCH_SIZE))
+        if not batch:
+            return report
+        try:
+            created, errors = await create_batch(batch, semaphore)
+        except Exception as e:
+            logger.exception("failed to create a batch of users")
+            created, errors = 0, [(number, row.get('username'), str(e)) for number, row, _ in batch]
+        report['created'] += created
+        report['failed'] += len(errors)
+        report['errors'].extend(
+            {'line': number, 'username': username, 'error': error} for number, username, error in errors)
+
+
+# Command line use: python provisioning.py users.csv (or users.jsonl)
+async def main(path: str):
+    await database.connect()
+    try:
+        with open(path, 'r', newline='', encoding='utf-8') as file:
+            report = await provision(file)
+        print(orjson.dumps(report, option=orjson.OPT_INDENT_2).decode())
+    finally:
+        await remote.close()
+        shutdown()
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1]))
@@ -0,0 +1,101 @@
+# Importing necessary modules and components
+import contextlib
+import contextvars
+import time
+import databases
+
+# Statistics of the request (or block) being tracked, shared by the tasks it starts
+_current = contextvars.ContextVar('query_stats', default=None)
+
+
+# Number of database round trips and time spent in them, with the statements when asked for
+class QueryStats:
+    def __init__(self, keep_statements: bool = False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] if keep_statements else None
+
+    def add(self, query, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        if self.statements is not None:
+            self.statements.append(" ".join(str(query).split()))
+
+    # Headers attached to responses in debug mode
+    def headers(self):
+        return {'X-DB-Queries': str(self.count), 'X-DB-Time-Ms': "{:.2f}".format(self.seconds * 1000)}
+
+
+# Database counting every round trip made while statistics are tracked (untracked calls, e.g. from background
+# tasks, cost nothing more)
+class CountingDatabase(databases.Database):
+    async def _timed(self, call, query, *args, **kwargs):
+        stats = _current.get()
+        if stats is None:
+            return await call(query, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await call(query, *args, **kwargs)
+        finally:
+            stats.add(query, time.perf_counter() - start)
+
+    async def fetch_all(self, query, values=None):
+        return await self._timed(super().fetch_all, query, values)
+
+    async def fetch_one(self, query, values=None):
+        return await self._timed(super().fetch_one, query, values)
+
+    async def fetch_val(self, query, values=None, column=0):
+        return await self._timed(super().fetch_val, query, values, column=column)
+
+    async def execute(self, query, values=None):
+        return await self._timed(super().execute, query, values)
+
+    async def execute_many(self, query, values):
+        return await self._timed(super().execute_many, query, values)
+
+    # Iterating counts one round trip, timed until the first row
+    async def iterate(self, query, values=None):
+        stats = _current.get()
+        start = time.perf_counter()
+        first = True
+        async for record in super().iterate(query, values):
+            if first and stats is not None:
+                stats.add(query, time.perf_counter() - start)
+                first = False
+            yield record
+        if first and stats is not None:
+            stats.add(query, time.perf_counter() - start)
+
+
+# Context manager tracking the queries made in its block (and the tasks started from it)
+@contextlib.contextmanager
+def track(keep_statements: bool = False):
+    stats = QueryStats(keep_statements)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+# Context manager failing when the block makes more than 'limit' queries, listing them, e.g.
+#     with assert_max_queries(3):
+#         await methods.get_feed(user)
+@contextlib.contextmanager
+def assert_max_queries(limit: int):
+    with track(keep_statements=True) as stats:
+        yield stats
+    if stats.count > limit:
+        raise AssertionError("{} queries made, expected at most {}:\n{}".format(
+            stats.count, limit, "\n".join(stats.statements)))
+
+
+# Function failing when a route made more than 'limit' queries, from the headers of its response (the server must
+# run with DEBUG=true), e.g. assert_route_queries(client.get('/client/posts', headers=auth), 4)
+def assert_route_queries(response, limit: int):
+    count = response.headers.get('X-DB-Queries')
+    if count is None:
+        raise AssertionError("no X-DB-Queries header: run the server with DEBUG=true")
+    if int(count) > limit:
+        raise AssertionError("the route made {} queries, expected at most {}".format(count, limit))
@@ -0,0 +1,249 @@
+# Importing necessary modules and components
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+import urllib.parse
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable
+import aiofiles
+import aiohttp
+from sqlalchemy import or_
+from sqlalchemy.sql import select, exists
+from database import read_database
+from constants import REMOTE_PROFILE_CACHE_SIZE, REMOTE_PROFILE_TTL, REMOTE_STALE_TTL, REMOTE_MEDIA_DIR, \
+    REMOTE_MEDIA_MAX_BYTES, REMOTE_MEDIA_TTL, REMOTE_TIMEOUT, FEDERATION_KEY, FEDERATION_PEERS
+import cache
+import communities
+import exceptions
+import federation
+import models
+import tables
+
+logger = logging.getLogger(__name__)
+
+
+# Function logging the failure of a fetch (background refreshes are not awaited by anyone)
+def _log_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("background refresh failed: %s", task.exception())
+
+
+# Cache of remote values with a TTL and stale-while-revalidate: fresh values are returned as is, stale ones are
+# returned immediately while one background fetch refreshes them, and concurrent misses share one fetch per key
+class RemoteCache:
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = cache.LRUCache(maxsize)
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    # Asynchronous function to get the value of a key, calling 'fetch(key)' when it has to be (re)loaded
+    async def get(self, key: Hashable, fetch: Callable[[Hashable], Awaitable]):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._refresh(key, fetch)
+                return value
+        # Shielding the shared fetch so a cancelled caller does not cancel it for the others
+        return await asyncio.shield(self._refresh(key, fetch))
+
+    # Function returning the in-flight fetch of a key, starting one if there is none
+    def _refresh(self, key: Hashable, fetch: Callable[[Hashable], Awaitable]):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, fetch))
+            task.add_done_callback(_log_failure)
+            self._inflight[key] = task
+        return task
+
+    async def _load(self, key: Hashable, fetch: Callable[[Hashable], Awaitable]):
+        try:
+            value = await fetch(key)
+            self._entries.set(key, (value, time.monotonic()))
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Disk-backed LRU of remote media files (e.g. avatars of users from other communities) under 'root',
+# evicting the least recently used files once they take more than 'max_bytes'
+class MediaCache:
+    def __init__(self, root: str, max_bytes: int, ttl: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._files = None  # hash -> (file name, size, fetched at), least recently used first
+        self._size = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    # Function to load the index of cached files from disk, oldest first, on first use
+    def _index(self):
+        if self._files is None:
+            os.makedirs(self.root, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.root):
+                if name.startswith('.') or name.endswith('.part'):
+                    continue
+                stat = os.stat(os.path.join(self.root, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+            self._files = OrderedDict()
+            for mtime, name, size in sorted(entries):
+                self._files[os.path.splitext(name)[0]] = (name, size, mtime)
+                self._size += size
+        return self._files
+
+    # Asynchronous function returning the local path of a remote file, downloading it if it is not cached and
+    # 'allowed(url)' agrees (files are only cached once allowed)
+    async def get(self, url: str, allowed: Callable[[str], Awaitable[bool]]):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        files = self._index()
+        entry = files.get(key)
+        if entry is not None:
+            files.move_to_end(key)
+            name, _, fetched_at = entry
+            # Serving a stale file right away while it is downloaded again in the background
+            if time.time() - fetched_at > self.ttl:
+                self._download(key, url)
+            return os.path.join(self.root, name)
+        if not await allowed(url):
+            raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+        return await asyncio.shield(self._download(key, url))
+
+    # Function returning the in-flight download of a file, starting one if there is none
+    def _download(self, key: str, url: str):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, url))
+            task.add_done_callback(_log_failure)
+            self._inflight[key] = task
+        return task
+
+    async def _fetch(self, key: str, url: str):
+        try:
+            async with session().get(url) as response:
+                if response.status != 200:
+                    raise exceptions.API_404_NOT_FOUND_EXCEPTION
+                extension = mimetypes.guess_extension(response.content_type or '') or ''
+                name = key + extension
+                path = os.path.join(self.root, name)
+                # Writing to a temporary file first so readers never see a partial file
+                async with aiofiles.open(path + '.part', 'wb') as out_file:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        await out_file.write(chunk)
+            os.replace(path + '.part', path)
+
+            files = self._index()
+            previous = files.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+                if previous[0] != name and os.path.exists(os.path.join(self.root, previous[0])):
+                    os.remove(os.path.join(self.root, previous[0]))
+            size = os.path.getsize(path)
+            files[key] = (name, size, time.time())
+            self._size += size
+            self._evict()
+            return path
+        finally:
+            self._inflight.pop(key, None)
+
+    # Function removing the least recently used files until the cache fits in 'max_bytes'
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._files) > 1:
+            _, (name, size, _) = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+
+# Shared HTTP session for remote fetches, created on first use
+_session = None
+
+
+def session():
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=8, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=REMOTE_TIMEOUT)
+        )
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+# Profiles and media files are cached per community, as each one keeps its own copy of remote users and decides
+# which media may be fetched (media files under REMOTE_MEDIA_DIR of the community's media root)
+profile_cache = communities.PerCommunity(
+    lambda community: RemoteCache(REMOTE_PROFILE_CACHE_SIZE, REMOTE_PROFILE_TTL, REMOTE_STALE_TTL))
+media_cache = communities.PerCommunity(
+    lambda community: MediaCache(os.path.join(community.media_root, REMOTE_MEDIA_DIR), REMOTE_MEDIA_MAX_BYTES,
+                                 REMOTE_MEDIA_TTL))
+
+
+# Asynchronous function fetching a user's profile from their community and refreshing the local copy, provided
+# the community answered with the user that was asked for
+async def _fetch_profile(username: str):
+    if not federation.is_remote(username):
+        raise exceptions.API_400_BAD_REQUEST_EXCEPTION
+    url = federation.peer_url(federation.community_of(username)) + '/server/users'
+    headers = {'X-Federation-Key': FEDERATION_KEY} if FEDERATION_KEY else {}
+    async with session().get(url, params={'username': username}, headers=headers) as response:
+        if response.status != 200:
+            raise exceptions.API_404_NOT_FOUND_EXCEPTION
+        user = models.ServerUser(**await response.json())
+    # The user has to be the one asked for, so of the community that answered, not a local user or one of another
+    # community
+    if user.username.lower() != username:
+        logger.warning("community %s answered with user %s for %s", federation.community_of(username),
+                       user.username, username)
+        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+    await federation.upsert_remote_user(user)
+    return user
+
+
+# Asynchronous function to get the profile of a user from another community, served from the cache when possible
+async def get_profile(username: str):
+    return await profile_cache.get(username.lower(), _fetch_profile)
+
+
+# Function returning the host names of the configured peers (the communities of FEDERATION_PEERS and the hosts of
+# their URLs)
+def peer_hosts():
+    return set(FEDERATION_PEERS) | {urllib.parse.urlsplit(url).hostname for url in FEDERATION_PEERS.values()}
+
+
+# Asynchronous function telling whether a remote media file may be downloaded: it has to be on a configured peer,
+# or be the avatar of a user or an image of a post stored here, so the media route cannot fetch arbitrary URLs
+async def media_allowed(url: str):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        return False
+    if parts.hostname in peer_hosts():
+        return True
+    query = select([or_(
+        exists().where(tables.users.c.avatar_url == url),
+        exists().where(tables.post_images.c.image_url == url)
+    )])
+    return bool(await read_database().fetch_val(query))
+
+
+# Asynchronous function to get the local path of a remote media file (e.g. an avatar on another server)
+async def get_media(url: str):
+    return await media_cache.get(url, media_allowed)
@@ -0,0 +1,86 @@
+# Importing necessary modules and classes
+import enum
+import typing
+import uuid
+from typing import Any, Dict, List, Tuple
+
+import orjson
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+# Cache of field plans per model so the model introspection only happens once
+_field_plans: Dict[type, List[Tuple[str, Any]]] = {}
+
+
+# Function used by orjson for types it does not serialize natively
+def _default(value):
+    # Enum columns (e.g. activity.action) are stored and returned by name
+    if isinstance(value, enum.Enum):
+        return value.name
+    # UUID subclasses (such as the one returned by asyncpg) are not handled natively
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError
+
+
+# Function to find the nested model (if any) of a field annotation, unwrapping Optional[...] and List[...]
+def _nested_model(annotation):
+    origin = typing.get_origin(annotation)
+    if origin in (typing.Union, list, List):
+        for arg in typing.get_args(annotation):
+            nested = _nested_model(arg)
+            if nested is not None:
+                return nested
+        return None
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    return None
+
+
+# Function to build (and cache) the list of fields to copy out of a record for a given model
+def _field_plan(model: type):
+    plan = _field_plans.get(model)
+    if plan is None:
+        # Supporting both pydantic v2 (model_fields) and v1 (__fields__)
+        fields = getattr(model, "model_fields", None) or model.__fields__
+        plan = []
+        for name, field in fields.items():
+            annotation = getattr(field, "annotation", None) or getattr(field, "outer_type_", None)
+            plan.append((name, _nested_model(annotation)))
+        _field_plans[model] = plan
+    return plan
+
+
+# Function to turn a single database record into a plain dict holding exactly the fields of the model
+def record_to_dict(record, model: type):
+    if record is None:
+        return None
+    mapping = getattr(record, "_mapping", record)
+    result = {}
+    for name, nested in _field_plan(model):
+        value = mapping.get(name)
+        if nested is not None and value is not None:
+            if isinstance(value, (list, tuple)):
+                value = [record_to_dict(item, nested) for item in value]
+            else:
+                value = record_to_dict(value, nested)
+        result[name] = value
+    return result
+
+
+# Function to serialize a record (or list of records) straight to JSON bytes following the model's schema
+def dump_records(records, model: type) -> bytes:
+    if isinstance(records, (list, tuple)):
+        content = [record_to_dict(record, model) for record in records]
+    else:
+        content = record_to_dict(records, model)
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Response class that serializes database records with orjson, skipping pydantic validation.
+# Routes keep their response_model so the OpenAPI schema is unchanged.
+class RecordResponse(Response):
+    media_type = "application/json"
+
+    def __init__(self, records: Any, model: type, **kwargs):
+        super().__init__(content=dump_records(records, model), **kwargs)
@@ -0,0 +1,166 @@
+# Importing necessary modules and components
+import asyncio
+import datetime
+import logging
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.dialects import postgresql
+from database import database
+from constants import ACTIVITY_PARTITIONING, ACTIVITY_PARTITIONS_AHEAD, ACTIVITY_RETENTION_DAYS
+import tables
+
+logger = logging.getLogger(__name__)
+
+dialect = postgresql.dialect()
+
+# Columns added to existing tables since they were created (create_all only creates missing tables): (table, column,
+# definition)
+ADDED_COLUMNS = [
+    ('post_changes', 'txid', "bigint NOT NULL DEFAULT txid_current()"),
+]
+
+
+# Function to tell whether a table is declared as partitioned
+def _partitioned(table):
+    return bool(table.dialect_options['postgresql'].get('partition_by'))
+
+
+# Asynchronous function to get the names of the invalid indexes, left behind by a concurrent build that failed (an
+# index still being built by another server is invalid too, so those are left out)
+async def invalid_indexes():
+    rows = await database.fetch_all("""
+        SELECT c.relname FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema()
+        AND i.indexrelid NOT IN (SELECT index_relid FROM pg_stat_progress_create_index)
+    """)
+    return {row[0] for row in rows}
+
+
+# Asynchronous function creating the indexes declared in tables.py that are missing (create_all only creates
+# the indexes of new tables), and rebuilding those a failed build left invalid (IF NOT EXISTS would skip them, and
+# Postgres does not use them). Indexes are built concurrently so writes go on meanwhile; partitioned tables do not
+# support that, so theirs are built normally.
+async def ensure_indexes():
+    invalid = await invalid_indexes()
+    for table in tables.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            concurrently = "" if _partitioned(table) else " CONCURRENTLY"
+            if index.name in invalid:
+                logger.warning("rebuilding invalid index %s", index.name)
+                await database.execute("DROP INDEX{} IF EXISTS {}".format(concurrently, index.name))
+            statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+            await database.execute(statement.replace("CREATE INDEX", "CREATE INDEX" + concurrently, 1))
+
+
+# Asynchronous function adding the columns of ADDED_COLUMNS that are missing (checked first, so existing databases
+# are not locked by an ALTER TABLE on every startup)
+async def add_columns():
+    rows = await database.fetch_all("""
+        SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = current_schema()
+    """)
+    existing = {(row[0], row[1]) for row in rows}
+    for table, column, definition in ADDED_COLUMNS:
+        if (table, column) not in existing:
+            await database.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(table, column, definition))
+
+
+# Function to get the first day of the month 'months' after the month of 'day'
+def month_start(day: datetime.date, months: int = 0):
+    month = day.month - 1 + months
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+
+# Function to get the name of the activity partition of a month
+def partition_name(start: datetime.date):
+    return "activity_p{:04d}{:02d}".format(start.year, start.month)
+
+
+# Asynchronous function to tell whether the activity table is partitioned in the database
+async def is_partitioned():
+    return await database.fetch_val("""
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+                       WHERE c.relname = 'activity')
+    """)
+
+
+# Asynchronous function to get the names of the partitions attached to the activity table
+async def partitions():
+    rows = await database.fetch_all("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'activity'
+    """)
+    return {row[0] for row in rows}
+
+
+# Asynchronous function creating the monthly activity partitions from the month of 'since' to
+# ACTIVITY_PARTITIONS_AHEAD months ahead, plus a default partition for anything outside of them
+async def ensure_partitions(since: datetime.date = None):
+    today = datetime.date.today()
+    start = month_start(since or today)
+    existing = await partitions()
+    while start <= month_start(today, ACTIVITY_PARTITIONS_AHEAD):
+        end = month_start(start, 1)
+        if partition_name(start) not in existing:
+            await database.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF activity FOR VALUES FROM ('{}') TO ('{}')"
+                                   .format(partition_name(start), start, end))
+        start = end
+    await database.execute("CREATE TABLE IF NOT EXISTS activity_default PARTITION OF activity DEFAULT")
+
+
+# Asynchronous function detaching the activity partitions older than ACTIVITY_RETENTION_DAYS. Detached partitions
+# are kept as plain tables (to archive or drop) and are no longer read or written.
+async def detach_partitions():
+    if not ACTIVITY_RETENTION_DAYS:
+        return
+    cutoff = datetime.date.today() - datetime.timedelta(days=ACTIVITY_RETENTION_DAYS)
+    for name in sorted(await partitions()):
+        if not name.startswith('activity_p'):
+            continue
+        start = datetime.date(int(name[10:14]), int(name[14:16]), 1)
+        if month_start(start, 1) <= cutoff:
+            await database.execute("ALTER TABLE activity DETACH PARTITION {}".format(name))
+            logger.info("detached activity partition %s", name)
+
+
+# Asynchronous function converting an existing unpartitioned activity table into a partitioned one, copying its
+# rows, in one transaction (run once after enabling ACTIVITY_PARTITIONING on an existing database)
+async def partition_activity():
+    if not ACTIVITY_PARTITIONING or await is_partitioned():
+        return
+    async with database.transaction():
+        await database.execute("ALTER TABLE activity RENAME TO activity_unpartitioned")
+        await database.execute("ALTER INDEX IF EXISTS activity_pkey RENAME TO activity_unpartitioned_pkey")
+        await database.execute("DROP INDEX IF EXISTS ix_activity_user_datetime")
+        await database.execute(str(CreateTable(tables.activity).compile(dialect=dialect)))
+        for index in tables.activity.indexes:
+            await database.execute(str(CreateIndex(index).compile(dialect=dialect)))
+        oldest = await database.fetch_val("SELECT min(datetime) FROM activity_unpartitioned")
+        await ensure_partitions(oldest.date() if oldest else None)
+        await database.execute("INSERT INTO activity SELECT * FROM activity_unpartitioned")
+        await database.execute("DROP TABLE activity_unpartitioned")
+
+
+# Asynchronous function preparing the schema on startup: adding missing columns, converting and creating the
+# activity partitions
+async def prepare():
+    await add_columns()
+    if ACTIVITY_PARTITIONING:
+        await partition_activity()
+        await ensure_partitions()
+
+
+# Background task building missing indexes, then maintaining the activity partitions every day
+async def run():
+    try:
+        await ensure_indexes()
+    except Exception:
+        logger.exception("failed to create the missing indexes")
+    while True:
+        if ACTIVITY_PARTITIONING:
+            try:
+                await ensure_partitions()
+                await detach_partitions()
+            except Exception:
+                logger.exception("failed to maintain the activity partitions")
+        await asyncio.sleep(86400)
@@ -1,62 +1,138 @@
 # Importing necessary modules and classes from FastAPI
-from fastapi import FastAPI, Depends, status, Request, UploadFile
+from fastapi import FastAPI, Depends, Query, status, Request, UploadFile
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from uuid import UUID
 from typing import List
 
 # Importing standard libraries
+import asyncio
+import io
 import time
 import logging
-import random
-import string
 import helper
-import os
+import hydration
+import jobs
 
 # Importing custom modules and classes
 import models
 import exceptions
+import federation
 import database
 import constants
 import methods
+import activity
+import admission
 import auth
+import changes
+import communities
+import export
+import likes
+import logs
+import maps
+import provisioning
+import querystats
+import remote
+import schema
+import storage
+import suggestions
+import trending
+import responses
+import versions
 
 # Creating a FastAPI app instance
 app = FastAPI()
 
-# Configuring logging to write to 'info.log'
-logging.basicConfig(filename='info.log', level=logging.INFO)
+# Configuring logging to write JSON lines to 'info.log' from a background thread
+logs.setup(logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Middleware to log incoming requests and their processing times
+# Middleware giving each request its own post loaders, so the posts it reads are hydrated in batches and once
+@app.middleware('http')
+async def hydration_scope(request: Request, call_next):
+    with hydration.scope():
+        return await call_next(request)
+
+# Middleware rate limiting each user per route and shedding load when the server is overloaded
+@app.middleware('http')
+async def admission_control(request: Request, call_next):
+    return await admission.admission_controller(request, call_next)
+
+# Middleware to log completed requests with their processing times and database queries (errors and slow requests
+# always, others sampled), and in debug mode to attach the query count and time to the response headers
 @app.middleware('http')
 async def log_requests(request: Request, call_next):
-    idem = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    logger.info(f"rid={idem} start request path={request.url.path}")
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = (time.time() - start_time) * 1000
-    formatted_process_time = '{0:.2f}'.format(process_time)
-    logger.info(f"rid={idem} completed_in={formatted_process_time}ms status_code={response.status_code}")
+    idem = logs.request_id()
+    start_time = time.perf_counter()
+    with querystats.track() as stats:
+        try:
+            response = await call_next(request)
+        except Exception:
+            logger.exception("request failed", extra={'fields': {'rid': idem, 'path': request.url.path}})
+            raise
+    logs.log_request(logger, idem, request.method, request.url.path, response.status_code, start_time,
+                     stats.count, round(stats.seconds * 1000, 2))
+    if constants.DEBUG:
+        response.headers.update(stats.headers())
     return response
 
+# Middleware selecting the community of each request by host name or '/c/<community>' path prefix
+@app.middleware('http')
+async def route_community(request: Request, call_next):
+    return await communities.dispatch(request, call_next)
+
+# Handlers opening and closing a community (the default one on startup, the others on first use and when idle):
+# connecting its database, preparing its schema and data, and running its background jobs
+@communities.on_open
+async def open_community():
+    community = communities.current()
+    await database.connect()
+    await schema.prepare()
+    community.start_task(schema.run())
+    await helper.ensure_user_stats()
+    await maps.ensure()
+    activity.activity_writer.start()
+    federation.delivery_queue.start()
+    community.start_task(changes.run_pruning())
+    community.start_task(suggestions.run())
+    storage.media_store.start()
+    await trending.tracker.start()
+    if constants.LIKE_BUFFERING:
+        likes.like_buffer.start()
+    jobs.runner.start()
+
+@communities.on_close
+async def close_community():
+    await jobs.runner.stop()
+    await storage.media_store.stop()
+    await trending.tracker.stop()
+    await likes.like_buffer.stop()
+    await activity.activity_writer.stop()
+    await federation.delivery_queue.stop()
+    await database.disconnect()
+
 # Event handlers for startup and shutdown
 @app.on_event("startup")
 async def startup():
-    await database.database.connect()
+    await communities.open_pinned()
+    app.state.evict_communities = asyncio.create_task(communities.run_eviction())
 
 @app.on_event("shutdown")
 async def shutdown():
-    await database.database.disconnect()
+    app.state.evict_communities.cancel()
+    await communities.close_all()
+    await remote.close()
+    provisioning.shutdown()
+    logs.shutdown()
 
 # API Routes
 
 # Util Routes --
 
-# Reset the database (for development purposes)
-@app.get("/reset_database")
+# Reset the database (for development purposes), as a job whose progress is shown by /admin/jobs/{job_id}
+@app.get("/reset_database", response_model=models.JobOut)
 async def reset_database():
-    await helper.reset_database()
+    return responses.RecordResponse(await jobs.runner.enqueue('reset_database'), models.JobOut)
 
 # Utility endpoint (for development/debugging purposes)
 @app.get("/util")
@@ -64,9 +140,44 @@ async def util():
     print("helping!")
     # Uncomment and use helper methods for various tasks
     # await helper.helper()
-    # await helper.populate_activity()
-    # await helper.fix_followers()
-    # await helper.update_password()
+    # The longer routines (populate_activity, fix_followers, update_password, create_avatars) run as jobs:
+    # POST /admin/jobs?kind=populate_activity
+
+# Admission control counters (admitted, in-flight and shed requests)
+@app.get("/util/admission")
+async def admission_stats():
+    return admission.admission_controller.stats()
+
+# Create users in bulk from an uploaded CSV (username,full_name,password header) or JSON lines file
+@app.post("/admin/users", status_code=status.HTTP_200_OK, response_model=models.ProvisionReport,
+          dependencies=[Depends(auth.verify_admin)])
+async def provision_users(file: UploadFile):
+    return await provisioning.provision(io.TextIOWrapper(file.file, encoding='utf-8', newline=''))
+
+# Queue a maintenance job (one of jobs.KINDS), or get the unfinished job of that kind
+@app.post("/admin/jobs", status_code=status.HTTP_202_ACCEPTED, response_model=models.JobOut,
+          dependencies=[Depends(auth.verify_admin)])
+async def start_job(kind: str):
+    return responses.RecordResponse(await jobs.runner.enqueue(kind), models.JobOut,
+                                    status_code=status.HTTP_202_ACCEPTED)
+
+# List the most recent jobs with their progress
+@app.get("/admin/jobs", status_code=status.HTTP_200_OK, response_model=List[models.JobOut],
+         dependencies=[Depends(auth.verify_admin)])
+async def list_jobs():
+    return responses.RecordResponse(await jobs.recent(), models.JobOut)
+
+# Get the progress of a job
+@app.get("/admin/jobs/{job_id}", status_code=status.HTTP_200_OK, response_model=models.JobOut,
+         dependencies=[Depends(auth.verify_admin)])
+async def get_job(job_id: int):
+    return responses.RecordResponse(await jobs.get(job_id), models.JobOut)
+
+# Cancel a queued or running job (the chunk in progress is rolled back)
+@app.post("/admin/jobs/{job_id}/cancel", status_code=status.HTTP_200_OK, response_model=models.JobOut,
+          dependencies=[Depends(auth.verify_admin)])
+async def cancel_job(job_id: int):
+    return responses.RecordResponse(await jobs.runner.cancel(job_id), models.JobOut)
 
 # Auth Routes --
 
@@ -85,23 +196,42 @@ async def create_user(user: models.UserIn):
 
 # Get the current user's profile
 @app.get("/client/me", status_code=status.HTTP_200_OK, response_model=models.UserOut)
-async def get_me(current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.get_user_profile(current_user.username, current_user)
+async def get_me(request: Request, cursor: str = None,
+                 limit: int = Query(constants.PAGE_SIZE, ge=1, le=constants.MAX_PAGE_SIZE),
+                 current_user: models.User = Depends(auth.get_current_active_user)):
+    etag = versions.profile_etag(current_user.username, current_user.username, "{}:{}".format(cursor, limit))
+    if versions.not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    with database.primary_reads():
+        profile = await methods.get_user_profile(current_user.username, current_user, cursor, limit)
+    return responses.RecordResponse(profile, models.UserOut, headers={"ETag": etag})
 
 # Get a user's profile by username
 @app.get("/client/users", status_code=status.HTTP_200_OK, response_model=models.UserOut)
-async def get_user_profile(username: str, current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.get_user_profile(username, current_user)
+async def get_user_profile(request: Request, username: str, cursor: str = None,
+                           limit: int = Query(constants.PAGE_SIZE, ge=1, le=constants.MAX_PAGE_SIZE),
+                           current_user: models.User = Depends(auth.get_current_active_user)):
+    etag = versions.profile_etag(username, current_user.username, "{}:{}".format(cursor, limit))
+    if versions.not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    with database.primary_reads():
+        profile = await methods.get_user_profile(username, current_user, cursor, limit)
+    return responses.RecordResponse(profile, models.UserOut, headers={"ETag": etag})
 
 # Get user's activity
 @app.get("/client/activity", status_code=status.HTTP_200_OK, response_model=List[models.ActivityOut])
-async def get_activity(current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.get_activity(current_user)
+async def get_activity(request: Request, current_user: models.User = Depends(auth.get_current_active_user)):
+    etag = versions.activity_etag(current_user.username)
+    if versions.not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    with database.primary_reads():
+        activity = await methods.get_activity(current_user)
+    return responses.RecordResponse(activity, models.ActivityOut, headers={"ETag": etag})
 
 # Search for users
 @app.get("/client/search", status_code=status.HTTP_200_OK, response_model=List[models.SearchUser])
 async def search_users(search_query: str, current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.search_users(search_query, current_user)
+    return responses.RecordResponse(await methods.search_users(search_query, current_user), models.SearchUser)
 
 # Follow a user
 @app.post("/client/follow", status_code=status.HTTP_201_CREATED)
@@ -123,6 +253,21 @@ async def get_following(current_user: models.User = Depends(auth.get_current_act
 async def create_bio(bio: str, current_user: models.User = Depends(auth.get_current_active_user)):
     return await methods.create_bio(bio, current_user)
 
+# Get accounts the user may want to follow (followed by the accounts they follow)
+@app.get("/client/suggestions", status_code=status.HTTP_200_OK, response_model=List[models.SuggestedUser])
+async def get_suggestions(current_user: models.User = Depends(auth.get_current_active_user)):
+    return responses.RecordResponse(await methods.get_suggestions(current_user), models.SuggestedUser)
+
+# Download all of the user's data (posts, comments, likes, follows, activity and media) as a zip archive
+@app.get("/client/export", status_code=status.HTTP_200_OK)
+async def export_data(current_user: models.User = Depends(auth.get_current_active_user)):
+    if not export.acquire():
+        raise exceptions.API_503_EXPORT_BUSY_EXCEPTION
+    body = export.stream(current_user)
+    await body.__anext__()
+    return StreamingResponse(body, media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="stringshare-export.zip"'})
+
 # Update user's avatar
 @app.post("/client/avatar", status_code=status.HTTP_201_CREATED)
 async def update_avatar(file: UploadFile, current_user: models.User = Depends(auth.get_current_active_user)):
@@ -132,8 +277,37 @@ async def update_avatar(file: UploadFile, current_user: models.User = Depends(au
 
 # Get the user's feed
 @app.get("/client/posts", status_code=status.HTTP_200_OK, response_model=List[models.PostOut])
-async def get_feed(current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.get_feed(current_user)
+async def get_feed(request: Request, current_user: models.User = Depends(auth.get_current_active_user)):
+    etag = await versions.feed_etag(current_user.username)
+    if versions.not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    with database.primary_reads():
+        feed = await methods.get_feed(current_user)
+    return responses.RecordResponse(feed, models.PostOut, headers={"ETag": etag})
+
+# Get what changed in the user's feed since a watermark returned by a previous call (0 for everything retained)
+@app.get("/client/sync", status_code=status.HTTP_200_OK, response_model=models.SyncOut)
+async def sync_feed(since: int = 0, current_user: models.User = Depends(auth.get_current_active_user)):
+    return responses.RecordResponse(await methods.sync_feed(current_user, since), models.SyncOut)
+
+# Get the posts with the most recent likes and comments, across all users
+@app.get("/client/trending", status_code=status.HTTP_200_OK, response_model=List[models.PostOut])
+async def get_trending(limit: int = Query(min(20, constants.TRENDING_SIZE), ge=1, le=constants.TRENDING_SIZE),
+                       current_user: models.User = Depends(auth.get_current_active_user)):
+    return responses.RecordResponse(await methods.get_trending(current_user, limit), models.PostOut)
+
+# Get clusters of posts (count, mean position and newest post) in a map viewport at a zoom level
+@app.get("/client/map", status_code=status.HTTP_200_OK, response_model=List[models.MapCluster])
+async def get_map_clusters(
+        south: float = Query(..., ge=-90, le=90),
+        west: float = Query(..., ge=-180, le=180),
+        north: float = Query(..., ge=-90, le=90),
+        east: float = Query(..., ge=-180, le=180),
+        zoom: int = Query(..., ge=0),
+        current_user: models.User = Depends(auth.get_current_active_user)
+):
+    clusters = await methods.get_map_clusters(south, west, north, east, zoom, current_user)
+    return responses.RecordResponse(clusters, models.MapCluster)
 
 # Get details of a specific post
 @app.get("/client/post", status_code=status.HTTP_200_OK, response_model=models.PostOut)
@@ -143,12 +317,16 @@ async def get_post(post_id: UUID, current_user: models.User = Depends(auth.get_c
 # Get likes for a post
 @app.get("/client/likes", status_code=status.HTTP_200_OK, response_model=List[models.LikeOut])
 async def get_post_likes(post_id: UUID, current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.get_post_likes(post_id)
+    return responses.RecordResponse(await methods.get_post_likes(post_id), models.LikeOut)
 
 # Get comments for a post
 @app.get("/client/comments", status_code=status.HTTP_200_OK, response_model=List[models.CommentOut])
-async def get_comments(post_id: UUID, current_user: models.User = Depends(auth.get_current_active_user)):
-    return await methods.get_post_comments(post_id)
+async def get_comments(post_id: UUID, cursor: str = None,
+                       limit: int = Query(constants.PAGE_SIZE, ge=1, le=constants.MAX_PAGE_SIZE),
+                       current_user: models.User = Depends(auth.get_current_active_user)):
+    comments, next_cursor = await methods.get_post_comments(post_id, cursor, limit)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return responses.RecordResponse(comments, models.CommentOut, headers=headers)
 
 # Create a new post
 @app.post("/client/post", status_code=status.HTTP_201_CREATED)
@@ -173,9 +351,43 @@ async def create_like(post_id: UUID, current_user: models.User = Depends(auth.ge
 
 # Get a photo (avatar or post image)
 @app.get("/client/media/", status_code=status.HTTP_200_OK)
-async def get_photo(url: str = None):
-    path = os.path.join(constants.MEDIA_ROOT, url)
-    if os.path.isfile(path):
-        return FileResponse(path)
-    else:
-        raise exceptions.API_404_NOT_FOUND_EXCEPTION
+async def get_photo(url: str):
+    # Media of other communities (absolute URLs of peers, or stored avatars and images) are served from the remote
+    # media cache
+    if '://' in url:
+        return FileResponse(await remote.get_media(url))
+    return FileResponse(storage.media_store.path(url))
+
+# Server Routes (requests from other communities) --
+
+# Search local users on behalf of a user of another community
+@app.post("/server/search", status_code=status.HTTP_200_OK, response_model=List[models.SearchUser],
+          dependencies=[Depends(federation.verify_peer)])
+async def server_search_users(search: models.ServerSearchUser):
+    return responses.RecordResponse(await methods.server_search_users(search), models.SearchUser)
+
+# Get the profile of a local user for another community
+@app.get("/server/users", status_code=status.HTTP_200_OK, response_model=models.ServerUser,
+         dependencies=[Depends(federation.verify_peer)])
+async def server_get_user(username: str):
+    return await federation.server_user(username.lower())
+
+# Follow a local user from another community
+@app.post("/server/follow", status_code=status.HTTP_201_CREATED, dependencies=[Depends(federation.verify_peer)])
+async def server_follow_user(event: models.ServerFollowUser):
+    await methods.receive_follow(event)
+
+# Like a local post from another community
+@app.post("/server/like", status_code=status.HTTP_201_CREATED, dependencies=[Depends(federation.verify_peer)])
+async def server_create_like(event: models.ServerLike):
+    await methods.receive_like(event)
+
+# Comment on a local post from another community
+@app.post("/server/comment", status_code=status.HTTP_201_CREATED, dependencies=[Depends(federation.verify_peer)])
+async def server_create_comment(event: models.ServerComment):
+    await methods.receive_comment(event)
+
+# Apply a batch of follows, likes and comments delivered by another community
+@app.post("/server/batch", status_code=status.HTTP_201_CREATED, dependencies=[Depends(federation.verify_peer)])
+async def server_batch(batch: models.ServerBatch):
+    await methods.receive_batch(batch)
@@ -0,0 +1,141 @@
+# Importing necessary modules and components
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import aiofiles
+from sqlalchemy.sql import select, union
+from database import database
+from constants import MEDIA_ROOT, MEDIA_GC_GRACE_SECONDS, MEDIA_GC_INTERVAL, MEDIA_GC_SHARD_DELAY, MEDIA_GC_DELETE_RATE
+import communities
+import exceptions
+import tables
+
+logger = logging.getLogger(__name__)
+
+HEX_DIGITS = set('0123456789abcdef')
+
+
+# Function telling whether a directory name is a shard (two hex digits)
+def _is_shard(name: str):
+    return len(name) == 2 and set(name) <= HEX_DIGITS
+
+
+# Content-addressed media store. Files are named by the SHA-256 of their content and sharded into two levels of
+# directories ('ab/cd/abcd....jpg'), so identical uploads are stored once and no directory grows too large.
+# Files no longer referenced by post_images or users are removed by an incremental mark-and-sweep, one shard
+# at a time and at a limited rate. Older flat files (named by post id or username) are still served but never swept.
+class MediaStore:
+    def __init__(self, root: str = MEDIA_ROOT, grace: float = MEDIA_GC_GRACE_SECONDS,
+                 interval: float = MEDIA_GC_INTERVAL, shard_delay: float = MEDIA_GC_SHARD_DELAY,
+                 delete_rate: float = MEDIA_GC_DELETE_RATE):
+        self.root = root
+        # Files written or reused within 'grace' seconds are never swept, so a file saved by a request whose
+        # database row is not committed yet is not mistaken for garbage
+        self.grace = grace
+        self.interval = interval
+        self.shard_delay = shard_delay
+        self.delete_rate = delete_rate
+        self._task = None
+
+    # Function to get the local path of a media URL, refusing paths outside of the store
+    def path(self, url: str):
+        path = os.path.realpath(os.path.join(self.root, url))
+        if not path.startswith(os.path.realpath(self.root) + os.sep) or not os.path.isfile(path):
+            raise exceptions.API_404_NOT_FOUND_EXCEPTION
+        return path
+
+    # Asynchronous function to store content and return its URL, reusing the existing file for identical content
+    async def save(self, content: bytes, extension: str = ''):
+        digest = hashlib.sha256(content).hexdigest()
+        url = '/'.join((digest[:2], digest[2:4], digest + extension.lower()))
+        path = os.path.join(self.root, url)
+        if os.path.exists(path):
+            # Refreshing the modification time so the sweep treats the file as recently written
+            os.utime(path)
+            return url
+
+        # Writing to a temporary file first so readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "{}.{}.part".format(path, os.urandom(4).hex())
+        async with aiofiles.open(temporary, "wb") as out_file:
+            await out_file.write(content)
+        os.replace(temporary, path)
+        return url
+
+    # Generator of the leaf shards ('ab/cd') of the store
+    def shards(self):
+        if not os.path.isdir(self.root):
+            return
+        for first in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, first)
+            if _is_shard(first) and os.path.isdir(directory):
+                for second in sorted(os.listdir(directory)):
+                    if _is_shard(second) and os.path.isdir(os.path.join(directory, second)):
+                        yield first + '/' + second
+
+    # Asynchronous function to sweep one shard: marking the files still referenced with one query,
+    # then removing the others, returning how many files were removed
+    async def collect(self, shard: str):
+        cutoff = time.time() - self.grace
+        candidates = {}
+        with os.scandir(os.path.join(self.root, shard)) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    candidates[shard + '/' + entry.name] = entry.path
+        if not candidates:
+            return 0
+
+        urls = list(candidates)
+        query = union(
+            select([tables.post_images.c.image_url.label('url')]).where(tables.post_images.c.image_url.in_(urls)),
+            select([tables.users.c.avatar_url.label('url')]).where(tables.users.c.avatar_url.in_(urls))
+        )
+        referenced = {row['url'] for row in await database.fetch_all(query)}
+
+        removed = 0
+        for url, path in candidates.items():
+            if url in referenced:
+                continue
+            try:
+                # Checking again in case an identical upload reused the file since the shard was listed
+                if os.stat(path).st_mtime >= time.time() - self.grace:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            await asyncio.sleep(1 / self.delete_rate)
+        return removed
+
+    # Background task sweeping every shard, pausing between shards, then waiting 'interval' seconds for the next pass
+    async def run(self):
+        while True:
+            removed = 0
+            for shard in self.shards():
+                try:
+                    removed += await self.collect(shard)
+                except Exception:
+                    logger.exception("failed to collect media shard %s", shard)
+                await asyncio.sleep(self.shard_delay)
+            logger.info("media collection removed %d files", removed)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+# Store of the current community, shared by the upload methods and the media route
+media_store = communities.PerCommunity(lambda community: MediaStore(root=community.media_root))
@@ -0,0 +1,174 @@
+# Importing necessary modules and components
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, List
+from sqlalchemy.sql import select, exists, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from database import database, read_database
+from constants import SUGGESTIONS_SIZE, SUGGESTIONS_CHUNK, SUGGESTIONS_FANOUT, SUGGESTIONS_INTERVAL, \
+    SUGGESTIONS_CHUNK_DELAY
+import communities
+import tables
+
+logger = logging.getLogger(__name__)
+
+
+# Function to build the statement storing the candidate lists of several users, along with the time they were
+# computed, unless they were only adjusted (then the users are still refreshed on time)
+def store_query(candidates: Dict[str, List[dict]], computed: bool = True):
+    query = pg_insert(tables.follow_suggestions).values([
+        {'username': username, 'candidates': users, 'updated': func.now() if computed else None}
+        for username, users in candidates.items()
+    ])
+    return query.on_conflict_do_update(
+        index_elements=[tables.follow_suggestions.c.username],
+        set_={'candidates': query.excluded.candidates,
+              'updated': func.now() if computed else tables.follow_suggestions.c.updated}
+    )
+
+
+# Function to describe a candidate from a row of the users table
+def _candidate(row, mutuals: int = 0):
+    return {'username': row['username'], 'full_name': row['full_name'], 'avatar_url': row['avatar_url'],
+            'mutuals': mutuals}
+
+
+# Function to order candidates by mutual follows (then username) and keep the best ones
+def _rank(candidates):
+    return sorted(candidates, key=lambda user: (-user['mutuals'], user['username']))[:SUGGESTIONS_SIZE]
+
+
+# Asynchronous function computing the suggestions of a chunk of users: the accounts followed by the accounts they
+# follow, ranked by how many of those follow them, topped up with the most followed accounts
+async def compute(usernames: List[str], popular: List[dict]):
+    followed, friend, known = (tables.following.alias(name) for name in ('followed', 'friend', 'known'))
+
+    mutuals = select([
+        followed.c.user,
+        friend.c.following.label('candidate'),
+        func.count().label('mutuals')
+    ]).select_from(
+        followed.join(friend, friend.c.user == followed.c.following)
+    ).where(
+        followed.c.user.in_(usernames),
+        friend.c.following != followed.c.user,
+        ~exists().where(and_(known.c.user == followed.c.user, known.c.following == friend.c.following))
+    ).group_by(followed.c.user, friend.c.following).subquery()
+
+    ranked = select([
+        mutuals,
+        func.row_number().over(
+            partition_by=mutuals.c.user,
+            order_by=(mutuals.c.mutuals.desc(), mutuals.c.candidate)
+        ).label('rank')
+    ]).subquery()
+
+    query = select([
+        ranked.c.user,
+        ranked.c.candidate.label('username'),
+        ranked.c.mutuals,
+        tables.users.c.full_name,
+        tables.users.c.avatar_url
+    ]).select_from(
+        ranked.join(tables.users, tables.users.c.username == ranked.c.candidate)
+    ).where(ranked.c.rank <= SUGGESTIONS_SIZE)
+
+    db = read_database()
+    candidates = {username: [] for username in usernames}
+    for row in await db.fetch_all(query):
+        candidates[row['user']].append(_candidate(row, row['mutuals']))
+
+    # Topping up short lists with popular accounts the user does not follow yet
+    short = [username for username, users in candidates.items() if len(users) < SUGGESTIONS_SIZE]
+    if short and popular:
+        query = select([tables.following.c.user, tables.following.c.following]).where(
+            tables.following.c.user.in_(short),
+            tables.following.c.following.in_([user['username'] for user in popular])
+        )
+        following = {(row['user'], row['following']) for row in await db.fetch_all(query)}
+        for username in short:
+            users = candidates[username]
+            excluded = {user['username'] for user in users}
+            users.extend(user for user in popular if user['username'] != username and user['username'] not in excluded
+                         and (username, user['username']) not in following)
+            candidates[username] = users[:SUGGESTIONS_SIZE]
+    return candidates
+
+
+# Asynchronous function to get the most followed accounts (used to top up short lists)
+async def popular_users():
+    query = select([
+        tables.users.c.username,
+        tables.users.c.full_name,
+        tables.users.c.avatar_url
+    ]).select_from(
+        tables.user_stats.join(tables.users, tables.users.c.username == tables.user_stats.c.username)
+    ).order_by(tables.user_stats.c.followers.desc()).limit(SUGGESTIONS_SIZE + 1)
+    return [_candidate(row) for row in await read_database().fetch_all(query)]
+
+
+# Asynchronous function refreshing the suggestions of the local users (usernames ending with '@' and the name of the
+# community) not refreshed within SUGGESTIONS_INTERVAL, one chunk of users at a time, so reopening a community does
+# not compute them all again
+async def refresh():
+    popular = await popular_users()
+    suffix = '@' + communities.current().name
+    stale = func.now() - timedelta(seconds=SUGGESTIONS_INTERVAL)
+    last = ''
+    while True:
+        query = select([tables.users.c.username]).select_from(
+            tables.users.outerjoin(tables.follow_suggestions,
+                                   tables.follow_suggestions.c.username == tables.users.c.username)
+        ).where(
+            tables.users.c.username > last,
+            tables.users.c.username.endswith(suffix, autoescape=True),
+            or_(tables.follow_suggestions.c.updated.is_(None), tables.follow_suggestions.c.updated < stale)
+        ).order_by(tables.users.c.username).limit(SUGGESTIONS_CHUNK)
+        usernames = [row['username'] for row in await read_database().fetch_all(query)]
+        if not usernames:
+            return
+        await database.execute(store_query(await compute(usernames, popular)))
+        last = usernames[-1]
+        await asyncio.sleep(SUGGESTIONS_CHUNK_DELAY)
+
+
+# Asynchronous function updating a user's suggestions after they followed 'username': dropping it, and counting
+# a mutual follow for each account it follows. The user's row is created if needed and locked first, so concurrent
+# follows of the same user update it one after the other instead of overwriting each other's changes.
+async def followed(user: str, username: str):
+    async with database.transaction():
+        await database.execute(pg_insert(tables.follow_suggestions).values(
+            username=user, candidates=[], updated=None).on_conflict_do_nothing())
+        row = await database.fetch_one(select([tables.follow_suggestions.c.candidates]).where(
+            tables.follow_suggestions.c.username == user).with_for_update())
+        candidates = {candidate['username']: candidate for candidate in row['candidates']}
+        candidates.pop(username, None)
+
+        known = tables.following.alias('known')
+        query = select([
+            tables.users.c.username,
+            tables.users.c.full_name,
+            tables.users.c.avatar_url
+        ]).select_from(
+            tables.following.join(tables.users, tables.users.c.username == tables.following.c.following)
+        ).where(
+            tables.following.c.user == username,
+            tables.following.c.following != user,
+            ~exists().where(and_(known.c.user == user, known.c.following == tables.following.c.following))
+        ).limit(SUGGESTIONS_FANOUT)
+        for row in await database.fetch_all(query):
+            candidate = candidates.setdefault(row['username'], _candidate(row))
+            candidate['mutuals'] += 1
+
+        await database.execute(store_query({user: _rank(candidates.values())}, computed=False))
+
+
+# Background task refreshing the suggestions every SUGGESTIONS_INTERVAL seconds
+async def run():
+    while True:
+        try:
+            await refresh()
+        except Exception:
+            logger.exception("failed to refresh follow suggestions")
+        await asyncio.sleep(SUGGESTIONS_INTERVAL)
@@ -1,9 +1,11 @@
 # Importing necessary modules and classes from SQLAlchemy
-from sqlalchemy import Column, Integer, String, Boolean, Table, MetaData, Enum, Float, ForeignKey, DateTime, func
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Table, MetaData, Enum, Float, ForeignKey, DateTime, JSON, \
+    Index, DDL, event, func, text
 from sqlalchemy.dialects.postgresql import UUID
 
-# Importing models module
+# Importing models and constants modules
 import models
+from constants import ACTIVITY_PARTITIONING, MAP_MAX_ZOOM, MAP_CELL_BITS
 
 # Creating a metadata object to hold the information about database tables
 metadata = MetaData()
@@ -15,6 +17,7 @@ users = Table('users', metadata,
     Column('avatar_url', String(500)),  # URL for the user's avatar (could be stored on other servers)
     Column('bio', String(500)),  # Biography or description of the user
     # Column('server', String(100)),  # Uncomment if storing information about the server
+    Index('ix_users_avatar_url', 'avatar_url'),  # Lets the media sweep find referenced files
 )
 
 # Defining the 'user_credentials' table
@@ -32,6 +35,7 @@ posts = Table('posts', metadata,
     Column('username', String(100), ForeignKey('users.username', ondelete='cascade')),  # User who made the post
     Column('content', String(1000)),  # Content of the post
     Column('date_posted', DateTime, server_default=func.now()),  # Date and time when the post was made
+    Index('ix_posts_username_date_posted', 'username', 'date_posted'),  # Profile pages and feeds, newest first
 )
 
 # Defining the 'post_locations' table
@@ -39,18 +43,21 @@ post_locations = Table('post_locations', metadata,
     Column('post_id', UUID, ForeignKey('posts.post_id', ondelete='cascade'), primary_key=True),
     Column('latitude', Float),  # Latitude information for post location
     Column('longitude', Float),  # Longitude information for post location
+    Index('ix_post_locations_latitude_longitude', 'latitude', 'longitude'),  # Locations within a map cell
 )
 
 # Defining the 'post_images' table
 post_images = Table('post_images', metadata,
     Column('post_id', UUID, ForeignKey('posts.post_id', ondelete='cascade'), primary_key=True),
     Column('image_url', String(500), primary_key=True),  # URL for post images
+    Index('ix_post_images_image_url', 'image_url'),  # Lets the media sweep find referenced files
 )
 
 # Defining the 'likes' table
 likes = Table('likes', metadata,
     Column('post_id', UUID, ForeignKey('posts.post_id', ondelete='cascade'), primary_key=True),
     Column('username', ForeignKey('users.username', ondelete='cascade'), primary_key=True),
+    Index('ix_likes_username', 'username'),  # Likes of a user (and deleting them with the user)
 )
 
 # Defining the 'comments' table
@@ -60,6 +67,7 @@ comments = Table('comments', metadata,
     Column('username', String(100), ForeignKey('users.username', ondelete='cascade')),  # User who made the comment
     Column('content', String(1000)),  # Content of the comment
     Column('date_posted', DateTime, server_default=func.now()),  # Date and time when the comment was made
+    Index('ix_comments_post_id_date_posted', 'post_id', 'date_posted'),  # Comments of a post, newest first
 )
 
 # Defining the 'followers' table
@@ -74,12 +82,169 @@ following = Table('following', metadata,
     Column('following', String(100), ForeignKey('users.username', ondelete='cascade'), primary_key=True),
 )
 
-# Defining the 'activity' table
+# Defining the 'activity' table, optionally partitioned by month (the partition key then has to be in the primary key)
 activity = Table('activity', metadata,
     Column('action_id', UUID, primary_key=True, server_default=func.gen_random_uuid()),  # Unique identifier for actions
     Column('user', String(100), ForeignKey('users.username', ondelete='cascade'), primary_key=True),  # User involved in the action
     Column('action_user', String(100), ForeignKey('users.username', ondelete='cascade')),  # User performing the action
     Column('action', Enum(models.ActivityAction), primary_key=True, default=None),  # Type of action (enum from the models module)
     Column('post_id', ForeignKey('posts.post_id', ondelete='cascade'), default=None),  # Post associated with the action
-    Column('datetime', DateTime, server_default=func.now()),  # Date and time when the action occurred
+    Column('datetime', DateTime, server_default=func.now(), primary_key=ACTIVITY_PARTITIONING),  # Date and time when the action occurred
+    Index('ix_activity_user_datetime', 'user', 'datetime'),  # Activity of a user, newest first
+    **({'postgresql_partition_by': 'RANGE (datetime)'} if ACTIVITY_PARTITIONING else {})
 )
+
+
+# Defining the 'user_stats' table (follower and following counters maintained by follow_user)
+user_stats = Table('user_stats', metadata,
+    Column('username', String(100), ForeignKey('users.username', ondelete='cascade'), primary_key=True),
+    Column('followers', Integer, nullable=False, server_default='0'),  # Number of users following this user
+    Column('following', Integer, nullable=False, server_default='0'),  # Number of users this user follows
+)
+
+
+# Defining the 'federation_outbox' table (events waiting to be delivered to other communities)
+federation_outbox = Table('federation_outbox', metadata,
+    Column('event_id', BigInteger, primary_key=True, autoincrement=True),  # Delivery order
+    Column('destination', String(100), nullable=False, index=True),  # Community the event is sent to
+    Column('kind', String(20), nullable=False),  # Kind of event ('follows', 'likes' or 'comments')
+    Column('payload', JSON, nullable=False),  # The ServerFollowUser / ServerLike / ServerComment body
+    Column('attempts', Integer, nullable=False, server_default='0'),  # Failed delivery attempts so far
+    Column('next_attempt', DateTime, nullable=False, server_default=func.now()),  # Earliest time of the next attempt
+)
+
+
+# Defining the 'post_changes' table (change log read by the feed sync endpoint). Rows outlive their posts, so
+# there are no foreign keys.
+post_changes = Table('post_changes', metadata,
+    Column('change_id', BigInteger, primary_key=True, autoincrement=True),  # Order of the changes
+    Column('txid', BigInteger, nullable=False, server_default=text('txid_current()')),  # Transaction of the change
+    Column('post_id', UUID, nullable=False),  # Post that changed
+    Column('username', String(100), nullable=False),  # Author of the post, to select the changes of a feed
+    Column('kind', String(20), nullable=False),  # 'post' (new post), 'counters' (likes/comments) or 'deleted'
+    Column('created', DateTime, server_default=func.now()),  # Date and time of the change
+    Index('ix_post_changes_username_txid', 'username', 'txid'),
+    Index('ix_post_changes_txid', 'txid'),
+)
+
+# Defining the 'follow_changes' table (users whose followed accounts changed, so their feed sync starts over)
+follow_changes = Table('follow_changes', metadata,
+    Column('change_id', BigInteger, primary_key=True, autoincrement=True),  # Order of the changes
+    Column('txid', BigInteger, nullable=False, server_default=text('txid_current()')),  # Transaction of the change
+    Column('username', String(100), nullable=False),  # User who followed someone
+    Column('created', DateTime, server_default=func.now()),  # Date and time of the change
+    Index('ix_follow_changes_username_txid', 'username', 'txid'),
+)
+
+# Defining the 'trending_scores' table (checkpoint of the in-memory trending scores, decayed from 'updated')
+trending_scores = Table('trending_scores', metadata,
+    Column('post_id', UUID, primary_key=True),  # Post being scored (rows of deleted posts are skipped on load)
+    Column('score', Float, nullable=False),  # Time-decayed score at the time of the checkpoint
+    Column('updated', DateTime, server_default=func.now()),  # Date and time of the checkpoint
+)
+
+# Defining the 'follow_suggestions' table (precomputed accounts to suggest to each user)
+follow_suggestions = Table('follow_suggestions', metadata,
+    Column('username', String(100), ForeignKey('users.username', ondelete='cascade'), primary_key=True),
+    Column('candidates', JSON, nullable=False),  # Suggested users with their number of mutual follows, best first
+    Column('updated', DateTime, server_default=func.now()),  # Date and time of the last refresh (None before it)
+)
+
+# Defining the 'map_cells' table (post locations aggregated on a grid at every zoom level, for map clusters)
+map_cells = Table('map_cells', metadata,
+    Column('zoom', Integer, primary_key=True),  # Zoom level of the grid
+    Column('cell_x', Integer, primary_key=True),  # Column of the cell, west to east
+    Column('cell_y', Integer, primary_key=True),  # Row of the cell, north to south
+    Column('count', Integer, nullable=False),  # Number of posts in the cell
+    Column('latitude_sum', Float, nullable=False),  # Sums of the coordinates, to place the cluster at their mean
+    Column('longitude_sum', Float, nullable=False),
+    Column('post_id', UUID),  # Newest post of the cell, shown for the cluster
+)
+
+# Defining the 'jobs' table (maintenance routines run in chunks by the job runner, resumed after a restart)
+jobs = Table('jobs', metadata,
+    Column('job_id', BigInteger, primary_key=True, autoincrement=True),  # Unique identifier for jobs
+    Column('kind', String(50), nullable=False),  # Routine run by the job (see jobs.KINDS)
+    Column('state', String(20), nullable=False, index=True),  # 'queued', 'running', 'done', 'failed' or 'cancelled'
+    Column('cursor', JSON, nullable=False),  # Position the next chunk starts from
+    Column('done', Integer, nullable=False, server_default='0'),  # Number of rows processed so far
+    Column('error', String(1000)),  # Error that made the job fail
+    Column('created', DateTime, server_default=func.now()),  # Date and time when the job was queued
+    Column('updated', DateTime, server_default=func.now()),  # Date and time of the last chunk or heartbeat
+    Column('owner', String(32)),  # Token of the runner running the job
+)
+
+# Logging deleted posts (including those removed by ON DELETE CASCADE) with a trigger on 'posts', (re)installed
+# after every create_all so existing databases get it too
+event.listen(metadata, 'after_create', DDL("""
+CREATE OR REPLACE FUNCTION log_post_deletion() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO post_changes (post_id, username, kind) VALUES (OLD.post_id, OLD.username, 'deleted');
+    RETURN OLD;
+END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS post_deleted ON posts;
+CREATE TRIGGER post_deleted AFTER DELETE ON posts FOR EACH ROW EXECUTE PROCEDURE log_post_deletion();
+"""))
+
+# Taking deleted post locations (including those removed with their posts) out of the map cells at every zoom level,
+# dropping emptied cells and choosing the newest remaining post of cells the deleted post represented (among the
+# locations within the cell's bounds, so only the cell is read). map_cell computes the same cells as
+# maps.cell_columns, and map_cell_bounds their edges, widened a little against rounding (the edge cells of the grid
+# also hold the points beyond it).
+event.listen(metadata, 'after_create', DDL("""
+CREATE OR REPLACE FUNCTION map_cell(latitude double precision, longitude double precision, zoom integer,
+                                    OUT cell_x integer, OUT cell_y integer) AS $$
+    SELECT least(greatest(floor((longitude + 180) / 360 * n), 0), n - 1)::integer,
+           least(greatest(floor((1 - ln(tan(lat) + 1 / cos(lat)) / pi()) / 2 * n), 0), n - 1)::integer
+    FROM (SELECT power(2, zoom + {cell_bits}) AS n,
+                 radians(greatest(least(latitude, 85.0511), -85.0511)) AS lat) AS grid
+$$ LANGUAGE sql IMMUTABLE;
+CREATE OR REPLACE FUNCTION map_cell_bounds(zoom integer, cell_x integer, cell_y integer,
+                                           OUT south double precision, OUT north double precision,
+                                           OUT west double precision, OUT east double precision) AS $$
+    SELECT CASE WHEN cell_y = n - 1 THEN '-infinity'
+                ELSE degrees(2 * atan(exp(pi() * (1 - 2 * (cell_y + 1) / n))) - pi() / 2) - 1e-9 END,
+           CASE WHEN cell_y = 0 THEN 'infinity'
+                ELSE degrees(2 * atan(exp(pi() * (1 - 2 * cell_y / n))) - pi() / 2) + 1e-9 END,
+           CASE WHEN cell_x = 0 THEN '-infinity' ELSE cell_x / n * 360 - 180 - 1e-9 END,
+           CASE WHEN cell_x = n - 1 THEN 'infinity' ELSE (cell_x + 1) / n * 360 - 180 + 1e-9 END
+    FROM (SELECT power(2, zoom + {cell_bits}) AS n) AS grid
+$$ LANGUAGE sql IMMUTABLE;
+CREATE OR REPLACE FUNCTION unmap_post_location() RETURNS trigger AS $$
+DECLARE
+    cell record;
+    remaining integer;
+    represented uuid;
+BEGIN
+    IF OLD.latitude IS NULL OR OLD.longitude IS NULL THEN
+        RETURN OLD;
+    END IF;
+    FOR cell IN SELECT levels.zoom, located.cell_x, located.cell_y
+                FROM generate_series(0, {max_zoom}) AS levels(zoom),
+                     map_cell(OLD.latitude, OLD.longitude, levels.zoom) AS located LOOP
+        UPDATE map_cells SET count = map_cells.count - 1,
+                             latitude_sum = map_cells.latitude_sum - OLD.latitude,
+                             longitude_sum = map_cells.longitude_sum - OLD.longitude
+            WHERE map_cells.zoom = cell.zoom AND map_cells.cell_x = cell.cell_x AND map_cells.cell_y = cell.cell_y
+            RETURNING map_cells.count, map_cells.post_id INTO remaining, represented;
+        IF remaining <= 0 THEN
+            DELETE FROM map_cells
+                WHERE map_cells.zoom = cell.zoom AND map_cells.cell_x = cell.cell_x AND map_cells.cell_y = cell.cell_y;
+        ELSIF represented = OLD.post_id THEN
+            UPDATE map_cells SET post_id = (
+                    SELECT posts.post_id
+                    FROM map_cell_bounds(cell.zoom, cell.cell_x, cell.cell_y) AS bounds,
+                         post_locations JOIN posts ON posts.post_id = post_locations.post_id,
+                         map_cell(post_locations.latitude, post_locations.longitude, cell.zoom) AS located
+                    WHERE post_locations.latitude BETWEEN bounds.south AND bounds.north
+                    AND post_locations.longitude BETWEEN bounds.west AND bounds.east
+                    AND located.cell_x = cell.cell_x AND located.cell_y = cell.cell_y
+                    ORDER BY posts.date_posted DESC LIMIT 1)
+                WHERE map_cells.zoom = cell.zoom AND map_cells.cell_x = cell.cell_x AND map_cells.cell_y = cell.cell_y;
+        END IF;
+    END LOOP;
+    RETURN OLD;
+END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS post_location_deleted ON post_locations;
+CREATE TRIGGER post_location_deleted AFTER DELETE ON post_locations FOR EACH ROW EXECUTE PROCEDURE unmap_post_location();
+""".format(cell_bits=MAP_CELL_BITS, max_zoom=MAP_MAX_ZOOM)))
@@ -0,0 +1,165 @@
+# Importing necessary modules and components
+import asyncio
+import heapq
+import logging
+import time
+from operator import itemgetter
+from typing import Dict
+from uuid import UUID
+from sqlalchemy.sql import select, insert, delete, func
+from database import database
+from constants import TRENDING_SIZE, TRENDING_CAPACITY, TRENDING_HALF_LIFE, TRENDING_REFRESH_SECONDS, \
+    TRENDING_CHECKPOINT_INTERVAL, TRENDING_LIKE_WEIGHT
+import communities
+import tables
+
+logger = logging.getLogger(__name__)
+
+
+# Tracker of time-decayed post scores. Each like or comment adds its weight scaled by 2^(age / half_life) relative
+# to a reference time, so older scores never need to be decayed one by one and the order stays correct over time.
+# Only the 'capacity' best posts are kept, and the top 'size' list is recomputed at most every 'refresh' seconds,
+# so reading it costs O(size). The weight each like added is kept, so removing the like takes back exactly that
+# weight rather than a like's weight at the current (larger) scale.
+class TrendingTracker:
+    def __init__(self, size: int = TRENDING_SIZE, capacity: int = TRENDING_CAPACITY,
+                 half_life: float = TRENDING_HALF_LIFE, refresh: float = TRENDING_REFRESH_SECONDS,
+                 checkpoint_interval: float = TRENDING_CHECKPOINT_INTERVAL):
+        self.size = size
+        self.capacity = capacity
+        self.half_life = half_life
+        self.refresh = refresh
+        self.checkpoint_interval = checkpoint_interval
+        self._scores: Dict[str, float] = {}
+        self._likes: Dict[str, Dict[str, float]] = {}
+        self._epoch = time.time()
+        self._top = []
+        self._computed = 0.0
+        self._dirty = False
+        self._task = None
+
+    # Function to get the growth factor of new weights since the reference time
+    def _growth(self, now: float):
+        return 2 ** ((now - self._epoch) / self.half_life)
+
+    # Function to move the reference time to 'now', scaling the scores down accordingly (keeps floats in range)
+    def _rebase(self, now: float):
+        factor = 1 / self._growth(now)
+        self._scores = {post_id: score * factor for post_id, score in self._scores.items()}
+        self._likes = {post_id: {username: added * factor for username, added in likers.items()}
+                       for post_id, likers in self._likes.items()}
+        self._top = [(post_id, score * factor) for post_id, score in self._top]
+        self._epoch = now
+
+    # Function to add a weight (e.g. of a comment) to a post's score, returning the weight added at the current scale
+    def record(self, post_id: UUID, weight: float):
+        now = time.time()
+        if now - self._epoch > 500 * self.half_life:
+            self._rebase(now)
+        post_id = str(post_id)
+        added = weight * self._growth(now)
+        self._set(post_id, self._scores.get(post_id, 0.0) + added)
+        return added
+
+    # Function to add a user's like to a post's score, or to take back the weight it added when it is removed
+    # (likes from before the last start are not known, so removing one cannot take more than the post's score)
+    def like(self, post_id: UUID, username: str, liked: bool):
+        post_id = str(post_id)
+        if liked:
+            added = self.record(post_id, TRENDING_LIKE_WEIGHT)
+            if post_id in self._scores:
+                self._likes.setdefault(post_id, {})[username] = added
+            return
+        added = self._likes.get(post_id, {}).pop(username, None)
+        if added is None:
+            self.record(post_id, -TRENDING_LIKE_WEIGHT)
+        else:
+            self._set(post_id, self._scores.get(post_id, 0.0) - added)
+
+    # Function to set a post's score, forgetting the post when nothing is left of it
+    def _set(self, post_id: str, score: float):
+        if score > 0:
+            self._scores[post_id] = score
+        else:
+            self._scores.pop(post_id, None)
+            self._likes.pop(post_id, None)
+        # Dropping the lowest scores once twice the capacity is tracked, so pruning is amortized
+        if len(self._scores) > 2 * self.capacity:
+            self._scores = dict(heapq.nlargest(self.capacity, self._scores.items(), key=itemgetter(1)))
+            self._likes = {post_id: likers for post_id, likers in self._likes.items() if post_id in self._scores}
+        self._dirty = True
+
+    # Function to forget a post (e.g. deleted)
+    def discard(self, post_id: UUID):
+        self._likes.pop(str(post_id), None)
+        if self._scores.pop(str(post_id), None) is not None:
+            self._dirty = True
+            self._computed = 0.0
+
+    # Function to get the ids of the 'limit' best posts, best first
+    def top(self, limit: int):
+        now = time.monotonic()
+        if self._dirty and now - self._computed >= self.refresh:
+            self._top = heapq.nlargest(self.size, self._scores.items(), key=itemgetter(1))
+            self._computed = now
+            self._dirty = False
+        return [post_id for post_id, _ in self._top[:limit]]
+
+    def clear(self):
+        self._scores = {}
+        self._likes = {}
+        self._top = []
+        self._dirty = False
+
+    # Asynchronous function to load the last checkpoint, decaying the scores by the time elapsed since
+    async def load(self):
+        decayed = tables.trending_scores.c.score * func.power(
+            0.5, func.extract('epoch', func.now() - tables.trending_scores.c.updated) / self.half_life)
+        query = select([tables.trending_scores.c.post_id, decayed.label('score')]).select_from(
+            tables.trending_scores
+            .join(tables.posts, tables.posts.c.post_id == tables.trending_scores.c.post_id)
+        )
+        self._epoch = time.time()
+        self._scores = {str(row['post_id']): row['score'] for row in await database.fetch_all(query)}
+        self._likes = {}
+        self._dirty = True
+        self._computed = 0.0
+
+    # Asynchronous function to replace the checkpoint with the current scores
+    async def checkpoint(self):
+        self._rebase(time.time())
+        rows = [{'post_id': post_id, 'score': score} for post_id, score in self._scores.items()]
+        async with database.transaction():
+            await database.execute(delete(tables.trending_scores))
+            if rows:
+                await database.execute(insert(tables.trending_scores).values(rows))
+
+    # Background task checkpointing the scores every 'checkpoint_interval' seconds
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception:
+                logger.exception("failed to checkpoint trending scores")
+
+    async def start(self):
+        if self._task is None:
+            await self.load()
+            self._task = asyncio.create_task(self.run())
+
+    # Asynchronous function stopping the background task and writing a last checkpoint
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.checkpoint()
+
+
+# Tracker of the current community, shared by the like and comment methods
+tracker = communities.PerCommunity(lambda community: TrendingTracker())
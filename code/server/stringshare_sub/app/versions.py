@@ -0,0 +1,113 @@
+# Importing necessary modules and components
+import hashlib
+import uuid
+from typing import Optional
+from fastapi import Request
+from sqlalchemy.sql import select
+from database import database
+from constants import VERSION_CACHE_USERS
+import cache
+import communities
+import tables
+
+
+# Per-user version stamps of a community, bumped by every write that changes what a user's profile, feed or activity
+# shows, along with a lazily loaded cache of who each user follows (needed to build feed ETags without running the feed
+# query). The stamps live in process memory, so a random epoch is mixed into every ETag: tags issued before a restart or
+# a database reset never match again. Stamps are drawn from one counter and the least recently used ones are evicted;
+# users without a stamp share the counter's value at the last eviction, so a tag built with an evicted stamp never
+# matches again either.
+class Stamps:
+    def __init__(self, size: int = VERSION_CACHE_USERS):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.versions = cache.LRUCache(size)
+        self.following = cache.LRUCache(size)
+        self._counter = 0
+        self._floor = 0
+
+    # Function returning the version stamp of a user
+    def version(self, username: str):
+        return self.versions.get(username, self._floor)
+
+    # Function giving a user a new version stamp
+    def bump(self, username: str):
+        if username not in self.versions and len(self.versions) >= self.versions.maxsize:
+            self._counter += 1
+            self._floor = self._counter
+        self._counter += 1
+        self.versions.set(username, self._counter)
+
+    # Function to invalidate every stamp
+    def reset(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.versions.clear()
+        self.following.clear()
+
+
+stamps = communities.PerCommunity(lambda community: Stamps())
+
+
+# Function to bump the version stamp of one or more users
+def bump(*usernames: Optional[str]):
+    for username in usernames:
+        if username:
+            stamps.bump(username)
+
+
+# Function to record that a user's following list changed
+def following_changed(username: str):
+    bump(username)
+    stamps.following.pop(username)
+
+
+# Function to invalidate every stamp (e.g. after the database has been reset)
+def reset():
+    stamps.reset()
+
+
+# Function to build a weak ETag from the viewer, the requested page and the version stamps of the given users
+def _etag(viewer: str, *usernames: str, page: str = ''):
+    digest = hashlib.blake2b("{}|{}".format(viewer, page).encode(), digest_size=8)
+    for username in usernames:
+        digest.update("|{}:{}".format(username, stamps.version(username)).encode())
+    return 'W/"{}-{}"'.format(stamps.epoch, digest.hexdigest())
+
+
+# ETag of a user's profile as seen by a viewer (the viewer matters because of the 'liked' flags)
+def profile_etag(username: str, viewer: str, page: str = ''):
+    return _etag(viewer, username, page=page)
+
+
+# ETag of a user's activity list
+def activity_etag(username: str):
+    return _etag(username, username)
+
+
+# ETag of a user's feed, covering the user and everyone they follow
+async def feed_etag(username: str):
+    followees = stamps.following.get(username)
+    if followees is None:
+        version = (stamps.epoch, stamps.version(username))
+        query = select([tables.following.c.following]).where(tables.following.c.user == username)
+        # Read on the primary: a list loaded from a lagging replica would be cached until the user's next follow
+        followees = {row.following for row in await database.fetch_all(query)}
+        # Only caching the list if no follow happened while it was being loaded
+        if (stamps.epoch, stamps.version(username)) == version:
+            stamps.following.set(username, followees)
+    return _etag(username, username, *sorted(followees))
+
+
+# Function to check a request's If-None-Match header against an ETag, comparing them weakly (a 'W/' prefix on
+# either side is ignored)
+def not_modified(request: Request, etag: str):
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == opaque:
+            return True
+    return False
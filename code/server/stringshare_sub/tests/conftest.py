@@ -0,0 +1,101 @@
+# Test setup: the app modules are imported from ../app with the environment of docker-compose, and the tests that
+# need Postgres run against the database of POSTGRES_SERVER (default localhost), e.g. the one of `docker compose
+# up db`, and are skipped when it cannot be reached. Each of those tests runs in a transaction that is rolled back.
+# The app's log is written to a temporary file instead of the app directory.
+import asyncio
+import contextlib
+import os
+import sys
+import tempfile
+import uuid
+import orjson
+import pytest
+
+APP_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+for name, value in (('COMMUNITY', 'stringshare.ca'), ('POSTGRES_SERVER', 'localhost'), ('POSTGRES_PORT', '5432'),
+                    ('POSTGRES_USER', 'postgres'), ('POSTGRES_PASSWORD', 'postgres'), ('POSTGRES_DB', 'stringshare'),
+                    ('SECRET_KEY', 'test-secret'), ('FEDERATION_KEY', 'test-federation-key'),
+                    ('LOG_FILE', os.path.join(tempfile.gettempdir(), 'stringshare-tests.log'))):
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, APP_ROOT)
+os.chdir(APP_ROOT)
+
+import asyncpg
+import communities
+import constants
+from database import database
+
+
+# Function telling whether the test database can be reached
+def _database_reachable():
+    async def connect():
+        connection = await asyncpg.connect(constants.DB_URL, timeout=2)
+        await connection.close()
+    try:
+        asyncio.run(connect())
+        return True
+    except Exception:
+        return False
+
+
+requires_db = pytest.mark.skipif(not _database_reachable(),
+                                 reason="needs the Postgres database of POSTGRES_SERVER (e.g. docker compose up db)")
+
+
+# Function running a coroutine to completion (the tests are plain functions)
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+# Asynchronous context manager connecting the default community's database for a test, inside a transaction that
+# is rolled back at the end. The connection is shared by every task (the queries of gather and of post loaders run
+# in tasks of their own), so they all see the test's data.
+@contextlib.asynccontextmanager
+async def connected():
+    communities.create_tables(constants.DB_URL)
+    with database.force_rollback():
+        await database.connect()
+        try:
+            yield database
+        finally:
+            await database.disconnect()
+            communities.default.instances.clear()
+
+
+# Asynchronous function inserting a local user, returning its username
+async def add_user(name: str = 'test', bio: str = None):
+    username = "{}{}@{}".format(name, uuid.uuid4().hex[:8], constants.COMMUNITY)
+    await database.execute("INSERT INTO users (username, full_name, bio) VALUES (:username, :name, :bio)",
+                           {'username': username, 'name': name.title(), 'bio': bio})
+    return username
+
+
+# Asynchronous function calling an ASGI app with one request, returning (status, headers, decoded JSON body)
+async def call(app, method: str, path: str, query: str = '', headers: dict = None, body: bytes = b''):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(key.lower().encode(), value.encode()) for key, value in
+                    {'host': 'localhost', **(headers or {})}.items()],
+        'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+    }
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = next(message for message in messages if message['type'] == 'http.response.start')
+    content = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+    response_headers = {key.decode().lower(): value.decode() for key, value in start['headers']}
+    return start['status'], response_headers, orjson.loads(content) if content else None
@@ -0,0 +1,62 @@
+# Activity writer: failed batches are retried, then written one event at a time so only the failing events are
+# dropped, and writers wait once the queue is full
+import asyncio
+import pytest
+from conftest import run
+import activity
+import models
+
+
+def event(user: str):
+    return {'user': user, 'action_user': 'someone', 'action': models.ActivityAction.follow, 'post_id': None}
+
+
+# Function returning a writer whose writes fail while 'failing(events)' is true, recording the events written
+def failing_writer(failing):
+    writer = activity.ActivityWriter(retry_delay=0)
+    writer.calls, writer.written = 0, []
+
+    async def write(events):
+        writer.calls += 1
+        if failing(events):
+            raise ConnectionResetError('connection lost')
+        writer.written.extend(events)
+    writer.write = write
+    return writer
+
+
+def test_batches_are_retried():
+    writer = failing_writer(lambda events: writer.calls <= 2)
+    run(writer.write_batch([event('a'), event('b')]))
+    assert writer.calls == 3 and [item['user'] for item in writer.written] == ['a', 'b']
+
+
+def test_only_failing_events_are_dropped():
+    writer = failing_writer(lambda events: any(item['user'] == 'bad' for item in events))
+    run(writer.write_batch([event('a'), event('bad'), event('b')]))
+    assert writer.calls == writer.max_attempts + 3
+    assert [item['user'] for item in writer.written] == ['a', 'b']
+
+
+def test_writers_wait_for_room_in_the_queue():
+    async def scenario():
+        writer = activity.ActivityWriter(interval=0, queue_size=1)
+        stalled = asyncio.Event()
+
+        async def write(events):
+            await stalled.wait()
+        writer.write = write
+        writer.start()
+        try:
+            # The first event is taken by the stalled writer, the second one fills the queue
+            await writer.log('a', 'someone', models.ActivityAction.follow)
+            await asyncio.sleep(0.01)
+            await writer.log('b', 'someone', models.ActivityAction.follow)
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(writer.log('c', 'someone', models.ActivityAction.follow), 0.05)
+            stalled.set()
+            await asyncio.wait_for(writer.log('c', 'someone', models.ActivityAction.follow), 1)
+        finally:
+            stalled.set()
+            await writer.stop()
+    run(scenario())
@@ -0,0 +1,24 @@
+# Admission control: rate limit buckets are keyed on verified token subjects only
+from jose import jwt
+from starlette.requests import Request
+import admission
+import auth
+
+
+def request(token: str = None):
+    headers = [(b'authorization', 'Bearer {}'.format(token).encode())] if token else []
+    return Request({'type': 'http', 'method': 'GET', 'path': '/client/posts', 'headers': headers,
+                    'client': ('203.0.113.7', 50000)})
+
+
+def test_valid_tokens_key_on_their_subject():
+    token = auth.create_access_token({'sub': 'alice@stringshare.ca'})
+    assert admission.AdmissionController.client_key(request(token)) == 'alice@stringshare.ca'
+
+
+def test_forged_tokens_key_on_the_client_address():
+    forged = jwt.encode({'sub': 'alice@stringshare.ca'}, 'not-the-secret', algorithm=auth.ALGORITHM)
+    unsigned = jwt.encode({'sub': 'alice@stringshare.ca'}, '', algorithm=auth.ALGORITHM)
+    for token in (forged, unsigned, 'garbage'):
+        assert admission.AdmissionController.client_key(request(token)) == '203.0.113.7'
+    assert admission.AdmissionController.client_key(request()) == '203.0.113.7'
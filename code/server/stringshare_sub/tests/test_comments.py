@@ -0,0 +1,63 @@
+# Cached comments: a load overtaken by a new comment is not cached, and cached comments show their author's
+# current avatar
+import datetime
+import uuid
+import pytest
+from conftest import run
+import communities
+import hydration
+import methods
+
+POST_ID = uuid.UUID('00000000-0000-0000-0000-000000000001')
+AUTHOR = 'author@stringshare.ca'
+
+
+# Stand-in for a database answering the comments query with one comment and the users query with the author's
+# avatar, calling 'during' while the comments query runs
+class StandInDatabase:
+    def __init__(self, avatar_url: str = 'old.png', during=None):
+        self.avatar_url = avatar_url
+        self.during = during
+
+    async def fetch_all(self, query):
+        if 'comments' not in str(query):
+            return [{'username': AUTHOR, 'full_name': 'Author', 'avatar_url': self.avatar_url, 'bio': None}]
+        if self.during is not None:
+            await self.during()
+        return [{'comment_id': uuid.uuid4(), 'username': AUTHOR, 'content': 'first', 'avatar_url': self.avatar_url,
+                 'date_posted': datetime.datetime(2024, 1, 1)}]
+
+
+@pytest.fixture(autouse=True)
+def caches():
+    yield
+    communities.default.instances.clear()
+
+
+def serve(monkeypatch, db):
+    monkeypatch.setattr(methods, 'database', db)
+    monkeypatch.setattr(hydration, 'database', db)
+    monkeypatch.setattr(hydration, 'read_database', lambda username=None: db)
+
+
+def test_loads_overtaken_by_a_new_comment_are_not_cached(monkeypatch):
+    # The comment is created while the first page is being read
+    serve(monkeypatch, StandInDatabase(during=lambda: methods.cache_comment(POST_ID, uuid.uuid4())))
+    comments, _ = run(methods.get_post_comments(POST_ID))
+    assert len(comments) == 1 and POST_ID not in methods.comment_cache
+
+    serve(monkeypatch, StandInDatabase())
+    run(methods.get_post_comments(POST_ID))
+    assert POST_ID in methods.comment_cache
+
+
+def test_cached_comments_show_the_current_avatar(monkeypatch):
+    serve(monkeypatch, StandInDatabase('old.png'))
+    comments, _ = run(methods.get_post_comments(POST_ID))
+    assert comments[0]['avatar_url'] == 'old.png'
+
+    # The author changes their avatar while the comments stay cached
+    serve(monkeypatch, StandInDatabase('new.png'))
+    hydration.forget_authors(AUTHOR)
+    comments, _ = run(methods.get_post_comments(POST_ID))
+    assert comments[0]['avatar_url'] == 'new.png' and POST_ID in methods.comment_cache
@@ -0,0 +1,26 @@
+# Communities hosted together: each one has its own version stamps and remote media directory
+import contextlib
+import communities
+import remote
+import versions
+
+
+# Context manager making a community the current one
+@contextlib.contextmanager
+def current(community):
+    token = communities._current.set(community)
+    try:
+        yield community
+    finally:
+        communities._current.reset(token)
+        community.instances.clear()
+
+
+def test_communities_have_their_own_stamps_and_remote_media():
+    etag = versions.activity_etag('someone@other.test')
+    with current(communities.Community('other.test', 'postgresql://other/db', '/tmp/other/', '/tmp/other', '')):
+        assert versions.activity_etag('someone@other.test') != etag
+        versions.bump('someone@other.test')
+        assert remote.media_cache.root == '/tmp/other/remote/'
+    assert versions.activity_etag('someone@other.test') == etag
+    assert remote.media_cache.root != '/tmp/other/remote/'
@@ -0,0 +1,27 @@
+# Account export: requests beyond EXPORT_CONCURRENCY are turned away at once, and streams give their slot back
+from conftest import run
+import export
+import models
+
+
+def test_slots_are_taken_without_waiting(monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_CONCURRENCY', 2)
+    monkeypatch.setattr(export, '_running', 0)
+    assert export.acquire() and export.acquire()
+    assert not export.acquire()
+    export.release()
+    assert export.acquire()
+
+
+def test_closed_streams_release_their_slot(monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_CONCURRENCY', 1)
+    monkeypatch.setattr(export, '_running', 0)
+
+    async def scenario():
+        assert export.acquire()
+        body = export.stream(models.User(username='someone@stringshare.ca', full_name='Someone'))
+        assert await body.__anext__() == b''
+        # E.g. the client went away before the archive was read
+        await body.aclose()
+    run(scenario())
+    assert export.acquire()
@@ -0,0 +1,155 @@
+# Federation: inbound checks, and outbound delivery and retry against a local stand-in peer
+import contextlib
+import aiohttp
+import pytest
+from aiohttp import web
+from sqlalchemy.sql import select, update, func
+from conftest import requires_db, run, connected, add_user
+import exceptions
+import federation
+import methods
+import models
+import tables
+
+PEER = 'peer.test'
+
+
+# Stand-in for another community's server, recording the batches it receives and answering with 'status'
+class StandInPeer:
+    def __init__(self):
+        self.status = 201
+        self.batches = []
+        self.keys = []
+        self.url = None
+        self._runner = None
+
+    async def batch(self, request):
+        self.keys.append(request.headers.get('X-Federation-Key'))
+        self.batches.append(await request.json())
+        return web.json_response(None, status=self.status)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/server/batch', self.batch)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        self.url = "http://127.0.0.1:{}".format(self._runner.addresses[0][1])
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+# Asynchronous context manager running a stand-in peer reached as PEER, and a delivery queue (without its background
+# task) sending to it
+@contextlib.asynccontextmanager
+async def stand_in(monkeypatch, **options):
+    peer = StandInPeer()
+    await peer.start()
+    monkeypatch.setitem(federation.FEDERATION_PEERS, PEER, peer.url)
+    queue = federation.DeliveryQueue(**options)
+    queue._session = aiohttp.ClientSession()
+    try:
+        yield peer, queue
+    finally:
+        await queue._session.close()
+        await peer.stop()
+
+
+def follow_event(username: str):
+    user = models.ServerUser(username='remote@' + PEER, full_name='Remote', avatar_url='', bio='')
+    return models.ServerFollowUser(username=username, user=user)
+
+
+def test_verify_peer_refuses_requests_without_a_configured_key(monkeypatch):
+    monkeypatch.setattr(federation, 'FEDERATION_KEY', None)
+    with pytest.raises(type(exceptions.API_403_FEDERATION_DISABLED_EXCEPTION)) as error:
+        run(federation.verify_peer('anything'))
+    assert error.value.status_code == 403
+
+
+def test_verify_peer_checks_the_key():
+    with pytest.raises(type(exceptions.API_401_CREDENTIALS_EXCEPTION)) as error:
+        run(federation.verify_peer('wrong'))
+    assert error.value.status_code == 401
+    run(federation.verify_peer(federation.FEDERATION_KEY))
+
+
+def test_remote_users_cannot_overwrite_local_users():
+    user = models.ServerUser(username='someone@' + federation.communities.current().name, full_name='x',
+                             avatar_url='', bio='')
+    with pytest.raises(type(exceptions.API_400_BAD_REQUEST_EXCEPTION)):
+        run(federation.upsert_remote_user(user))
+
+
+def test_send_posts_one_batch_with_the_key(monkeypatch):
+    async def scenario():
+        async with stand_in(monkeypatch) as (peer, queue):
+            events = [{'kind': federation.FOLLOW, 'payload': {'username': 'a'}},
+                      {'kind': federation.FOLLOW, 'payload': {'username': 'b'}}]
+            assert await queue.send(PEER, events)
+            peer.status = 500
+            assert not await queue.send(PEER, events)
+            return peer
+    peer = run(scenario())
+    assert peer.keys == [federation.FEDERATION_KEY] * 2
+    assert peer.batches[0] == {'follows': [{'username': 'a'}, {'username': 'b'}], 'likes': [], 'comments': []}
+
+
+def test_send_reports_unreachable_peers(monkeypatch):
+    async def scenario():
+        async with stand_in(monkeypatch) as (peer, queue):
+            monkeypatch.setitem(federation.FEDERATION_PEERS, PEER, 'http://127.0.0.1:9')
+            return await queue.send(PEER, [{'kind': federation.FOLLOW, 'payload': {}}])
+    assert not run(scenario())
+
+
+@requires_db
+def test_deliver_retries_with_backoff_then_deletes_delivered_events(monkeypatch):
+    async def scenario():
+        async with connected() as db, stand_in(monkeypatch) as (peer, queue):
+            local = await add_user()
+            await queue.enqueue(PEER, federation.FOLLOW, follow_event(local))
+
+            peer.status = 503
+            await queue.deliver()
+            row = await db.fetch_one(select([tables.federation_outbox, (
+                tables.federation_outbox.c.next_attempt > func.now()).label('later')]))
+            assert row['attempts'] == 1 and row['later']
+
+            # Not due yet: nothing is sent
+            await queue.deliver()
+            assert len(peer.batches) == 1
+
+            peer.status = 201
+            await db.execute(update(tables.federation_outbox).values(next_attempt=func.now()))
+            await queue.deliver()
+            assert len(peer.batches) == 2
+            assert peer.batches[1]['follows'][0]['username'] == local
+            assert await db.fetch_all(select([tables.federation_outbox])) == []
+    run(scenario())
+
+
+@requires_db
+def test_deliver_drops_events_after_max_attempts(monkeypatch):
+    async def scenario():
+        async with connected() as db, stand_in(monkeypatch, max_attempts=1) as (peer, queue):
+            await queue.enqueue(PEER, federation.FOLLOW, follow_event(await add_user()))
+            peer.status = 500
+            await queue.deliver()
+            assert await db.fetch_all(select([tables.federation_outbox])) == []
+    run(scenario())
+
+
+@requires_db
+def test_redelivered_follow_is_applied_once():
+    async def scenario():
+        async with connected() as db:
+            local = await add_user()
+            event = follow_event(local)
+            await methods.receive_follow(event)
+            await methods.receive_follow(event)
+            rows = await db.fetch_all(select([tables.followers]).where(tables.followers.c.user == local))
+            stats = await db.fetch_one(select([tables.user_stats]).where(tables.user_stats.c.username == local))
+            assert len(rows) == 1 and stats['followers'] == 1
+    run(scenario())
@@ -0,0 +1,57 @@
+# Post hydration: cached authors survive changes to the caches during the query, and outdated authors are not cached
+import datetime
+import pytest
+from conftest import run
+import communities
+import hydration
+
+POST_ID = '00000000-0000-0000-0000-000000000001'
+AUTHOR = 'author@stringshare.ca'
+
+
+# Stand-in for a database answering the hydration query with one post, calling 'during' while the query runs
+class StandInDatabase:
+    def __init__(self, during=lambda: None):
+        self.during = during
+
+    async def fetch_all(self, query):
+        self.during()
+        return [{'post_id': POST_ID, 'username': AUTHOR, 'content': 'hello', 'image_url': None, 'latitude': None,
+                 'longitude': None, 'date_posted': datetime.datetime(2024, 1, 1), 'full_name': 'Author',
+                 'avatar_url': 'new.png', 'bio': None, 'comments': 2, 'likes': 3, 'liked': False}]
+
+
+@pytest.fixture(autouse=True)
+def caches():
+    yield
+    communities.default.instances.clear()
+
+
+def serve(monkeypatch, db, primary: bool = True):
+    monkeypatch.setattr(hydration, 'read_database', lambda username=None: db)
+    if primary:
+        monkeypatch.setattr(hydration, 'database', db)
+
+
+def test_authors_evicted_during_the_query_are_still_used(monkeypatch):
+    hydration.post_cache.set(POST_ID, {'post_id': POST_ID, 'username': AUTHOR})
+    hydration.author_cache.set(AUTHOR, {'full_name': 'Author', 'avatar_url': 'old.png', 'bio': None})
+    serve(monkeypatch, StandInDatabase(lambda: hydration.forget_authors(AUTHOR)))
+    post = run(hydration.hydrate([POST_ID], 'viewer@stringshare.ca'))[POST_ID]
+    assert post['avatar_url'] == 'old.png' and post['likes'] == 3
+
+
+def test_authors_read_from_a_replica_are_not_cached(monkeypatch):
+    serve(monkeypatch, StandInDatabase(), primary=False)
+    run(hydration.hydrate([POST_ID], 'viewer@stringshare.ca'))
+    assert POST_ID in hydration.post_cache and AUTHOR not in hydration.author_cache
+
+
+def test_authors_forgotten_during_the_query_are_not_cached(monkeypatch):
+    serve(monkeypatch, StandInDatabase(lambda: hydration.forget_authors(AUTHOR)))
+    post = run(hydration.hydrate([POST_ID], 'viewer@stringshare.ca'))[POST_ID]
+    assert post['avatar_url'] == 'new.png' and AUTHOR not in hydration.author_cache
+
+    serve(monkeypatch, StandInDatabase())
+    run(hydration.hydrate([POST_ID], 'viewer@stringshare.ca'))
+    assert AUTHOR in hydration.author_cache
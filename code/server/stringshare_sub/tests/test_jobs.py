@@ -0,0 +1,73 @@
+# Jobs: a community is not closed while its jobs run or wait, a job taken over by another runner is only saved
+# by that runner, and rebuilding the followers keeps the follows made while it runs
+import asyncio
+import time
+from datetime import timedelta
+from sqlalchemy.sql import select, insert, update, func
+from conftest import requires_db, run, connected, add_user
+import communities
+import helper
+import jobs
+import tables
+
+
+def test_communities_with_jobs_are_not_idle():
+    community = communities.Community('other.test', 'postgresql://other/db', '/tmp/other/', '/tmp/other', '')
+    community.is_open = True
+    later = time.monotonic() + communities.COMMUNITY_IDLE_SECONDS + 1
+    runner = community.instance(jobs.runner, lambda community: jobs.JobRunner())
+    assert community.idle(later)
+
+    runner._running[1] = None
+    assert not community.idle(later)
+    runner._running.clear()
+    runner._backlog = True
+    assert not community.idle(later)
+
+
+@requires_db
+def test_jobs_taken_over_are_only_saved_by_their_new_runner(monkeypatch):
+    async def step(cursor):
+        return None, 1, []
+    monkeypatch.setitem(jobs.KINDS, 'test', step)
+
+    async def scenario():
+        async with connected() as db:
+            first, second = jobs.JobRunner(), jobs.JobRunner()
+            first._wakeup = second._wakeup = asyncio.Event()
+            job_id = (await first.enqueue('test'))['job_id']
+            claimed = await first.claim()
+
+            # The first runner looks stopped, so the second one takes the job over
+            await db.execute(update(tables.jobs).where(tables.jobs.c.job_id == job_id).values(
+                updated=func.now() - timedelta(seconds=first.stale_seconds + 1)))
+            taken = await second.claim()
+            assert taken['job_id'] == job_id and taken['owner'] == second.owner
+
+            await first.execute(claimed)
+            row = await db.fetch_one(select([tables.jobs]).where(tables.jobs.c.job_id == job_id))
+            assert (row['state'], row['done'], row['owner']) == ('running', 0, second.owner)
+
+            await second.execute(taken)
+            row = await db.fetch_one(select([tables.jobs]).where(tables.jobs.c.job_id == job_id))
+            assert (row['state'], row['done']) == ('done', 1)
+    run(scenario())
+
+
+@requires_db
+def test_fixing_followers_keeps_follows_made_while_it_runs():
+    async def scenario():
+        async with connected() as db:
+            user, other = await add_user(), await add_user()
+            await db.execute(insert(tables.following).values(user=user, following=other))
+            cursor = {}
+            while cursor.get('phase') != 'stats':
+                cursor, _, statements = await helper.fix_followers(cursor)
+                for statement in statements:
+                    await db.execute(statement)
+                if cursor['phase'] == 'copy' and 'after' not in cursor:
+                    # The follow is made again between clearing the table and copying it
+                    await db.execute(insert(tables.followers).values(user=other, follower=user))
+            rows = await db.fetch_all(select([tables.followers]).where(tables.followers.c.user == other))
+            assert [row['follower'] for row in rows] == [user]
+    run(scenario())
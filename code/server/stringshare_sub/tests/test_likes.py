@@ -0,0 +1,66 @@
+# Buffered likes: a batch breaking a constraint is dropped instead of holding back later taps, a batch failing for
+# another reason is retried, and taps on posts that do not exist are not buffered
+import contextlib
+import uuid
+import asyncpg
+import pytest
+from sqlalchemy.sql import select, insert, delete
+from conftest import requires_db, run, connected, add_user
+import likes
+import tables
+
+POST_ID = uuid.UUID('00000000-0000-0000-0000-000000000001')
+
+
+# Stand-in for a database whose writes raise 'error'
+class FailingDatabase:
+    def __init__(self, error: Exception):
+        self.error = error
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch_all(self, query):
+        raise self.error
+
+    async def execute(self, query):
+        raise self.error
+
+
+@pytest.mark.parametrize('error, kept', [
+    (asyncpg.exceptions.ForeignKeyViolationError('post does not exist'), False),
+    (ConnectionResetError('connection lost'), True),
+])
+def test_only_batches_failing_for_a_transient_reason_are_retried(monkeypatch, error, kept):
+    monkeypatch.setattr(likes, 'database', FailingDatabase(error))
+    buffer = likes.LikeBuffer()
+    buffer._pending = {POST_ID: {'someone@stringshare.ca': True}}
+
+    async def flush():
+        try:
+            await buffer.flush()
+        except ConnectionResetError:
+            pass
+    run(flush())
+    assert buffer.has_pending(POST_ID) == kept
+
+
+@requires_db
+def test_likes_on_deleted_posts_do_not_block_the_buffer():
+    async def scenario():
+        async with connected() as db:
+            username = await add_user()
+            posts = [await db.execute(insert(tables.posts).values(username=username, content='post')
+                                      .returning(tables.posts.c.post_id)) for _ in range(2)]
+            buffer = likes.LikeBuffer()
+            assert await buffer.toggle(uuid.uuid4(), username) is None
+            assert await buffer.toggle(posts[0], username) and await buffer.toggle(posts[1], username)
+
+            # The first post is deleted before the batch is written
+            await db.execute(delete(tables.posts).where(tables.posts.c.post_id == posts[0]))
+            await buffer.flush()
+            assert not buffer.has_pending(posts[1])
+            rows = await db.fetch_all(select([tables.likes.c.post_id]).where(tables.likes.c.username == username))
+            assert [row['post_id'] for row in rows] == [posts[1]]
+    run(scenario())
@@ -0,0 +1,42 @@
+# Request logs: errors and slow requests are always logged, others are sampled, and records are written as one
+# JSON line
+import logging
+import sys
+import orjson
+import pytest
+import logs
+
+
+@pytest.fixture(autouse=True)
+def thresholds(monkeypatch):
+    monkeypatch.setattr(logs, 'LOG_SAMPLE_RATE', 0.1)
+    monkeypatch.setattr(logs, 'LOG_SLOW_MS', 500)
+
+
+def test_errors_and_slow_requests_are_always_logged(monkeypatch):
+    monkeypatch.setattr(logs.random, 'random', lambda: 0.99)
+    assert logs.should_log(500, 1)
+    assert logs.should_log(200, 500)
+    assert not logs.should_log(404, 499)
+
+
+def test_other_requests_are_sampled(monkeypatch):
+    monkeypatch.setattr(logs.random, 'random', lambda: 0.05)
+    assert logs.should_log(200, 1)
+    monkeypatch.setattr(logs.random, 'random', lambda: 0.1)
+    assert not logs.should_log(200, 1)
+
+
+def test_records_are_written_as_one_json_line():
+    try:
+        raise ValueError("broken")
+    except ValueError:
+        exc_info = sys.exc_info()
+    record = logging.LogRecord('app', logging.ERROR, __file__, 1, "request %s", ('completed',), exc_info)
+    record.fields = {'rid': 'abc-1', 'status_code': 500}
+    text = logs.JSONFormatter().format(record)
+    assert '\n' not in text
+    line = orjson.loads(text)
+    assert line['level'] == 'ERROR' and line['logger'] == 'app' and line['message'] == "request completed"
+    assert line['rid'] == 'abc-1' and line['status_code'] == 500
+    assert 'ValueError: broken' in line['exc_info']
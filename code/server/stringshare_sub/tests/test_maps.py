@@ -0,0 +1,67 @@
+# Map clusters: deleting posts takes their locations out of the cells, as a rebuild from scratch would, and the
+# bounds of a cell (which limit the search for its new representative post) contain its points
+from datetime import datetime
+from sqlalchemy.sql import select, insert, delete
+from conftest import requires_db, run, connected, add_user
+import maps
+import tables
+
+
+# Asynchronous function inserting a located post and adding it to the map cells, returning its id
+async def located_post(db, username: str, day: int, latitude: float, longitude: float):
+    post_id = await db.execute(insert(tables.posts).values(username=username, content='here',
+                                                           date_posted=datetime(2024, 1, day))
+                               .returning(tables.posts.c.post_id))
+    await db.execute(insert(tables.post_locations).values(post_id=post_id, latitude=latitude, longitude=longitude))
+    await db.execute(maps.record_query(post_id, latitude, longitude))
+    return post_id
+
+
+async def cells(db):
+    rows = await db.fetch_all(select([tables.map_cells]))
+    return {(row['zoom'], row['cell_x'], row['cell_y']): (row['count'], round(row['latitude_sum'], 6),
+                                                          round(row['longitude_sum'], 6), row['post_id'])
+            for row in rows}
+
+
+@requires_db
+def test_deleted_posts_leave_the_map_cells():
+    async def scenario():
+        async with connected() as db:
+            await db.execute(delete(tables.map_cells))
+            await db.execute(delete(tables.post_locations))
+            username = await add_user()
+            older = await located_post(db, username, 1, 45.5, -73.6)
+            newer = await located_post(db, username, 2, 45.5001, -73.6001)
+            elsewhere = await located_post(db, username, 3, -33.9, 151.2)
+            montreal = (0,) + maps.cell(45.5, -73.6, 0)
+            assert (await cells(db))[montreal][0] == 2
+
+            # The newer post represented the cells it shared: the older one takes over, and the cells of the other
+            # post are emptied and dropped
+            await db.execute(delete(tables.posts).where(tables.posts.c.post_id.in_([newer, elsewhere])))
+            incremental = await cells(db)
+            assert incremental[montreal][0] == 1 and incremental[montreal][3] == older
+            assert (0,) + maps.cell(-33.9, 151.2, 0) not in incremental
+            await maps.rebuild()
+            assert incremental == await cells(db)
+
+            # Deleting the user removes their posts, and the emptied cells go with them
+            await db.execute(delete(tables.users).where(tables.users.c.username == username))
+            assert await cells(db) == {}
+    run(scenario())
+
+
+@requires_db
+def test_cell_bounds_contain_their_points():
+    async def scenario():
+        async with connected() as db:
+            query = """
+                SELECT bounds.* FROM map_cell(:latitude, :longitude, :zoom) AS located,
+                                     map_cell_bounds(:zoom, located.cell_x, located.cell_y) AS bounds
+            """
+            for latitude, longitude in [(45.5, -73.6), (-33.9, 151.2), (0.0, 0.0), (89.9, -180.0), (-89.9, 180.0)]:
+                for zoom in (0, 9, maps.MAP_MAX_ZOOM):
+                    row = await db.fetch_one(query, {'latitude': latitude, 'longitude': longitude, 'zoom': zoom})
+                    assert row['south'] <= latitude <= row['north'] and row['west'] <= longitude <= row['east']
+    run(scenario())
@@ -0,0 +1,57 @@
+# Keyset pagination: a page holds at most 'limit' rows with the cursor of its last row, and paging through a
+# profile returns every post once, in order, even when posts share the same date
+import base64
+import datetime
+import uuid
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.sql import insert
+from conftest import requires_db, run, connected, add_user
+import methods
+import models
+import pagination
+import tables
+
+DATE = datetime.datetime(2024, 1, 1, 12, 0, 0, 123456)
+
+
+def rows(count: int):
+    return [{'date': DATE, 'id': uuid.UUID(int=count - index)} for index in range(count)]
+
+
+def test_pages_end_at_the_limit():
+    assert pagination.page(rows(2), 2, 'date', 'id') == (rows(2), None)
+    page, cursor = pagination.page(rows(3), 2, 'date', 'id')
+    assert page == rows(3)[:2] and pagination.decode_cursor(cursor) == (DATE, uuid.UUID(int=2))
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor', base64.urlsafe_b64encode(b'2024-01-01').decode()])
+def test_invalid_cursors_are_bad_requests(cursor):
+    with pytest.raises(HTTPException) as error:
+        pagination.decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+@requires_db
+def test_paging_through_a_profile_returns_every_post_once():
+    async def scenario():
+        async with connected() as db:
+            username = await add_user()
+            # Five posts, three of them at the same time
+            created = []
+            for day in (1, 2, 2, 2, 3):
+                created.append(await db.execute(insert(tables.posts).values(
+                    username=username, content='post', date_posted=datetime.datetime(2024, 1, day))
+                    .returning(tables.posts.c.post_id)))
+            viewer = models.User(username=username, full_name='Test')
+            seen, cursor = [], None
+            while True:
+                profile = await methods.get_user_profile(username, viewer, cursor, 2)
+                assert len(profile['posts']) <= 2
+                seen.extend(str(post['post_id']) for post in profile['posts'])
+                cursor = profile['next_cursor']
+                if cursor is None:
+                    return created, seen
+    created, seen = run(scenario())
+    assert sorted(seen) == sorted(str(post_id) for post_id in created) and len(seen) == len(set(seen))
+    assert seen[0] == str(created[-1]) and seen[-1] == str(created[0])
@@ -0,0 +1,25 @@
+# Query plans: the hot queries of the API use indexes on a seeded dataset, and the check does catch sequential scans
+from sqlalchemy.sql import select
+from conftest import requires_db, run, connected
+import plancheck
+import tables
+
+
+def test_nodes_walks_the_whole_plan():
+    plan = {'Node Type': 'Limit', 'Plans': [
+        {'Node Type': 'Nested Loop', 'Plans': [{'Node Type': 'Seq Scan', 'Relation Name': 'posts'}]},
+        {'Node Type': 'Index Scan', 'Relation Name': 'likes'},
+    ]}
+    assert [node['Node Type'] for node in plancheck.nodes(plan)] == ['Limit', 'Nested Loop', 'Seq Scan', 'Index Scan']
+
+
+@requires_db
+def test_hot_queries_use_indexes():
+    async def scenario():
+        async with connected():
+            await plancheck.seed(0.1)
+            unindexed = await plancheck.seq_scans(select([tables.posts]).where(tables.posts.c.content == 'post 1'))
+            return unindexed, await plancheck.check()
+    unindexed, results = run(scenario())
+    assert unindexed == ['posts']
+    assert {name: scans for name, scans in results.items() if scans} == {}
@@ -0,0 +1,24 @@
+# Bulk user creation: rows with values beyond the header or unknown columns are reported on their own line instead
+# of failing their whole batch
+import io
+from conftest import run
+import provisioning
+
+CSV = ("username,full_name,password\n"
+       "a,A,secret,extra\n"
+       "b,B,secret\n")
+
+
+def test_values_beyond_the_header_are_reported():
+    rows = list(provisioning.read_rows(io.StringIO(CSV)))
+    assert [(number, error) for number, _, error in rows] == [(2, "more values than columns"), (3, None)]
+
+
+def test_rows_are_checked_one_by_one():
+    stream = io.StringIO('{"username": "a", "full_name": "A", "password": "x", "admin": true}\n'
+                         '{"username": "b", "full_name": "B"}\n'
+                         'not json\n')
+    report = run(provisioning.provision(stream))
+    assert report['created'] == 0 and report['failed'] == 3
+    assert [(error['line'], error['username']) for error in report['errors']] == [(1, 'a'), (2, 'b'), (3, None)]
+    assert report['errors'][0]['error'] == "unexpected columns: admin"
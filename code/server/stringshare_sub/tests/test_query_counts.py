@@ -0,0 +1,83 @@
+# Query budgets: the feed, profile, post and comments routes make a fixed number of queries, however many posts,
+# comments and likes they return (an N+1 regression fails these tests)
+import types
+import pytest
+from sqlalchemy.sql import insert
+from conftest import requires_db, run, connected, add_user, call
+import auth
+import communities
+import constants
+import methods
+import models
+import querystats
+import server
+import tables
+
+# Queries of each route: authenticating the user, then the route's own reads
+BUDGETS = {
+    '/client/posts': 4,  # user, followees (feed ETag), feed ids, hydration
+    '/client/users': 4,  # user, profile, page of post ids, hydration
+    '/client/post': 2,  # user, hydration
+    '/client/comments': 2,  # user, comments
+}
+
+
+# Fixture serving the routes of the default community (its database is connected by the test) with the query count
+# headers of debug mode
+@pytest.fixture
+def debug_server(monkeypatch):
+    monkeypatch.setattr(constants, 'DEBUG', True)
+    monkeypatch.setattr(communities.default, 'is_open', True)
+
+
+# Asynchronous function adding a viewer following three authors, who have three posts each, every post liked and
+# commented on by the two other authors, returning the viewer and the authors
+async def seed(db):
+    viewer, authors = await add_user('viewer'), [await add_user('author') for _ in range(3)]
+    await db.execute(insert(tables.user_credentials).values(
+        [{'username': username, 'hashed_password': 'x', 'salt': 'x'} for username in [viewer] + authors]))
+    await db.execute(insert(tables.following).values([{'user': viewer, 'following': author} for author in authors]))
+    for author in authors:
+        for index in range(3):
+            post_id = await db.execute(insert(tables.posts).values(username=author, content='post')
+                                       .returning(tables.posts.c.post_id))
+            others = [other for other in authors if other != author]
+            await db.execute(insert(tables.likes).values([{'post_id': post_id, 'username': other} for other in others]))
+            await db.execute(insert(tables.comments).values(
+                [{'post_id': post_id, 'username': other, 'content': 'comment'} for other in others]))
+    return viewer, authors
+
+
+# Asynchronous function calling a route as 'username', checking its status and query budget, returning its body
+async def get(username: str, path: str, query: str = ''):
+    token = auth.create_access_token({'sub': username})
+    status, headers, body = await call(server.app, 'GET', path, query, {'authorization': 'Bearer ' + token})
+    assert status == 200, body
+    querystats.assert_route_queries(types.SimpleNamespace(headers=headers), BUDGETS[path])
+    return body
+
+
+@requires_db
+def test_routes_stay_within_their_query_budgets(debug_server):
+    async def scenario():
+        async with connected() as db:
+            viewer, authors = await seed(db)
+            feed = await get(viewer, '/client/posts')
+            assert len(feed) == 9
+            profile = await get(viewer, '/client/users', 'username=' + authors[0])
+            assert len(profile['posts']) == 3
+            post_id = feed[0]['post_id']
+            await get(viewer, '/client/post', 'post_id=' + post_id)
+            assert len(await get(viewer, '/client/comments', 'post_id=' + post_id)) == 2
+    run(scenario())
+
+
+@requires_db
+def test_feed_hydration_is_batched():
+    async def scenario():
+        async with connected() as db:
+            viewer, _ = await seed(db)
+            with querystats.assert_max_queries(2):
+                feed = await methods.get_feed(models.User(username=viewer, full_name='Viewer'))
+            assert len(feed) == 9
+    run(scenario())
@@ -0,0 +1,87 @@
+# Remote profiles and media: only the users asked for and the media of peers or stored users are fetched
+import pytest
+from aiohttp import web
+from conftest import requires_db, run, connected, add_user
+import exceptions
+import federation
+import remote
+
+PEER = 'peer.test'
+
+
+# Asynchronous function running a stand-in peer answering /server/users with 'profile', returning its runner
+async def profile_peer(monkeypatch, profile: dict):
+    async def server_users(request):
+        return web.json_response(profile)
+    app = web.Application()
+    app.router.add_get('/server/users', server_users)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    monkeypatch.setitem(federation.FEDERATION_PEERS, PEER, "http://127.0.0.1:{}".format(runner.addresses[0][1]))
+    return runner
+
+
+def fetch_profile(monkeypatch, username: str, profile: dict):
+    upserted = []
+
+    async def upsert_remote_user(user):
+        upserted.append(user.username)
+    monkeypatch.setattr(federation, 'upsert_remote_user', upsert_remote_user)
+
+    async def scenario():
+        runner = await profile_peer(monkeypatch, profile)
+        try:
+            return await remote._fetch_profile(username)
+        finally:
+            await remote.close()
+            await runner.cleanup()
+    return run(scenario()), upserted
+
+
+def profile(username: str):
+    return {'username': username, 'full_name': 'Remote', 'avatar_url': '', 'bio': ''}
+
+
+def test_profile_of_the_user_asked_for_is_stored(monkeypatch):
+    user, upserted = fetch_profile(monkeypatch, 'someone@' + PEER, profile('someone@' + PEER))
+    assert user.username == 'someone@' + PEER and upserted == ['someone@' + PEER]
+
+
+@pytest.mark.parametrize('answer', ['other@' + PEER, 'someone@stringshare.ca', 'someone@elsewhere.test'])
+def test_profile_of_another_user_is_refused(monkeypatch, answer):
+    with pytest.raises(type(exceptions.API_404_NOT_FOUND_EXCEPTION)):
+        fetch_profile(monkeypatch, 'someone@' + PEER, profile(answer))
+
+
+def test_profiles_of_local_users_are_not_fetched(monkeypatch):
+    with pytest.raises(type(exceptions.API_400_BAD_REQUEST_EXCEPTION)):
+        fetch_profile(monkeypatch, 'someone@stringshare.ca', profile('someone@stringshare.ca'))
+
+
+def test_media_of_configured_peers_is_allowed(monkeypatch):
+    monkeypatch.setitem(federation.FEDERATION_PEERS, PEER, 'http://10.1.2.3:8081')
+    assert run(remote.media_allowed('https://peer.test/client/media/?url=a.png'))
+    assert run(remote.media_allowed('http://10.1.2.3:8081/client/media/?url=a.png'))
+    assert not run(remote.media_allowed('file:///etc/passwd'))
+
+
+def test_media_cache_refuses_urls_not_allowed(tmp_path):
+    async def refuse(url):
+        return False
+    cache = remote.MediaCache(str(tmp_path), 1024, 60)
+    with pytest.raises(type(exceptions.API_400_BAD_REQUEST_EXCEPTION)) as error:
+        run(cache.get('http://169.254.169.254/latest/meta-data/', refuse))
+    assert error.value.status_code == 400
+
+
+@requires_db
+def test_media_of_stored_remote_users_is_allowed():
+    async def scenario():
+        async with connected() as db:
+            username = await add_user()
+            await db.execute("UPDATE users SET avatar_url = :url WHERE username = :username",
+                             {'url': 'https://remote.test/avatar.png', 'username': username})
+            return (await remote.media_allowed('https://remote.test/avatar.png'),
+                    await remote.media_allowed('http://127.0.0.1:5432/'))
+    assert run(scenario()) == (True, False)
@@ -0,0 +1,69 @@
+# Read replicas: read-your-writes routing, and ETag'd reads kept on the primary
+import os
+import uuid
+import pytest
+import communities
+import constants
+import database
+from conftest import run
+from querystats import CountingDatabase
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    replica = CountingDatabase(os.getenv('POSTGRES_REPLICA_URL', 'postgresql://replica/stringshare'))
+    monkeypatch.setattr(database, 'replicas', [replica])
+    monkeypatch.setattr(database, '_next_replica', iter(lambda: replica, None))
+    return replica
+
+
+def test_reads_go_to_the_replica(replica):
+    assert database.read_database() is replica
+    assert database.read_database('reader@stringshare.ca') is replica
+
+
+def test_writers_read_their_writes_on_the_primary(replica, monkeypatch):
+    writer = 'writer{}@stringshare.ca'.format(uuid.uuid4().hex[:8])
+    database.mark_write(writer)
+    assert database.read_database(writer) is database.database
+    assert database.read_database('other@stringshare.ca') is replica
+
+    monkeypatch.setattr(constants, 'READ_YOUR_WRITES_SECONDS', 0)
+    assert database.read_database(writer) is replica
+
+
+def test_primary_reads_skip_the_replica(replica):
+    with database.primary_reads():
+        assert database.read_database('reader@stringshare.ca') is database.database
+    assert database.read_database('reader@stringshare.ca') is replica
+
+
+def test_other_communities_have_no_replicas(replica):
+    other = communities.Community('other.test', 'postgresql://other/other', 'media/other/', 'data/other', '')
+    token = communities._current.set(other)
+    try:
+        assert database.read_database() is database.database
+    finally:
+        communities._current.reset(token)
+
+
+# With a streaming replica of the test database in POSTGRES_REPLICA_URL: a user who just wrote reads the write back
+@pytest.mark.skipif(not os.getenv('POSTGRES_REPLICA_URL'), reason="needs a replica of the test database")
+def test_writes_are_read_back_with_a_replica(replica):
+    async def scenario():
+        communities.create_tables(constants.DB_URL)
+        await database.database.connect()
+        await replica.connect()
+        username = 'replica{}@stringshare.ca'.format(uuid.uuid4().hex[:8])
+        try:
+            await database.database.execute("INSERT INTO users (username, full_name) VALUES (:username, 'R')",
+                                            {'username': username})
+            database.mark_write(username)
+            query = "SELECT username FROM users WHERE username = :username"
+            return await database.read_database(username).fetch_val(query, {'username': username})
+        finally:
+            await database.database.execute("DELETE FROM users WHERE username = :username", {'username': username})
+            await replica.disconnect()
+            await database.database.disconnect()
+            communities.default.instances.clear()
+    assert run(scenario()) is not None
@@ -0,0 +1,43 @@
+# orjson responses: records are serialized exactly as FastAPI serializes them through the response model, keeping
+# only the model's fields
+import datetime
+import uuid
+import orjson
+from fastapi.encoders import jsonable_encoder
+import models
+import responses
+
+
+# Stand-in for the UUID subclass returned by asyncpg
+class RecordUUID(uuid.UUID):
+    pass
+
+
+POST = {
+    'post_id': RecordUUID('00000000-0000-0000-0000-000000000001'), 'username': 'author@stringshare.ca',
+    'full_name': 'Author', 'content': 'hello', 'date_posted': datetime.datetime(2024, 1, 2, 3, 4, 5, 678900),
+    'latitude': 45.5, 'longitude': -73.6, 'avatar_url': None, 'image_url': 'ab/cd/abcd.jpg', 'comments': 2,
+    'likes': 3, 'liked': True,
+}
+PROFILE = {
+    'username': 'author@stringshare.ca', 'full_name': 'Author', 'bio': None, 'avatar_url': 'ab/cd/ef.png',
+    'followers': 1, 'following': 0, 'posts': [POST], 'next_cursor': 'abc', 'hashed_password': 'secret',
+}
+
+
+# Function serializing content the way FastAPI does for a route with a response model
+def through_model(content, model: type):
+    if isinstance(content, list):
+        return orjson.loads(orjson.dumps(jsonable_encoder([model(**item) for item in content])))
+    return orjson.loads(orjson.dumps(jsonable_encoder(model(**content))))
+
+
+def test_records_match_the_response_model():
+    assert orjson.loads(responses.dump_records(PROFILE, models.UserOut)) == through_model(PROFILE, models.UserOut)
+    assert orjson.loads(responses.dump_records([POST, POST], models.PostOut)) == through_model([POST, POST],
+                                                                                              models.PostOut)
+
+
+def test_fields_outside_the_model_are_left_out():
+    body = orjson.loads(responses.RecordResponse(PROFILE, models.UserOut).body)
+    assert 'hashed_password' not in body and set(body) == set(models.UserOut.__fields__)
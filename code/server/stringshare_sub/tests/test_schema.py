@@ -0,0 +1,26 @@
+# Schema upkeep: an index left invalid by a failed concurrent build is dropped and built again, the others are only
+# created if missing
+from conftest import run
+import schema
+
+
+# Stand-in for a database reporting 'invalid' as the invalid indexes and recording the statements it runs
+class StandInDatabase:
+    def __init__(self, invalid: list):
+        self.invalid = invalid
+        self.statements = []
+
+    async def fetch_all(self, query):
+        return [(name,) for name in self.invalid]
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+
+
+def test_invalid_indexes_are_rebuilt(monkeypatch):
+    db = StandInDatabase(['ix_likes_username'])
+    monkeypatch.setattr(schema, 'database', db)
+    run(schema.ensure_indexes())
+    dropped = [index for index, statement in enumerate(db.statements) if statement.startswith("DROP")]
+    assert [db.statements[index] for index in dropped] == ["DROP INDEX CONCURRENTLY IF EXISTS ix_likes_username"]
+    assert db.statements[dropped[0] + 1].startswith("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_username")
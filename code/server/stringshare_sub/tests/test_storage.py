@@ -0,0 +1,53 @@
+# Media store: identical content is stored once, and the sweep only removes old files that nothing references
+import os
+import time
+from conftest import run
+import storage
+
+
+# Stand-in for a database answering the references query with 'referenced'
+class StandInDatabase:
+    def __init__(self, referenced):
+        self.referenced = referenced
+
+    async def fetch_all(self, query):
+        return [{'url': url} for url in self.referenced]
+
+
+def age(store: storage.MediaStore, url: str, seconds: float):
+    path = os.path.join(store.root, url)
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    store = storage.MediaStore(root=str(tmp_path))
+    url = run(store.save(b'image', '.JPG'))
+    assert run(store.save(b'image', '.jpg')) == url and url.endswith('.jpg')
+    assert run(store.save(b'other', '.jpg')) != url
+    assert len(os.listdir(os.path.join(store.root, url[:5]))) == 1
+    with open(store.path(url), 'rb') as stored:
+        assert stored.read() == b'image'
+
+
+def test_only_old_unreferenced_files_are_swept(monkeypatch, tmp_path):
+    store = storage.MediaStore(root=str(tmp_path), grace=60, delete_rate=1e6)
+    referenced, garbage, recent = [run(store.save(content, '.jpg')) for content in (b'kept', b'garbage', b'recent')]
+    for url in (referenced, garbage):
+        age(store, url, 120)
+    monkeypatch.setattr(storage, 'database', StandInDatabase([referenced]))
+
+    removed = sum(run(store.collect(shard)) for shard in store.shards())
+    assert removed == 1
+    assert not os.path.exists(os.path.join(store.root, garbage))
+    assert os.path.exists(os.path.join(store.root, referenced)) and os.path.exists(os.path.join(store.root, recent))
+
+
+def test_reused_files_are_not_swept(monkeypatch, tmp_path):
+    store = storage.MediaStore(root=str(tmp_path), grace=60, delete_rate=1e6)
+    url = run(store.save(b'image', '.jpg'))
+    age(store, url, 120)
+    # An identical upload reuses the file, refreshing it
+    run(store.save(b'image', '.jpg'))
+    monkeypatch.setattr(storage, 'database', StandInDatabase([]))
+    assert run(store.collect(url[:5])) == 0
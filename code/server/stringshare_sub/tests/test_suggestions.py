@@ -0,0 +1,49 @@
+# Follow suggestions: a refresh on the initial data suggests accounts to the local users, and only to them, and
+# the users refreshed within SUGGESTIONS_INTERVAL are left alone by the next one
+from sqlalchemy.sql import select, insert
+from conftest import requires_db, run, connected
+import helper
+import suggestions
+import tables
+
+
+@requires_db
+def test_refresh_suggests_accounts_to_local_users(monkeypatch):
+    monkeypatch.setattr(suggestions, 'SUGGESTIONS_CHUNK_DELAY', 0)
+
+    async def scenario():
+        async with connected() as db:
+            for statement in helper.reset_statements():
+                await db.execute(statement)
+            await helper.rebuild_user_stats()
+            await db.execute(insert(tables.users).values(username='someone@peer.test', full_name='Remote'))
+
+            await suggestions.refresh()
+            return {row['username']: row['candidates'] for row in
+                    await db.fetch_all(select([tables.follow_suggestions]))}
+    stored = run(scenario())
+    assert stored and all(username.endswith('@stringshare.ca') for username in stored)
+    assert any(stored.values())
+
+
+@requires_db
+def test_refresh_skips_users_refreshed_recently(monkeypatch):
+    monkeypatch.setattr(suggestions, 'SUGGESTIONS_CHUNK_DELAY', 0)
+    computed = []
+    compute = suggestions.compute
+
+    async def counted(usernames, popular):
+        computed.extend(usernames)
+        return await compute(usernames, popular)
+    monkeypatch.setattr(suggestions, 'compute', counted)
+
+    async def scenario():
+        async with connected() as db:
+            for statement in helper.reset_statements():
+                await db.execute(statement)
+            await suggestions.refresh()
+            refreshed = len(computed)
+            await suggestions.refresh()
+            return refreshed, len(computed)
+    refreshed, total = run(scenario())
+    assert refreshed and total == refreshed
@@ -0,0 +1,40 @@
+# Feed sync: watermarks are transaction ids, so the changes of transactions still running are held back
+from sqlalchemy.sql import select, insert
+from conftest import requires_db, run, connected, add_user
+import changes
+import methods
+import models
+import tables
+
+
+# Asynchronous function making 'follower' follow 'author', who then posts, returning the post's change row
+async def followed_post(db):
+    author, follower = await add_user('author'), await add_user('follower')
+    await db.execute(insert(tables.following).values(user=follower, following=author))
+    post_id = await db.execute(insert(tables.posts).values(username=author, content='hello')
+                               .returning(tables.posts.c.post_id))
+    await changes.record([post_id], changes.POST)
+    change = await db.fetch_one(select([tables.post_changes]).where(tables.post_changes.c.post_id == post_id))
+    return models.User(username=follower, full_name='Follower'), change
+
+
+@requires_db
+def test_changes_of_running_transactions_are_not_skipped():
+    async def scenario():
+        # The test's transaction is still running, so its change is neither handed out nor passed by the watermark
+        async with connected() as db:
+            user, change = await followed_post(db)
+            result = await methods.sync_feed(user, 0)
+            assert result['posts'] == [] and not result['reset']
+            assert result['watermark'] <= change['txid']
+    run(scenario())
+
+
+@requires_db
+def test_pruned_watermarks_reset():
+    async def scenario():
+        async with connected() as db:
+            user, change = await followed_post(db)
+            result = await methods.sync_feed(user, 1)
+            assert result['reset'] and result['posts'] == []
+    run(scenario())
@@ -0,0 +1,24 @@
+# Trending scores: removing a like takes back the weight it added, however long ago it was added
+import pytest
+import trending
+
+
+def test_unlike_takes_back_the_weight_the_like_added(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(trending.time, 'time', lambda: now[0])
+    tracker = trending.TrendingTracker(half_life=10)
+    tracker.record('post', 2)
+    tracker.like('post', 'someone', True)
+
+    # Ten half-lives later a new like weighs 1024 times more, but only the old like's weight is taken back
+    now[0] += 100
+    tracker.like('post', 'someone', False)
+    assert tracker._scores['post'] == pytest.approx(2)
+    assert tracker.top(1) == ['post']
+
+
+def test_unknown_likes_cannot_make_scores_negative():
+    tracker = trending.TrendingTracker()
+    tracker.record('post', 0.5)
+    tracker.like('post', 'liked before the start', False)
+    assert 'post' not in tracker._scores and tracker.top(1) == []
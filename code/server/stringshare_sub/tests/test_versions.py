@@ -0,0 +1,36 @@
+# ETags: If-None-Match is compared weakly, and tags built with a stamp evicted from memory never match again
+import types
+import pytest
+import versions
+
+
+@pytest.fixture(autouse=True)
+def stamps(monkeypatch):
+    monkeypatch.setattr(versions, 'stamps', versions.Stamps(size=2))
+
+
+def request(header: str):
+    return types.SimpleNamespace(headers={'if-none-match': header})
+
+
+def test_tags_are_compared_weakly():
+    etag = versions.activity_etag('someone')
+    opaque = etag[2:]
+    assert versions.not_modified(request(etag), etag)
+    assert versions.not_modified(request('"other", ' + opaque), etag)
+    assert versions.not_modified(request('*'), etag)
+    assert not versions.not_modified(request('W/"other"'), etag)
+    # Only a 'W/' prefix is ignored, not any two characters
+    assert not versions.not_modified(request('Xy' + opaque), etag)
+
+
+def test_tags_of_evicted_stamps_never_match_again():
+    versions.bump('someone')
+    etag = versions.activity_etag('someone')
+    versions.bump('other', 'third')
+    assert 'someone' not in versions.stamps.versions
+    assert versions.activity_etag('someone') != etag
+
+    # Bumping the user again after the eviction does not give back the old stamp either
+    versions.bump('someone')
+    assert versions.activity_etag('someone') != etag